@@ -49,6 +49,8 @@ export default function Nodes() {
   const navigate = useNavigate()
   const { workflow } = useLoaderData<typeof loader>()
   const [running, setRunning] = useState(false)
+  // The run shown, the latest one until this page starts its own
+  const [runId, setRunId] = useState<string | null>(null)
 
   const [nodes, setNodes] = useState([])
   const [edges, setEdges, onEdgesChange] = useEdgesState(initialEdges)
@@ -58,32 +60,61 @@ export default function Nodes() {
     [setEdges],
   )
 
-  async function poll() {
-    try {
-      const res = await fetch(`${API_URL}/agent_status`, {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({}),
+  useEffect(() => {
+    const query = runId ? `?run_id=${encodeURIComponent(runId)}` : ''
+    const source = new EventSource(`${API_URL}/agent_status/stream${query}`)
+
+    // Without a run ID the stream carries every run's events, only follow the run shown
+    function listen(type: string, handler: (body: any) => void) {
+      source.addEventListener(type, evt => {
+        const body = JSON.parse((evt as MessageEvent).data)
+        if (runId && body.run_id !== runId) return
+        handler(body)
       })
-      if (!res.ok) throw new Error("F in chat")
-      const body = await res.json() as unknown as any
-      const elapsedTime = body.elapsed_time as number
-      toast.info("Refreshing agent workflow status")
-      if (elapsedTime) setRunning(true)
-      const nodes = body.data as any[]
-      // console.log({ body, nodes })
-      setNodes(nodes as any)
-    } catch (err) {
-      console.error("Error occurred", err)
-      toast.error("Failed to refresh workflow status.")
     }
-  }
 
-  useEffect(() => {
-    poll()
-    const interval = setInterval(poll, 3000);
-    return () => clearInterval(interval);
-  }, [running])
+    function updateNode(label: string, patch: Record<string, unknown>) {
+      setNodes((nodes: any[]) =>
+        nodes.map(node =>
+          node.data?.label === label ? { ...node, data: { ...node.data, ...patch } } : node,
+        ) as any,
+      )
+    }
+
+    source.addEventListener('snapshot', evt => {
+      const body = JSON.parse((evt as MessageEvent).data)
+      setRunning(Boolean(body.task_active))
+      setNodes((body.data ?? []) as any)
+      if (!runId && body.run_id) setRunId(body.run_id)
+    })
+    listen('task_start', body => {
+      if (!runId) setRunId(body.run_id)
+      setRunning(true)
+    })
+    // Every way a run stops running, parked runs start again with task_start once approved
+    for (const type of ['task_end', 'task_failed', 'task_cancelled', 'task_stopped', 'task_parked']) {
+      listen(type, () => setRunning(false))
+    }
+    listen('task_failed', body => toast.error(`Workflow failed: ${body.error}`))
+    listen('task_stopped', body => toast.warning(`Workflow stopped at its ${body.reason} limit`))
+    listen('agent_start', body => {
+      updateNode(body.agent, { status: 'running', number_calls: body.call_count })
+    })
+    listen('agent_finish', body => {
+      updateNode(body.agent, {
+        status: 'success',
+        timeElapsed: body.elapsed_time,
+        number_calls: body.call_count,
+      })
+    })
+    listen('human_feedback', body => {
+      toast.info(`${body.agent} is waiting for feedback`)
+    })
+    source.onerror = () => {
+      toast.error("Lost connection to workflow status, retrying...")
+    }
+    return () => source.close()
+  }, [runId])
 
   return (
     <main className="mt-6 container h-[calc(100vh-32px)]">
@@ -94,7 +125,7 @@ export default function Nodes() {
           </div>
           <div className=" text-sm text-muted-foreground">{workflow?.description}</div>
         </div>
-        <RunWorkflow running={running} setRunning={setRunning} />
+        <RunWorkflow running={running} onStarted={id => { setRunId(id); setRunning(true) }} />
       </div>
       <Alert/>
       <div className="h-3/4 py-6 grid">
@@ -215,7 +246,7 @@ function AgentBody({
 
 const DEFAULT_PROMPT = "Scrape the first sentence on this link https://github.com/langchain-ai/langgraph/tree/main and then search the web to find an important lead developer."
 
-function RunWorkflow({ running, setRunning }: { running: boolean; setRunning: (val: boolean) => void }) {
+function RunWorkflow({ running, onStarted }: { running: boolean; onStarted: (runId: string) => void }) {
   const [open, setOpen] = useState(false)
   const [starting, setStarting] = useState(false)
   const [prompt, setPrompt] = useState(DEFAULT_PROMPT)
@@ -257,9 +288,9 @@ function RunWorkflow({ running, setRunning }: { running: boolean; setRunning: (v
                     body: JSON.stringify({ prompt }),
                   })
                   if (!res.ok) throw new Error("F in chat")
-                  await res.json()
+                  const { run_id } = await res.json()
                   toast.success("Agent workflow started!")
-                  setRunning(true)
+                  onStarted(run_id)
                   setOpen(false)
                 } catch (err) {
                   console.error("Error", err)
@@ -0,0 +1,514 @@
+"""Load benchmark for symphony_api.py.
+
+The API runs in a child process against deterministic local fakes with
+configurable latency: the parent serves an OpenAI-compatible chat completions
+endpoint and the scraped pages, and Tavily search is patched in the child. A
+run walks the real graph, model clients, scheduler, tools and run store
+without touching the network. The parent drives `/run_agent_stream`, `/agent_status` and
+`/update_agent` at a fixed client concurrency and reports throughput, request
+latency percentiles, the server's event-loop lag and its memory use.
+
+    python bench/symphony_bench.py --runs 200 --concurrency 16
+    python bench/symphony_bench.py --save-baseline
+    python bench/symphony_bench.py  # compares with bench/baseline.json when it exists
+
+`--import-time` only times a cold `import symphony_api` in fresh interpreters
+and fails when the median is over `--import-budget` seconds, which keeps heavy
+imports from creeping back into the server's startup path:
+
+    python bench/symphony_bench.py --import-time --import-budget 2
+
+`--workers N` starts N API processes sharing state through `--redis-url` and
+spreads the requests over them, so a run is submitted, polled and finished
+through different workers:
+
+    python bench/symphony_bench.py --workers 3 --redis-url redis://localhost:6379/0
+
+Comparing exits with status 1 when a metric is worse than the baseline by more
+than `--tolerance`. Baselines are machine specific, record them on the machine
+you compare on.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import zlib
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baseline.json"
+FINISHED_STATUSES = ("finished", "stopped", "failed", "rejected", "cancelled", "parked")
+
+# The graph structure the dashboard nodes are built from
+BENCH_STRUCTURE = [
+    {"id": str(index), "type": "agent", "position": {"x": 0, "y": 100 * index},
+     "data": {"label": label, "status": "pending", "timeElapsed": 0, "num iters": 0}}
+    for index, label in enumerate(["User", "supervisor", "Search", "WebScraper"], start=1)
+]
+
+# Metrics compared against the baseline, and whether a higher value is better
+COMPARED_METRICS = {
+    "runs_per_second": True,
+    "run_seconds.p95": False,
+    "requests.agent_status.p95": False,
+    "requests.agent_status.p99": False,
+    "requests.update_agent.p95": False,
+    "server.loop_lag.p99": False,
+    "server.max_rss_mb": False,
+}
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def rank(q: float) -> float:
+        return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))]
+
+    return {"count": len(ordered), "p50": rank(0.50), "p95": rank(0.95), "p99": rank(0.99), "max": ordered[-1]}
+
+
+# server side
+def install_fakes(args) -> None:
+    """Replace the search tool with a local fake, the model and pages are served by the parent."""
+    from langchain_community.tools.tavily_search import TavilySearchResults
+
+    async def fake_search(self, query, run_manager=None):
+        await asyncio.sleep(args.search_latency)
+        return [{"url": f"{args.upstream_url}/page/{index}", "content": f"Result {index} for {query}"}
+                for index in range(self.max_results)]
+
+    TavilySearchResults._arun = fake_search
+
+
+class LoopLagMonitor:
+    """Measure how late the event loop wakes a task that sleeps for `interval`."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples = []
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - start - self.interval))
+
+
+def current_rss_mb() -> float:
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def serve(args) -> None:
+    install_fakes(args)
+    sys.path.insert(0, str(REPO_ROOT))
+    import uvicorn
+    import symphony_api
+
+    monitor = LoopLagMonitor(args.lag_interval)
+
+    @symphony_api.app.on_event("startup")
+    async def start_lag_monitor():
+        asyncio.ensure_future(monitor.run())
+
+    @symphony_api.app.get("/_bench/stats")
+    async def bench_stats(reset: bool = False):
+        stats = {
+            "loop_lag": percentiles(monitor.samples),
+            "rss_mb": current_rss_mb(),
+            "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+        if reset:
+            monitor.samples.clear()
+        return stats
+
+    uvicorn.run(symphony_api.app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+# client side
+def fake_completion(args, body: dict, base_url: str) -> dict:
+    """The assistant message a scripted OpenAI model answers `body` with."""
+    messages = body["messages"]
+    functions = {function["name"] for function in body.get("functions") or []}
+    question = next((m["content"] for m in messages if m["role"] == "user" and not m.get("name")), "")
+    tool_called = any(m["role"] == "function" for m in messages)
+
+    def function_call(name: str, arguments: dict) -> dict:
+        return {"role": "assistant", "content": None, "function_call": {"name": name, "arguments": json.dumps(arguments)}}
+
+    if "route" in functions:
+        # Search, then WebScraper (or both at once with --fan-out), then finish
+        workers = sum(1 for m in messages if m["role"] == "user" and m.get("name"))
+        routes = [["Search", "WebScraper"], "FINISH"] if args.fan_out else ["Search", "WebScraper", "FINISH"]
+        return function_call("route", {"next": routes[min(workers, len(routes) - 1)]})
+    if "tavily_search_results_json" in functions and not tool_called:
+        return function_call("tavily_search_results_json", {"query": question})
+    if "scrape_webpages" in functions and not tool_called:
+        page_id = zlib.crc32(question.encode()) % args.distinct_pages
+        return function_call("scrape_webpages", {"urls": [f"{base_url}/page/{page_id}"]})
+    return {"role": "assistant", "content": f"Answer to {question}: " + "lorem ipsum " * (args.answer_bytes // 12)}
+
+
+async def start_upstream_server(args) -> web.AppRunner:
+    """Serve the pages the fake WebScraper agent asks for, and an OpenAI-compatible chat completions API."""
+
+    async def page(request: web.Request) -> web.Response:
+        await asyncio.sleep(args.page_latency)
+        page_id = request.match_info["page_id"]
+        paragraph = f"<p>Benchmark page {page_id}. " + "Lorem ipsum dolor sit amet. " * 8 + "</p>"
+        body = f"<html><head><title>Page {page_id}</title></head><body>{paragraph * max(1, args.page_bytes // len(paragraph))}</body></html>"
+        return web.Response(text=body, content_type="text/html")
+
+    async def chat_completions(request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        await asyncio.sleep(args.llm_latency)
+        if random.random() < args.llm_error_rate:
+            error = {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}
+            return web.json_response({"error": error}, status=429, headers={"retry-after": "0.1"})
+        message = fake_completion(args, body, f"http://{request.host}")
+        finish_reason = "function_call" if message.get("function_call") else "stop"
+        completion = {"id": "chatcmpl-bench", "created": int(time.time()), "model": body["model"]}
+        if not body.get("stream"):
+            prompt_tokens = sum(len(str(m.get("content") or "")) for m in body["messages"]) // 4
+            return web.json_response({
+                **completion, "object": "chat.completion",
+                "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 50, "total_tokens": prompt_tokens + 50},
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        content = message.get("content") or ""
+        deltas = [{"role": "assistant", "content": "", "function_call": message.get("function_call")}]
+        deltas += [{"content": content[start:start + 40]} for start in range(0, len(content), 40)]
+        for delta, last in zip(deltas, [False] * (len(deltas) - 1) + [True]):
+            chunk = {**completion, "object": "chat.completion.chunk", "choices": [
+                {"index": 0, "delta": {key: value for key, value in delta.items() if value is not None},
+                 "finish_reason": finish_reason if last else None}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    application = web.Application()
+    application.router.add_get("/page/{page_id}", page)
+    application.router.add_post("/v1/chat/completions", chat_completions)
+    runner = web.AppRunner(application)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    return runner
+
+
+class LoadDriver:
+    """Submit runs from `concurrency` clients and poll each until it ends, like the dashboard does.
+
+    With several workers each request goes to the next one in turn, so a run is mostly polled
+    through workers that do not execute it.
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, base_urls: List[str], poll_interval: float):
+        self.session = session
+        self.base_urls = itertools.cycle(base_urls)
+        self.poll_interval = poll_interval
+        self.latencies = {"run_agent_stream": [], "agent_status": [], "update_agent": [], "runs": []}
+        self.run_seconds = []
+        self.statuses = {}
+        self.rejected = 0
+
+    async def request(self, name: str, method: str, path: str, **kwargs):
+        start = time.perf_counter()
+        async with self.session.request(method, next(self.base_urls) + path, **kwargs) as response:
+            body = await response.json(content_type=None)
+        self.latencies[name].append(time.perf_counter() - start)
+        return response, body
+
+    async def one_run(self, index: int) -> None:
+        start = time.perf_counter()
+        while True:
+            response, body = await self.request(
+                "run_agent_stream", "POST", "/run_agent_stream", json={"prompt": f"Benchmark question {index}"}
+            )
+            if response.status != 429:
+                break
+            self.rejected += 1
+            await asyncio.sleep(float(response.headers.get("Retry-After", "1")))
+        run_id = body["run_id"]
+        version = None
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            params = {"run_id": run_id} if version is None else {"run_id": run_id, "since": version}
+            _, status = await self.request("agent_status", "GET", "/agent_status", params=params)
+            version = status.get("version", version)
+            await self.request("update_agent", "GET", "/update_agent", params={"run_id": run_id})
+            _, run = await self.request("runs", "GET", f"/runs/{run_id}")
+            if run["status"] in FINISHED_STATUSES:
+                break
+        self.run_seconds.append(time.perf_counter() - start)
+        self.statuses[run["status"]] = self.statuses.get(run["status"], 0) + 1
+
+    async def drive(self, runs: int, concurrency: int) -> None:
+        indexes = iter(range(runs))
+
+        async def client():
+            for index in indexes:
+                await self.one_run(index)
+
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+
+
+async def wait_until_ready(session: aiohttp.ClientSession, base_url: str, server: subprocess.Popen) -> None:
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Benchmark server exited with status {server.returncode}")
+        try:
+            async with session.get(base_url + "/_bench/stats") as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("Benchmark server did not start in time")
+
+
+async def benchmark(args) -> dict:
+    upstream = await start_upstream_server(args)
+    upstream_url = "http://127.0.0.1:%d" % upstream.addresses[0][1]
+    workdir = tempfile.TemporaryDirectory(prefix="symphony-bench-")
+    structure_path = Path(workdir.name) / "cleaned_structure.json"
+    structure_path.write_text(json.dumps(BENCH_STRUCTURE))
+    env = dict(
+        os.environ,
+        OPENAI_API_KEY="bench",
+        OPENAI_API_BASE=upstream_url + "/v1",
+        SYMPHONY_STATE_BACKEND="redis" if args.workers > 1 else "local",
+        SYMPHONY_REDIS_URL=args.redis_url or "",
+        SYMPHONY_REDIS_PREFIX=f"symphony-bench-{uuid.uuid4().hex[:8]}",
+        TAVILY_API_KEY="bench",
+        SYMPHONY_STRUCTURE_PATH=str(structure_path),
+        SYMPHONY_RUN_STORE_PATH=str(Path(workdir.name) / "runs.db"),
+        SYMPHONY_LLM_CACHE=args.llm_cache,
+        SYMPHONY_MAX_CONCURRENT_RUNS=str(args.max_concurrent_runs),
+    )
+    servers = [
+        subprocess.Popen(
+            [sys.executable, str(Path(__file__).resolve()), "--serve", "--port", str(args.port + index),
+             "--upstream-url", upstream_url, "--search-latency", str(args.search_latency), "--lag-interval", str(args.lag_interval)],
+            env=env, cwd=workdir.name, stdout=subprocess.DEVNULL,  # The run loop prints every step
+        )
+        for index in range(args.workers)
+    ]
+    base_urls = [f"http://127.0.0.1:{args.port + index}" for index in range(args.workers)]
+    try:
+        connector = aiohttp.TCPConnector(limit=args.concurrency * 2)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            for base_url, server in zip(base_urls, servers):
+                await wait_until_ready(session, base_url, server)
+            if args.warmup:
+                await LoadDriver(session, base_urls, args.poll_interval).drive(args.warmup, min(args.warmup, args.concurrency))
+            for base_url in base_urls:
+                async with session.get(base_url + "/_bench/stats", params={"reset": "true"}):
+                    pass
+            driver = LoadDriver(session, base_urls, args.poll_interval)
+            start = time.perf_counter()
+            await driver.drive(args.runs, args.concurrency)
+            duration = time.perf_counter() - start
+            worker_stats = []
+            for base_url in base_urls:
+                async with session.get(base_url + "/_bench/stats") as response:
+                    worker_stats.append(await response.json())
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+        await upstream.cleanup()
+        workdir.cleanup()
+
+    return {
+        "config": {key: value for key, value in vars(args).items()
+                   if key not in ("serve", "port", "upstream_url", "redis_url", "baseline", "save_baseline", "output", "tolerance")},
+        "duration_seconds": duration,
+        "runs_per_second": args.runs / duration,
+        "statuses": driver.statuses,
+        "rejected_submissions": driver.rejected,
+        "run_seconds": percentiles(driver.run_seconds),
+        "requests": {name: percentiles(samples) for name, samples in driver.latencies.items()},
+        "server": merge_server_stats(worker_stats),
+    }
+
+
+def merge_server_stats(worker_stats: List[dict]) -> dict:
+    """Combine the workers' stats: the worst event-loop lag and the total memory."""
+    return {
+        "loop_lag": {key: (sum if key == "count" else max)(stats["loop_lag"][key] for stats in worker_stats)
+                     for key in worker_stats[0]["loop_lag"]},
+        "rss_mb": sum(stats["rss_mb"] for stats in worker_stats),
+        "max_rss_mb": sum(stats["max_rss_mb"] for stats in worker_stats),
+    }
+
+
+def measure_import_time(repeats: int) -> dict:
+    """Time `import symphony_api` in fresh interpreters, with the slowest modules it imports directly."""
+    samples = []
+    with tempfile.TemporaryDirectory(prefix="symphony-bench-") as workdir:
+        structure_path = Path(workdir) / "cleaned_structure.json"
+        structure_path.write_text(json.dumps(BENCH_STRUCTURE))
+        env = dict(
+            os.environ,
+            OPENAI_API_KEY="bench",
+            TAVILY_API_KEY="bench",
+            PYTHONPATH=os.pathsep.join(filter(None, [str(REPO_ROOT), os.environ.get("PYTHONPATH")])),
+            SYMPHONY_STRUCTURE_PATH=str(structure_path),
+            SYMPHONY_RUN_STORE_PATH=str(Path(workdir) / "runs.db"),
+        )
+        # Timed inside the child so interpreter startup is not counted
+        timed = "import time; start = time.perf_counter(); import symphony_api; print(time.perf_counter() - start)"
+        for _ in range(repeats):
+            completed = subprocess.run([sys.executable, "-c", timed], env=env, cwd=workdir,
+                                       capture_output=True, text=True, check=True)
+            samples.append(float(completed.stdout.split()[-1]))
+        profiled = subprocess.run([sys.executable, "-X", "importtime", "-c", "import symphony_api"], env=env, cwd=workdir,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+
+    # -X importtime lines look like "import time: self [us] | cumulative | package", indented two
+    # spaces per nesting level, so the modules symphony_api imports itself are one level deep
+    direct = []
+    for line in profiled.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].startswith("   ") and not fields[2].startswith("    "):
+            direct.append((int(fields[1]) / 1e6, fields[2].strip()))
+    return {
+        "seconds": percentiles(samples),
+        "slowest_imports": {name: seconds for seconds, name in sorted(direct, reverse=True)[:10]},
+    }
+
+
+def lookup(results: dict, path: str) -> Optional[float]:
+    value = results
+    for key in path.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Metrics that got worse than the baseline by more than `tolerance`."""
+    regressions = []
+    for path, higher_is_better in COMPARED_METRICS.items():
+        current, previous = lookup(results, path), lookup(baseline, path)
+        if current is None or not previous:
+            continue
+        change = (current - previous) / previous
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append(f"{path}: {previous:.4g} -> {current:.4g} ({change:+.0%})")
+    return regressions
+
+
+def report(results: dict) -> None:
+    def ms(summary: dict) -> str:
+        if not summary.get("count"):
+            return "no samples"
+        return "p50 {p50:.1f} ms, p95 {p95:.1f} ms, p99 {p99:.1f} ms, max {max:.1f} ms".format(
+            **{key: summary[key] * 1000 for key in ("p50", "p95", "p99", "max")})
+
+    print(f"Runs:            {sum(results['statuses'].values())} {results['statuses']} in {results['duration_seconds']:.1f} s")
+    print(f"Throughput:      {results['runs_per_second']:.2f} runs/s ({results['rejected_submissions']} submissions rejected)")
+    print(f"Run latency:     {ms(results['run_seconds'])}")
+    for name, summary in results["requests"].items():
+        print(f"{name + ':':<17}{ms(summary)}")
+    print(f"Event-loop lag:  {ms(results['server']['loop_lag'])}")
+    print(f"Server RSS:      {results['server']['rss_mb']:.0f} MB (peak {results['server']['max_rss_mb']:.0f} MB)")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=100, help="Runs to submit in the measured phase")
+    parser.add_argument("--warmup", type=int, default=5, help="Runs to submit before measuring")
+    parser.add_argument("--concurrency", type=int, default=8, help="Clients submitting and polling runs at once")
+    parser.add_argument("--poll-interval", type=float, default=0.2, help="Seconds between a client's status polls")
+    parser.add_argument("--max-concurrent-runs", type=int, default=4, help="SYMPHONY_MAX_CONCURRENT_RUNS for the server")
+    parser.add_argument("--llm-cache", default="off", choices=["off", "memory", "sqlite"], help="SYMPHONY_LLM_CACHE for the server")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Seconds each fake model call takes")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="Fraction of fake model calls answered with a 429")
+    parser.add_argument("--search-latency", type=float, default=0.1, help="Seconds each fake search takes")
+    parser.add_argument("--page-latency", type=float, default=0.05, help="Seconds the local page server takes per page")
+    parser.add_argument("--page-bytes", type=int, default=20000, help="Approximate size of each served page")
+    parser.add_argument("--answer-bytes", type=int, default=2000, help="Approximate size of each agent answer")
+    parser.add_argument("--distinct-pages", type=int, default=1000000, help="Pages the scraper picks from, lower it to exercise the page cache")
+    parser.add_argument("--fan-out", action="store_true", help="Have the fake supervisor start both workers at once")
+    parser.add_argument("--lag-interval", type=float, default=0.01, help="Sampling interval of the event-loop lag monitor")
+    parser.add_argument("--import-time", action="store_true", help="Only measure how long importing the API takes")
+    parser.add_argument("--import-budget", type=float, default=2.0, help="Seconds the median import may take in --import-time mode")
+    parser.add_argument("--import-repeats", type=int, default=5, help="Fresh interpreters to time the import in")
+    parser.add_argument("--workers", type=int, default=1, help="API processes sharing state through --redis-url")
+    parser.add_argument("--redis-url", help="Redis the workers share state through, needed with --workers above 1")
+    parser.add_argument("--port", type=int, default=8765, help="Port of the first worker, the others use the next ones")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE, help="Baseline results to compare with")
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression before failing")
+    parser.add_argument("--output", type=Path, help="Also write the results to this file")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--upstream-url", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main() -> int:
+    args = parse_args()
+    if args.serve:
+        serve(args)
+        return 0
+    if args.import_time:
+        results = measure_import_time(args.import_repeats)
+        median = results["seconds"]["p50"]
+        print(f"Import time:     p50 {median:.2f} s, max {results['seconds']['max']:.2f} s over {args.import_repeats} imports")
+        for name, seconds in results["slowest_imports"].items():
+            print(f"  {seconds:6.2f} s  {name}")
+        if args.output:
+            args.output.write_text(json.dumps(results, indent=2))
+        if median > args.import_budget:
+            print(f"Importing symphony_api takes {median:.2f} s, over the {args.import_budget:.2f} s budget")
+            return 1
+        return 0
+
+    if args.workers > 1 and not args.redis_url:
+        print("--workers above 1 needs --redis-url")
+        return 2
+    results = asyncio.run(benchmark(args))
+    report(results)
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(results, indent=2))
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+    if args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text())
+        if baseline.get("config") != results["config"]:
+            print("Warning: the baseline was recorded with a different configuration")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Regressions against the baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("No regressions against the baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,110 +1,958 @@
+import abc
 import getpass
 import os
 import time
 import json
+import re
+import uuid
+import heapq
+import bisect
+import hashlib
+import sqlite3
+import queue
+import threading
+import subprocess
+import sys
+import itertools
+import random
 import functools
 import asyncio
-from fastapi import FastAPI, Request
-from pydantic import BaseModel
+import contextlib
+import inspect
+import mmap
+import shutil
+import socket
+import tempfile
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextvars import Context, ContextVar
+from multiprocessing.connection import Connection
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field
 import dotenv
 dotenv.load_dotenv()
 
-from typing import Any, Callable, List, Optional, TypedDict, Union
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, List, Literal, NamedTuple, Optional, TypedDict, Union
 
-from langchain.agents import AgentExecutor, create_openai_functions_agent
-from langchain.output_parsers.openai_functions import JsonOutputFunctionsParser
+from langchain_core.callbacks import AsyncCallbackHandler
+from langchain_core.load import dumps, loads
+from langchain_core.prompt_values import ChatPromptValue
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.runnables import Runnable
+from langchain_core.runnables import Runnable, RunnableLambda, RunnablePassthrough
+from langchain_core.utils.function_calling import convert_to_openai_function
 from langchain_core.tools import BaseTool
-from langchain_openai import ChatOpenAI
 
 from langgraph.graph import END, StateGraph
 
+if TYPE_CHECKING:  # The OpenAI client is slow to import, it is loaded with the first model
+    from langchain_openai import ChatOpenAI
+
 from typing import Annotated, List, Tuple, Union
 
-import matplotlib.pyplot as plt
-from langchain_community.document_loaders import WebBaseLoader
+import httpx
 from langchain_community.tools.tavily_search import TavilySearchResults
 from langchain_core.tools import tool
 from langsmith import trace
 
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:  # Tracing is optional, the Prometheus metrics work without it
+    otel_trace = None
+
+import symphony_repl
+
 import functools
 import operator
 
 from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
-from langchain_openai.chat_models import ChatOpenAI
 import functools
 
 
 os.environ["LANGCHAIN_TRACING_V2"] = "false"
 os.environ["LANGCHAIN_PROJECT"] = "Multi-agent Collaboration"
 
+# instrumentation
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def format_labels(labelnames: Tuple[str, ...], values: Tuple[str, ...], **extra) -> str:
+    pairs = list(zip(labelnames, values)) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = [(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in pairs]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Counter:
+    """A running total per label combination."""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}  # Label values to total
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labelnames, key)} {value:g}")
+        return lines
+
+
+class Histogram:
+    """Bucketed observations per label combination, rendered with cumulative buckets."""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.series = {}  # Label values to (per-bucket counts with a final +Inf bucket, [sum])
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self.lock:
+            if key not in self.series:
+                self.series[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            counts, total = self.series[key]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total) in sorted(self.series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, le=le)} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {total[0]:g}")
+                lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """A value read from a callback each time the metrics are scraped."""
+
+    def __init__(self, name: str, documentation: str, read: Callable[[], float]):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge",
+                f"{self.name} {self.read():g}"]
+
+
+class MetricsRegistry:
+    """The metrics served at `/metrics` in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        self.metrics.append(Counter(name, documentation, labelnames))
+        return self.metrics[-1]
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Histogram:
+        self.metrics.append(Histogram(name, documentation, labelnames))
+        return self.metrics[-1]
+
+    def gauge(self, name: str, documentation: str, read: Callable[[], float]) -> Gauge:
+        self.metrics.append(Gauge(name, documentation, read))
+        return self.metrics[-1]
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+
+metrics = MetricsRegistry()
+run_queue_seconds = metrics.histogram(
+    "symphony_run_queue_seconds", "Time runs wait in the scheduler queue before a slot frees up.")
+run_seconds = metrics.histogram(
+    "symphony_run_seconds", "Time from creating a run until it ends, by final status.", ("status",))
+node_seconds = metrics.histogram(
+    "symphony_node_seconds", "Duration of each graph node call.", ("node",))
+llm_seconds = metrics.histogram(
+    "symphony_llm_seconds", "Latency of chat model calls that reached the provider.", ("model",))
+llm_tokens = metrics.counter(
+    "symphony_llm_tokens_total", "Tokens used by chat model calls.", ("model", "kind"))
+llm_cache_requests = metrics.counter(
+    "symphony_llm_cache_requests_total", "LLM response cache lookups by result.", ("result",))
+tool_seconds = metrics.histogram(
+    "symphony_tool_seconds", "Duration of tool calls, including time spent waiting for a slot.", ("tool",))
+tool_queue_seconds = metrics.histogram(
+    "symphony_tool_queue_seconds", "Time tool calls wait for an executor slot or REPL worker.", ("tool",))
+history_compactions = metrics.counter(
+    "symphony_history_compactions_total", "Model calls whose messages were shortened, by how far compaction went.", ("stage",))
+history_tokens_saved = metrics.counter(
+    "symphony_history_tokens_saved_total", "Estimated prompt tokens removed by history compaction.")
+token_stream_drops = metrics.counter(
+    "symphony_token_stream_drops_total", "Token stream clients disconnected for falling behind.")
+router_decisions = metrics.counter(
+    "symphony_router_decisions_total", "Supervisor routing decisions by path (rule or llm) and rule.", ("path", "rule"))
+shared_messages_dropped = metrics.counter(
+    "symphony_state_messages_dropped_total", "Events and signals that could not be sent to the other workers.")
+llm_retries = metrics.counter(
+    "symphony_llm_retries_total", "Chat model requests retried, by model and error.", ("model", "error"))
+llm_fallbacks = metrics.counter(
+    "symphony_llm_fallbacks_total", "Chat model requests sent to the fallback model after failing.", ("model", "fallback"))
+runs_stopped = metrics.counter(
+    "symphony_runs_stopped_total", "Runs stopped before finishing, by reason (cancelled or the budget limit exceeded).", ("reason",))
+
+
+def build_tracer_provider():
+    """Export spans to an OTLP/HTTP collector when SYMPHONY_OTLP_ENDPOINT is set.
+
+    Needs opentelemetry-sdk and opentelemetry-exporter-otlp-proto-http. Without
+    them, or without the endpoint, spans go to whatever provider is already
+    installed (a no-op one by default).
+    """
+    endpoint = os.getenv("SYMPHONY_OTLP_ENDPOINT")
+    if otel_trace is None or not endpoint:
+        return None
+    try:
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError as e:
+        print(f"OTLP export disabled: {e}")
+        return None
+    provider = TracerProvider(resource=Resource.create({"service.name": os.getenv("SYMPHONY_SERVICE_NAME", "symphony")}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=endpoint)))
+    otel_trace.set_tracer_provider(provider)
+    return provider
+
+
+tracer_provider = build_tracer_provider()
+tracer = otel_trace.get_tracer("symphony") if otel_trace is not None else None
+
+
+@contextlib.contextmanager
+def span(name: str, histogram: Optional[Histogram] = None, labels: Optional[dict] = None, **attributes):
+    """Time a block into `histogram` and record it as a tracing span.
+
+    Yields a dict whose "duration" is filled in when the block exits.
+    """
+    timing = {}
+    attributes = {key: value for key, value in attributes.items() if value is not None}
+    with tracer.start_as_current_span(name, attributes=attributes) if tracer else contextlib.nullcontext():
+        start = time.perf_counter()
+        try:
+            yield timing
+        finally:
+            timing["duration"] = time.perf_counter() - start
+            if histogram is not None:
+                histogram.observe(timing["duration"], **(labels or {}))
+
+
+class MetricsCallbackHandler(AsyncCallbackHandler):
+    """Record chat model latency, token usage and tool calls for every graph run.
+
+    Pass it in the run config's callbacks so it reaches every nested agent, model
+    and tool. Spans start under the node span that is current when the call starts.
+    """
+
+    def __init__(self):
+        self.started = {}  # LangChain run ID to (start time, metric label, span)
+
+    def _start(self, run_id, label: str, span_name: str, **attributes) -> None:
+        otel_span = tracer.start_span(span_name, attributes=attributes) if tracer else None
+        self.started[run_id] = (time.perf_counter(), label, otel_span)
+
+    def _finish(self, run_id, error: Optional[BaseException] = None, **attributes) -> Tuple[Optional[float], str]:
+        start, label, otel_span = self.started.pop(run_id, (None, "", None))
+        if start is None:
+            return None, label
+        if otel_span is not None:
+            otel_span.set_attributes(attributes)
+            if error is not None:
+                otel_span.record_exception(error)
+                otel_span.set_status(otel_trace.Status(otel_trace.StatusCode.ERROR, repr(error)))
+            otel_span.end()
+        return time.perf_counter() - start, label
+
+    async def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs) -> None:
+        model = kwargs.get("invocation_params", {}).get("model") or serialized.get("name", "unknown")
+        self._start(run_id, model, "llm", model=model)
+
+    async def on_llm_end(self, response, *, run_id, **kwargs) -> None:
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        duration, model = self._finish(run_id, prompt_tokens=usage.get("prompt_tokens", 0),
+                                       completion_tokens=usage.get("completion_tokens", 0))
+        if duration is None:
+            return
+        llm_seconds.observe(duration, model=model)
+        for kind in ("prompt", "completion"):
+            llm_tokens.inc(usage.get(f"{kind}_tokens", 0), model=model, kind=kind)
+
+    async def on_llm_error(self, error, *, run_id, **kwargs) -> None:
+        duration, model = self._finish(run_id, error)
+        if duration is not None:
+            llm_seconds.observe(duration, model=model)
+
+    async def on_tool_start(self, serialized, input_str, *, run_id, **kwargs) -> None:
+        name = serialized.get("name", "unknown")
+        self._start(run_id, name, f"tool {name}", tool=name)
+
+    async def on_tool_end(self, output, *, run_id, **kwargs) -> None:
+        duration, name = self._finish(run_id)
+        if duration is not None:
+            tool_seconds.observe(duration, tool=name)
+
+    async def on_tool_error(self, error, *, run_id, **kwargs) -> None:
+        duration, name = self._finish(run_id, error)
+        if duration is not None:
+            tool_seconds.observe(duration, tool=name)
+
+
+metrics_callback = MetricsCallbackHandler()
+
 # tools
-tavily_tool = TavilySearchResults(max_results=5)
+class TTLCache:
+    """A size-bounded LRU mapping whose entries expire after `ttl` seconds."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # Key to (expires_at, value), least recently used first
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value) -> None:
+        self.entries[key] = (time.time() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+
+class SingleFlight:
+    """Coalesce concurrent calls for the same key into one in-flight call."""
+
+    def __init__(self):
+        self.inflight = {}  # Key to the task doing the work
+        self.coalesced = 0
+
+    async def do(self, key, coroutine_factory: Callable):
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(coroutine_factory())
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+        # Shield the shared call so one cancelled caller does not cancel it for the others
+        return await asyncio.shield(task)
+
+
+class SearchCache:
+    """Cache search results by normalized query and coalesce identical in-flight searches."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.results = TTLCache(maxsize, ttl)
+        self.single_flight = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return " ".join(query.lower().split()).rstrip("?.! ")
+
+    def get(self, key):
+        results = self.results.get(key)
+        if results is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return results
+
+    def set(self, key, results) -> None:
+        # The Tavily tool reports failures as a string, only cache real result lists
+        if isinstance(results, list):
+            self.results.set(key, results)
+
+    async def search(self, key, coroutine_factory: Callable):
+        results = self.get(key)
+        if results is not None:
+            return results
+
+        async def search_and_store():
+            results = await coroutine_factory()
+            self.set(key, results)
+            return results
+
+        return await self.single_flight.do(key, search_and_store)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "coalesced": self.single_flight.coalesced,
+            "size": len(self.results.entries),
+        }
+
+
+search_cache = SearchCache(
+    maxsize=int(os.getenv("SYMPHONY_SEARCH_CACHE_SIZE", "512")),
+    ttl=float(os.getenv("SYMPHONY_SEARCH_CACHE_TTL", "3600")),
+)
+
+
+class CachedTavilySearchResults(TavilySearchResults):
+    """Tavily search that goes through the shared `search_cache`."""
+
+    def _cache_key(self, query: str) -> tuple:
+        return (SearchCache.normalize(query), self.max_results)
+
+    def _run(self, query: str, run_manager=None):
+        key = self._cache_key(query)
+        results = search_cache.get(key)
+        if results is None:
+            results = super()._run(query, run_manager)
+            search_cache.set(key, results)
+        return results
+
+    async def _arun(self, query: str, run_manager=None):
+        parent = super()
+        return await search_cache.search(self._cache_key(query), lambda: parent._arun(query, run_manager))
+
+
+class CachedPage(NamedTuple):
+    title: str
+    text: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    expires_at: float
+    size: int  # UTF-8 encoded length of the text, what the cache budget counts
+
+
+class PageFetcher:
+    """Fetch and parse web pages for `scrape_webpages`.
+
+    Pages are fetched concurrently over one pooled aiohttp session, concurrent
+    requests for the same URL share a single fetch, and parsed pages are kept
+    in a byte-bounded LRU cache. Expired entries are revalidated with
+    If-None-Match/If-Modified-Since so unchanged pages are not downloaded again.
+    """
+
+    def __init__(self, ttl: float, max_bytes: int, max_connections: int, timeout: float):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.pages = OrderedDict()  # URL to CachedPage, least recently used first
+        self.size = 0  # Bytes of page text held in the cache
+        self.single_flight = SingleFlight()
+        self.session = None
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+
+    def get_session(self) -> "aiohttp.ClientSession":
+        import aiohttp
+
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"User-Agent": SCRAPE_USER_AGENT},
+            )
+        return self.session
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+
+    async def fetch(self, url: str) -> CachedPage:
+        page = self.pages.get(url)
+        if page is not None and page.expires_at >= time.time():
+            self.pages.move_to_end(url)
+            self.hits += 1
+            return page
+        self.misses += 1
+        return await self.single_flight.do(url, lambda: self._fetch(url, page))
+
+    async def _fetch(self, url: str, stale: Optional[CachedPage]) -> CachedPage:
+        headers = {}
+        if stale is not None and stale.etag:
+            headers["If-None-Match"] = stale.etag
+        if stale is not None and stale.last_modified:
+            headers["If-Modified-Since"] = stale.last_modified
+        async with self.get_session().get(url, headers=headers) as response:
+            if response.status == 304 and stale is not None:
+                self.revalidated += 1
+                page = stale._replace(expires_at=time.time() + self.ttl)
+                self._store(url, page)
+                return page
+            response.raise_for_status()
+            html = await response.text()
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+        # Parsing is CPU-bound, keep it off the event loop
+        title, text = await tool_executor.run("scrape_webpages", parse_page, html)
+        page = CachedPage(title, text, etag, last_modified, time.time() + self.ttl, len(text.encode()))
+        self._store(url, page)
+        return page
+
+    def _store(self, url: str, page: CachedPage) -> None:
+        previous = self.pages.pop(url, None)
+        if previous is not None:
+            self.size -= previous.size
+        if page.size > self.max_bytes:
+            return
+        self.pages[url] = page
+        self.size += page.size
+        while self.size > self.max_bytes:
+            _, evicted = self.pages.popitem(last=False)
+            self.size -= evicted.size
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "revalidated": self.revalidated,
+            "coalesced": self.single_flight.coalesced,
+            "pages": len(self.pages),
+            "size_bytes": self.size,
+        }
+
+
+def parse_page(html: str) -> Tuple[str, str]:
+    """Extract the title and text of a page the same way WebBaseLoader does."""
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, "html.parser")
+    title = soup.find("title")
+    return (title.get_text() if title else ""), soup.get_text()
+
+
+SCRAPE_USER_AGENT = os.getenv(
+    "SYMPHONY_SCRAPE_USER_AGENT",
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36",
+)
+page_fetcher = PageFetcher(
+    ttl=float(os.getenv("SYMPHONY_SCRAPE_CACHE_TTL", "900")),
+    max_bytes=int(os.getenv("SYMPHONY_SCRAPE_CACHE_BYTES", str(64 * 1024 * 1024))),
+    max_connections=int(os.getenv("SYMPHONY_SCRAPE_MAX_CONNECTIONS", "20")),
+    timeout=float(os.getenv("SYMPHONY_SCRAPE_TIMEOUT", "20")),
+)
+
+
+async def scrape_page(url: str) -> str:
+    try:
+        page = await page_fetcher.fetch(url)
+    except Exception as e:
+        return f'<Document name="{url}">\nFailed to fetch {url}: {e}\n</Document>'
+    return f'<Document name="{page.title}">\n{page.text}\n</Document>'
 
 
 @tool
-def scrape_webpages(urls: List[str]) -> str:
+async def scrape_webpages(urls: List[str]) -> str:
     """Use requests and bs4 to scrape the provided web pages for detailed information."""
-    loader = WebBaseLoader(urls)
-    docs = loader.load()
-    return "\n\n".join(
-        [
-            f'<Document name="{doc.metadata.get("title", "")}">\n{doc.page_content}\n</Document>'
-            for doc in docs
-        ]
-    )
+    documents = await asyncio.gather(*(scrape_page(url) for url in dict.fromkeys(urls)))
+    return "\n\n".join(documents)
 
 from pathlib import Path
 from tempfile import TemporaryDirectory
 from typing import Dict, Optional
 
-from langchain_experimental.utilities import PythonREPL
 from typing_extensions import TypedDict
 
 _TEMP_DIRECTORY = TemporaryDirectory()
 WORKING_DIRECTORY = Path(_TEMP_DIRECTORY.name)
+COPY_CHUNK_BYTES = 1 << 20
+
+
+class WorkspaceError(Exception):
+    """Raised when a document tool call cannot be carried out, reported back to the agent."""
+
+
+def line_starts(buffer) -> array:
+    """Byte offsets at which the lines of `buffer` (bytes or an mmap) start."""
+    starts = array("q")
+    position, size = 0, len(buffer)
+    while position < size:
+        starts.append(position)
+        position = buffer.find(b"\n", position) + 1
+        if position == 0:
+            break
+    return starts
+
+
+def index_key(stat: os.stat_result) -> Tuple[int, int, int]:
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class LineIndex(NamedTuple):
+    key: Tuple[int, int, int]  # The file version the offsets belong to, see index_key
+    starts: array
+
+
+class DocumentWorkspace:
+    """The directory a run's document tools work in, with a line index per document.
+
+    Reads map the document and slice the requested lines out by their byte
+    offsets, so a window costs the same however long the document is. Writes
+    and edits go to a temporary file that replaces the document in one rename,
+    so readers never see half an edit. They are refused once the workspace
+    would grow past `quota_bytes`.
+    """
+
+    def __init__(self, path: Path, quota_bytes: int):
+        path.mkdir(parents=True, exist_ok=True)
+        self.path = path.resolve()
+        self.quota_bytes = quota_bytes
+        self.size = directory_size(self.path)
+        self.indexes = {}
+        self.lock = threading.Lock()  # Workers running in parallel share their run's workspace
+
+    def resolve(self, file_name: str) -> Path:
+        path = (self.path / file_name).resolve()
+        if path == self.path or not path.is_relative_to(self.path):
+            raise WorkspaceError(f"{file_name} is outside the workspace")
+        return path
+
+    def line_index(self, path: Path, buffer, stat: os.stat_result) -> array:
+        index = self.indexes.get(path)
+        if index is None or index.key != index_key(stat):
+            index = self.indexes[path] = LineIndex(index_key(stat), line_starts(buffer))
+        return index.starts
+
+    @contextlib.contextmanager
+    def mapped(self, file_name: str):
+        """Yield the document's path, a read-only map of it (or b"" when empty) and its line starts."""
+        path = self.resolve(file_name)
+        try:
+            file = path.open("rb")
+        except (FileNotFoundError, IsADirectoryError):
+            raise WorkspaceError(f"{file_name} does not exist")
+        with file:
+            stat = os.fstat(file.fileno())
+            if stat.st_size == 0:
+                yield path, b"", array("q")
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                yield path, buffer, self.line_index(path, buffer, stat)
+
+    def read(self, file_name: str, start: Optional[int] = None, end: Optional[int] = None) -> str:
+        with self.mapped(file_name) as (_, buffer, starts):
+            lines = range(len(starts))[start:end]
+            if not lines:
+                return ""
+            stop = starts[lines.stop] if lines.stop < len(starts) else len(buffer)
+            return buffer[starts[lines.start]:stop].decode("utf-8", errors="replace")
+
+    def write(self, file_name: str, content: str) -> None:
+        data = content.encode("utf-8")
+        with self.lock:
+            self.replace(self.resolve(file_name), [data], len(data), line_starts(data))
+
+    def insert(self, file_name: str, inserts: Dict[int, str]) -> None:
+        """Insert lines in one pass over the document.
+
+        Line numbers count the lines inserted before them, as if the inserts
+        were applied one by one in ascending order.
+        """
+        with self.lock, self.mapped(file_name) as (path, buffer, starts):
+            size = len(buffer)
+            # A document without a final newline gets the first insert at its end appended to its last line
+            unterminated = size > 0 and buffer[size - 1:size] != b"\n"
+            pieces, new_starts = [], array("q")
+            copied = shift = 0  # Lines copied so far, and how far inserts moved them
+            for order, (line_number, text) in enumerate(sorted(inserts.items())):
+                line = line_number - 1 - order
+                if line_number < 1 or line > len(starts):
+                    raise WorkspaceError(f"Line number {line_number} is out of range")
+                offset = starts[line] if line < len(starts) else size
+                pieces.append((starts[copied] if copied < len(starts) else size, offset))
+                new_starts.extend(start + shift for start in starts[copied:line])
+                data = (text + "\n").encode("utf-8")
+                inserted = line_starts(data)
+                if offset == size and unterminated:
+                    inserted, unterminated = inserted[1:], False
+                new_starts.extend(offset + shift + start for start in inserted)
+                pieces.append(data)
+                copied, shift = line, shift + len(data)
+            pieces.append((starts[copied] if copied < len(starts) else size, size))
+            new_starts.extend(start + shift for start in starts[copied:])
+
+            def chunks():
+                for piece in pieces:
+                    if isinstance(piece, bytes):
+                        yield piece
+                        continue
+                    for position in range(piece[0], piece[1], COPY_CHUNK_BYTES):
+                        yield buffer[position:min(position + COPY_CHUNK_BYTES, piece[1])]
+
+            self.replace(path, chunks(), size + shift, new_starts)
+
+    def replace(self, path: Path, chunks, new_size: int, starts: array) -> None:
+        """Write `chunks` to a temporary file and rename it over `path`, within the quota. Hold `lock`."""
+        old_size = path.stat().st_size if path.exists() else 0
+        if self.size - old_size + new_size > self.quota_bytes:
+            raise WorkspaceError(f"the workspace is limited to {self.quota_bytes} bytes")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        descriptor, temp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+        try:
+            with os.fdopen(descriptor, "wb") as temp:
+                for chunk in chunks:
+                    temp.write(chunk)
+            os.replace(temp_name, path)
+        except BaseException:
+            os.unlink(temp_name)
+            raise
+        self.size += new_size - old_size
+        self.indexes[path] = LineIndex(index_key(path.stat()), starts)
+
+
+def directory_size(path: Path) -> int:
+    return sum(entry.stat().st_size for entry in path.rglob("*") if entry.is_file())
+
+
+class WorkspaceManager:
+    """A document workspace per run, in directories under `root`.
+
+    A run's workspace is created by its first document tool call. When the run
+    ends its documents stay on disk until all workspaces together take more
+    than `total_quota_bytes`. Then those of ended runs are deleted, least
+    recently ended first.
+    """
+
+    def __init__(self, root: Path, quota_bytes: int, total_quota_bytes: int):
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.total_quota_bytes = total_quota_bytes
+        self.active = {}  # run id -> DocumentWorkspace
+        self.ended = OrderedDict()  # run id -> bytes on disk, least recently ended first
+        self.lock = threading.Lock()  # Workspaces are created from the tool threads
+        root.mkdir(parents=True, exist_ok=True)
+        # Workspaces left behind by an earlier process count as ended
+        for path in sorted(root.iterdir(), key=lambda path: path.stat().st_mtime):
+            if path.is_dir():
+                self.ended[path.name] = directory_size(path)
+
+    def get(self, run_id: str) -> DocumentWorkspace:
+        """Blocking the first time for a run, which creates and sizes its directory."""
+        with self.lock:
+            if run_id not in self.active:
+                self.ended.pop(run_id, None)
+                self.active[run_id] = DocumentWorkspace(self.root / run_id, self.quota_bytes)
+            return self.active[run_id]
+
+    def total_bytes(self) -> int:
+        return sum(workspace.size for workspace in self.active.values()) + sum(self.ended.values())
+
+    async def end_session(self, run_id: str) -> None:
+        with self.lock:
+            workspace = self.active.pop(run_id, None)
+            if workspace is None:
+                return
+            self.ended[run_id] = workspace.size
+            expired = []
+            while self.ended and self.total_bytes() > self.total_quota_bytes:
+                expired.append(self.root / self.ended.popitem(last=False)[0])
+        for path in expired:
+            await asyncio.to_thread(shutil.rmtree, path, True)
+
+    def stats(self) -> dict:
+        return {"active": len(self.active), "ended": len(self.ended), "size_bytes": self.total_bytes()}
+
+
+workspaces = WorkspaceManager(
+    root=Path(os.getenv("SYMPHONY_WORKSPACE_ROOT") or WORKING_DIRECTORY),
+    quota_bytes=int(os.getenv("SYMPHONY_WORKSPACE_QUOTA_BYTES", str(64 * 2**20))),
+    total_quota_bytes=int(os.getenv("SYMPHONY_WORKSPACE_TOTAL_BYTES", str(2**30))),
+)
+
+
+class ToolLimits(NamedTuple):
+    pool: str  # "thread" for I/O-bound tools, "process" for CPU-heavy ones
+    max_concurrency: int  # Calls of this tool allowed to run at once across all runs
+    timeout: float  # Seconds before a call is abandoned
+
+
+class ToolTimeout(Exception):
+    """Raised when a tool call runs past its timeout."""
+
+
+class ToolExecutor:
+    """Run blocking tool bodies off the event loop.
+
+    Each tool name maps to `ToolLimits`. Calls beyond a tool's concurrency limit
+    wait for a free slot, and a call that outlives its timeout raises
+    `ToolTimeout`. The worker pools are created on first use.
+    """
+
+    def __init__(self, limits: Dict[str, ToolLimits], default_limits: ToolLimits,
+                 thread_workers: int, process_workers: int):
+        self.limits = limits
+        self.default_limits = default_limits
+        self.thread_workers = thread_workers
+        self.process_workers = process_workers
+        self.pools = {}
+        self.semaphores = {}
+
+    def get_limits(self, tool_name: str) -> ToolLimits:
+        return self.limits.get(tool_name, self.default_limits)
+
+    def get_pool(self, kind: str) -> Executor:
+        if kind not in self.pools:
+            if kind == "process":
+                self.pools[kind] = ProcessPoolExecutor(max_workers=self.process_workers)
+            else:
+                self.pools[kind] = ThreadPoolExecutor(max_workers=self.thread_workers,
+                                                      thread_name_prefix="symphony-tool")
+        return self.pools[kind]
+
+    async def run(self, tool_name: str, func: Callable, *args, **kwargs):
+        limits = self.get_limits(tool_name)
+        semaphore = self.semaphores.setdefault(tool_name, asyncio.Semaphore(limits.max_concurrency))
+        queued_at = time.perf_counter()
+        async with semaphore:
+            tool_queue_seconds.observe(time.perf_counter() - queued_at, tool=tool_name)
+            future = asyncio.get_running_loop().run_in_executor(
+                self.get_pool(limits.pool), functools.partial(func, *args, **kwargs)
+            )
+            try:
+                return await asyncio.wait_for(future, limits.timeout)
+            except asyncio.TimeoutError:
+                raise ToolTimeout(f"{tool_name} timed out after {limits.timeout:g} seconds")
+
+    def shutdown(self) -> None:
+        for pool in self.pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+        self.pools.clear()
+
+
+def load_tool_limits() -> Dict[str, ToolLimits]:
+    limits = {
+        "scrape_webpages": ToolLimits(pool="thread", max_concurrency=8, timeout=30.0),
+        "create_outline": ToolLimits(pool="thread", max_concurrency=8, timeout=10.0),
+        "read_document": ToolLimits(pool="thread", max_concurrency=8, timeout=10.0),
+        "write_document": ToolLimits(pool="thread", max_concurrency=8, timeout=10.0),
+        "edit_document": ToolLimits(pool="thread", max_concurrency=8, timeout=10.0),
+    }
+    # SYMPHONY_TOOL_LIMITS overrides individual fields, e.g. {"read_document": {"timeout": 30}}
+    overrides = json.loads(os.getenv("SYMPHONY_TOOL_LIMITS", "{}"))
+    for tool_name, fields in overrides.items():
+        limits[tool_name] = limits.get(tool_name, DEFAULT_TOOL_LIMITS)._replace(**fields)
+    return limits
+
+
+DEFAULT_TOOL_LIMITS = ToolLimits(pool="thread", max_concurrency=4, timeout=30.0)
+tool_executor = ToolExecutor(
+    limits=load_tool_limits(),
+    default_limits=DEFAULT_TOOL_LIMITS,
+    thread_workers=int(os.getenv("SYMPHONY_TOOL_THREADS", "16")),
+    process_workers=int(os.getenv("SYMPHONY_TOOL_PROCESSES", "2")),
+)
+
+
+def run_in_tool_executor(func):
+    """Turn a blocking tool body into a coroutine that runs on the tool executor."""
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await tool_executor.run(func.__name__, func, *args, **kwargs)
+        except ToolTimeout as e:
+            return f"Error: {e}."
+
+    return wrapper
+
+
+def run_in_workspace(func):
+    """Like `run_in_tool_executor`, for document tool bodies that take the calling run's workspace first."""
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        run = current_run.get(None)
+        run_id = run.run_id if run else "default"
+
+        def call():
+            # Getting the workspace may create it, which touches the disk too
+            return func(workspaces.get(run_id), *args, **kwargs)
+
+        try:
+            return await tool_executor.run(func.__name__, call)
+        except (ToolTimeout, WorkspaceError) as e:
+            return f"Error: {e}."
+
+    # The tool schema is read from the signature, which must not offer the workspace to the model
+    signature = inspect.signature(func)
+    wrapper.__signature__ = signature.replace(parameters=list(signature.parameters.values())[1:])
+    return wrapper
 
 
 @tool
+@run_in_workspace
 def create_outline(
+    workspace: DocumentWorkspace,
     points: Annotated[List[str], "List of main points or sections."],
     file_name: Annotated[str, "File path to save the outline."],
 ) -> Annotated[str, "Path of the saved outline file."]:
     """Create and save an outline."""
-    with (WORKING_DIRECTORY / file_name).open("w") as file:
-        for i, point in enumerate(points):
-            file.write(f"{i + 1}. {point}\n")
+    workspace.write(file_name, "".join(f"{i + 1}. {point}\n" for i, point in enumerate(points)))
     return f"Outline saved to {file_name}"
 
 
 @tool
+@run_in_workspace
 def read_document(
-    file_name: Annotated[str, "File path to save the document."],
+    workspace: DocumentWorkspace,
+    file_name: Annotated[str, "File path to read the document from."],
     start: Annotated[Optional[int], "The start line. Default is 0"] = None,
     end: Annotated[Optional[int], "The end line. Default is None"] = None,
 ) -> str:
     """Read the specified document."""
-    with (WORKING_DIRECTORY / file_name).open("r") as file:
-        lines = file.readlines()
-    if start is not None:
-        start = 0
-    return "\n".join(lines[start:end])
+    return workspace.read(file_name, start, end)
 
 
 @tool
+@run_in_workspace
 def write_document(
+    workspace: DocumentWorkspace,
     content: Annotated[str, "Text content to be written into the document."],
     file_name: Annotated[str, "File path to save the document."],
 ) -> Annotated[str, "Path of the saved document file."]:
     """Create and save a text document."""
-    with (WORKING_DIRECTORY / file_name).open("w") as file:
-        file.write(content)
+    workspace.write(file_name, content)
     return f"Document saved to {file_name}"
 
 
 @tool
+@run_in_workspace
 def edit_document(
+    workspace: DocumentWorkspace,
     file_name: Annotated[str, "Path of the document to be edited."],
     inserts: Annotated[
         Dict[int, str],
@@ -112,52 +960,435 @@ def edit_document(
     ],
 ) -> Annotated[str, "Path of the edited document file."]:
     """Edit a document by inserting text at specific line numbers."""
-
-    with (WORKING_DIRECTORY / file_name).open("r") as file:
-        lines = file.readlines()
-
-    sorted_inserts = sorted(inserts.items())
-
-    for line_number, text in sorted_inserts:
-        if 1 <= line_number <= len(lines) + 1:
-            lines.insert(line_number - 1, text + "\n")
-        else:
-            return f"Error: Line number {line_number} is out of range."
-
-    with (WORKING_DIRECTORY / file_name).open("w") as file:
-        file.writelines(lines)
-
+    workspace.insert(file_name, inserts)
     return f"Document edited and saved to {file_name}"
 
 
-# Warning: This executes code locally, which can be unsafe when not sandboxed
-
-repl = PythonREPL()
+# Warning: This executes code locally, which can be unsafe when not sandboxed.
+# Each worker is a separate process with a memory cap, and every run gets its
+# own namespace, but the code still has the server's filesystem and network access.
+# The worker side lives in symphony_repl.
+
+class ReplTimeout(Exception):
+    """Raised when REPL code runs past its wall-clock limit."""
+
+
+class ReplWorker:
+    """Parent-side handle on one REPL worker process."""
+
+    def __init__(self, memory_limit: Optional[int]):
+        self.memory_limit = memory_limit
+        parent_socket, child_socket = socket.socketpair()
+        # Started as a module rather than through multiprocessing, which would
+        # import the server's __main__ module again in every worker
+        env = {**os.environ, "PYTHONPATH": os.pathsep.join(
+            filter(None, [os.path.dirname(os.path.abspath(symphony_repl.__file__)), os.getenv("PYTHONPATH")]))}
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "symphony_repl", str(child_socket.fileno()), str(memory_limit or 0)],
+            pass_fds=[child_socket.fileno()], stdin=subprocess.DEVNULL, env=env,
+        )
+        child_socket.close()
+        self.conn = Connection(parent_socket.detach())
+        self.lock = asyncio.Lock()  # One call at a time per worker
+        self.sessions = set()
+
+    def execute(self, session_id: str, code: str, timeout: float) -> str:
+        """Blocking call, run it from a thread."""
+        self.conn.send((session_id, code))
+        if not self.conn.poll(timeout):
+            raise ReplTimeout(f"Execution timed out after {timeout:g} seconds")
+        return self.conn.recv()
+
+    def end_session(self, session_id: str) -> None:
+        self.sessions.discard(session_id)
+        if self.process.poll() is None:
+            self.conn.send((session_id, None))
+
+    def kill(self) -> None:
+        self.process.kill()
+        self.process.wait()
+        self.conn.close()
+
+
+class ReplWorkerPool:
+    """Pool of isolated REPL processes for `python_repl`, started ahead of the first call.
+
+    Workers are separate interpreters that import only what they need, so the
+    memory cap counts a worker's own memory and not the API's. Calls from the same run always go to the same worker, so variables persist
+    between a run's calls but are never visible to other runs. A worker that
+    overruns its wall-clock limit, hits its memory cap or dies is killed and
+    replaced, and the sessions it held start over.
+    """
+
+    def __init__(self, size: int, timeout: float, memory_limit: Optional[int]):
+        self.size = size
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.workers = []
+        self.affinity = {}  # Session ID to the worker holding its namespace
+        self.respawns = 0
+        self.starting = threading.Lock()  # The startup hook fills the pool from a thread
+
+    def start(self) -> None:
+        with self.starting:
+            while len(self.workers) < self.size:
+                self.workers.append(ReplWorker(self.memory_limit))
+
+    def get_worker(self, session_id: str) -> ReplWorker:
+        worker = self.affinity.get(session_id)
+        if worker is None:
+            self.start()
+            worker = min(self.workers, key=lambda w: len(w.sessions))
+            worker.sessions.add(session_id)
+            self.affinity[session_id] = worker
+        return worker
+
+    def respawn(self, worker: ReplWorker) -> None:
+        worker.kill()
+        for session_id in worker.sessions:
+            self.affinity.pop(session_id, None)
+        self.workers[self.workers.index(worker)] = ReplWorker(self.memory_limit)
+        self.respawns += 1
+
+    async def run(self, session_id: str, code: str) -> str:
+        worker = self.get_worker(session_id)
+        queued_at = time.perf_counter()
+        async with worker.lock:
+            tool_queue_seconds.observe(time.perf_counter() - queued_at, tool="python_repl")
+            if worker not in self.workers:
+                # Replaced while we waited, the session has to start over
+                return await self.run(session_id, code)
+            execution = asyncio.ensure_future(asyncio.to_thread(worker.execute, session_id, code, self.timeout))
+            try:
+                result = await asyncio.shield(execution)
+            except asyncio.CancelledError:
+                # The thread is still waiting on the worker's pipe and would hand this
+                # result to the next session. Kill the worker and keep the lock until
+                # the thread has given up on it
+                worker.process.kill()
+                try:
+                    with contextlib.suppress(Exception):
+                        await execution
+                finally:
+                    self.respawn(worker)
+                raise
+            except ReplTimeout:
+                self.respawn(worker)
+                raise
+            except (EOFError, OSError):
+                self.respawn(worker)
+                raise RuntimeError("REPL worker crashed, possibly by exceeding its memory limit")
+            if result.startswith("MemoryError("):
+                # The namespace may still hold the memory, start from a clean process
+                self.respawn(worker)
+            return result
+
+    async def end_session(self, session_id: str) -> None:
+        worker = self.affinity.pop(session_id, None)
+        if worker is None:
+            return
+        async with worker.lock:
+            if worker in self.workers:
+                worker.end_session(session_id)
+
+    def shutdown(self) -> None:
+        for worker in self.workers:
+            worker.kill()
+        self.workers.clear()
+        self.affinity.clear()
+
+
+repl_pool = ReplWorkerPool(
+    size=int(os.getenv("SYMPHONY_REPL_WORKERS", "2")),
+    timeout=float(os.getenv("SYMPHONY_REPL_TIMEOUT", "60")),
+    memory_limit=int(os.getenv("SYMPHONY_REPL_MEMORY_MB", "1024")) * 1024 * 1024 or None,
+)
 
 
 @tool
-def python_repl(
+async def python_repl(
     code: Annotated[str, "The python code to execute to generate your chart."]
 ):
     """Use this to execute python code. If you want to see the output of a value,
     you should print it out with `print(...)`. This is visible to the user."""
+    run = current_run.get(None)
     try:
-        result = repl.run(code)
-    except BaseException as e:
+        result = await repl_pool.run(run.run_id if run else "default", code)
+    except Exception as e:
         return f"Failed to execute. Error: {repr(e)}"
     return f"Succesfully executed:\n```python\n{code}\n```\nStdout: {result}"
 
+# response caching
+class ResponseCache:
+    """Base class for LLM response caches, counting hits and misses."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    async def aget(self, key: str) -> Optional[BaseMessage]:
+        value = await self._aget(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def aset(self, key: str, value: BaseMessage) -> None:
+        await self._aset(key, value)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class MemoryResponseCache(ResponseCache):
+    """In-process LRU cache with a TTL."""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 600.0):
+        super().__init__()
+        self.entries = TTLCache(maxsize, ttl)
+
+    async def _aget(self, key):
+        return self.entries.get(key)
+
+    async def _aset(self, key, value):
+        self.entries.set(key, value)
+
+    def stats(self) -> dict:
+        return {**super().stats(), "size": len(self.entries.entries)}
+
+
+class SQLiteResponseCache(ResponseCache):
+    """On-disk cache that survives restarts and can be shared by workers on one machine."""
+
+    def __init__(self, path: str = "llm_cache.db", ttl: float = 600.0):
+        super().__init__()
+        self.path = path
+        self.ttl = ttl
+        with sqlite3.connect(self.path) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)"
+            )
+
+    def _get(self, key):
+        with sqlite3.connect(self.path) as conn:
+            row = conn.execute(
+                "SELECT value FROM responses WHERE key = ? AND expires_at >= ?", (key, time.time())
+            ).fetchone()
+        return loads(row[0]) if row else None
+
+    def _set(self, key, value):
+        with sqlite3.connect(self.path) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, dumps(value), time.time() + self.ttl),
+            )
+            conn.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+
+    async def _aget(self, key):
+        return await asyncio.to_thread(self._get, key)
+
+    async def _aset(self, key, value):
+        await asyncio.to_thread(self._set, key, value)
+
+
+def response_cache_key(llm: Runnable, messages: List[BaseMessage]) -> str:
+    """Hash the normalized prompt together with the model and function schema.
+
+    Whitespace differences in message content do not change the key, so
+    near-identical prompts share an entry.
+    """
+    bound_kwargs = getattr(llm, "kwargs", {})
+    model = getattr(getattr(llm, "bound", llm), "model_name", "")
+    normalized = [
+        {
+            "type": message.type,
+            "name": getattr(message, "name", None),
+            "content": " ".join(str(message.content).split()),
+            "function_call": message.additional_kwargs.get("function_call"),
+        }
+        for message in messages
+    ]
+    payload = json.dumps(
+        {"model": model, "messages": normalized, "bound": bound_kwargs}, sort_keys=True, default=str
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class CachedLLM(Runnable):
+    """Serve repeated prompts to a (function-bound) chat model from a response cache."""
+
+    def __init__(self, llm: Runnable, cache: ResponseCache):
+        self.llm = llm
+        self.cache = cache
+
+    def invoke(self, input, config=None, **kwargs):
+        return self.llm.invoke(input, config, **kwargs)
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        key = response_cache_key(self.llm, input.to_messages())
+        cached = await self.cache.aget(key)
+        llm_cache_requests.inc(result="miss" if cached is None else "hit")
+        if cached is not None:
+            if tracer is not None:
+                otel_trace.get_current_span().add_event("llm_cache_hit")
+            return cached
+        result = await self.llm.ainvoke(input, config, **kwargs)
+        await self.cache.aset(key, result)
+        return result
+
+
+def build_response_cache() -> Optional[ResponseCache]:
+    backend = os.getenv("SYMPHONY_LLM_CACHE", "memory").lower()
+    ttl = float(os.getenv("SYMPHONY_LLM_CACHE_TTL", "600"))
+    if backend == "memory":
+        return MemoryResponseCache(maxsize=int(os.getenv("SYMPHONY_LLM_CACHE_SIZE", "1024")), ttl=ttl)
+    if backend == "sqlite":
+        return SQLiteResponseCache(path=os.getenv("SYMPHONY_LLM_CACHE_PATH", "llm_cache.db"), ttl=ttl)
+    return None
+
+
+response_cache = build_response_cache()
+
+
+def with_response_cache(llm: Runnable) -> Runnable:
+    return CachedLLM(llm, response_cache) if response_cache is not None else llm
+
+
+# message history
+DOCUMENT_PATTERN = re.compile(r"(<Document[^>]*>\n?)(.*?)(\n?</Document>)", re.DOTALL)
+
+
+class HistoryCompactor:
+    """Fit the messages of a model call into a token budget.
+
+    System messages, the user's request and the last `keep_recent` other
+    messages are sent verbatim. In older messages, each `<Document>` from
+    `scrape_webpages` is cut to `document_chars`. If the call is still over
+    `max_tokens`, older messages are cut to `message_chars` and then, oldest
+    first, replaced by a stub naming their author. Every message keeps its
+    place and name, so the supervisor still sees who has acted and routes the
+    same way. Only as a last resort are the recent messages shortened too.
+    """
+
+    def __init__(self, max_tokens: int, keep_recent: int, document_chars: int, message_chars: int):
+        self.max_tokens = max_tokens
+        self.keep_recent = keep_recent
+        self.document_chars = document_chars
+        self.message_chars = message_chars
+
+    @staticmethod
+    def count_tokens(message: BaseMessage) -> int:
+        # About four characters per token for English text, plus the per-message overhead
+        return len(str(message.content)) // 4 + 4
+
+    def truncate_documents(self, content: str) -> str:
+        def cut(match):
+            body = match.group(2)
+            if len(body) <= self.document_chars:
+                return match.group(0)
+            return match.group(1) + self.truncate(body, self.document_chars) + match.group(3)
+
+        return DOCUMENT_PATTERN.sub(cut, content)
+
+    @staticmethod
+    def truncate(content: str, limit: int) -> str:
+        if len(content) <= limit:
+            return content
+        return f"{content[:limit]}\n[... {len(content) - limit} characters truncated]"
+
+    def compact(self, messages: List[BaseMessage]) -> List[BaseMessage]:
+        messages = list(messages)
+        sizes = [self.count_tokens(message) for message in messages]
+        original_total = total = sum(sizes)
+        pinned = {index for index, message in enumerate(messages) if message.type == "system"}
+        pinned.update(itertools.islice((i for i, m in enumerate(messages) if m.type == "human"), 1))
+        movable = [index for index in range(len(messages)) if index not in pinned]
+        split = max(0, len(movable) - self.keep_recent)
+        older, recent = movable[:split], movable[split:]
+
+        def shorten(index: int, shortener: Callable[[BaseMessage], str]) -> None:
+            nonlocal total
+            if not isinstance(messages[index].content, str):
+                return
+            content = shortener(messages[index])
+            if content != messages[index].content:
+                messages[index] = messages[index].copy(update={"content": content})
+                total += self.count_tokens(messages[index]) - sizes[index]
+                sizes[index] = self.count_tokens(messages[index])
+
+        # Old scraped pages are cut whatever the budget, agents rarely need them again in full
+        stage = "documents"
+        for index in older:
+            shorten(index, lambda message: self.truncate_documents(message.content))
+        stages = [
+            ("messages", older, lambda message: self.truncate(message.content, self.message_chars)),
+            ("stubs", older, lambda message: f"[Earlier output from {message.name or message.type} omitted]"),
+            ("recent_documents", recent, lambda message: self.truncate_documents(message.content)),
+            ("recent_messages", recent, lambda message: self.truncate(message.content, self.message_chars)),
+        ]
+        for stage_name, indexes, shortener in stages:
+            if total <= self.max_tokens:
+                break
+            stage = stage_name
+            for index in indexes:
+                if total <= self.max_tokens:
+                    break
+                shorten(index, shortener)
+
+        if total < original_total:
+            history_compactions.inc(stage=stage)
+            history_tokens_saved.inc(original_total - total)
+        return messages
+
+    def compact_prompt(self, prompt_value: ChatPromptValue) -> ChatPromptValue:
+        return ChatPromptValue(messages=self.compact(prompt_value.to_messages()))
+
+
+def build_history_compactor() -> Optional[HistoryCompactor]:
+    max_tokens = int(os.getenv("SYMPHONY_HISTORY_MAX_TOKENS", "16000"))
+    if max_tokens <= 0:
+        return None
+    return HistoryCompactor(
+        max_tokens=max_tokens,
+        keep_recent=int(os.getenv("SYMPHONY_HISTORY_KEEP_RECENT", "4")),
+        document_chars=int(os.getenv("SYMPHONY_HISTORY_DOCUMENT_CHARS", "2000")),
+        message_chars=int(os.getenv("SYMPHONY_HISTORY_MESSAGE_CHARS", "4000")),
+    )
+
+
+history_compactor = build_history_compactor()
+
+
+def with_history_compaction(prompt: Runnable) -> Runnable:
+    return prompt | RunnableLambda(history_compactor.compact_prompt) if history_compactor is not None else prompt
+
+
 # team orchestration functions
 def create_agent(
-    llm: ChatOpenAI,
+    llm: "ChatOpenAI",
     tools: list,
     system_prompt: str,
 ) -> str:
     """Create a function-calling agent and add it to the graph."""
+    # The agent machinery is slow to import and only needed once a team is built
+    from langchain.agents import AgentExecutor
+    from langchain.agents.format_scratchpad.openai_functions import format_to_openai_function_messages
+    from langchain.agents.output_parsers.openai_functions import OpenAIFunctionsAgentOutputParser
+
     system_prompt += "\nWork autonomously according to your specialty, using the tools available to you."
     " Do not ask for clarification."
     " Your other team members (and other teams) will collaborate with you with their own specialties."
     " You are chosen for a reason! You are one of the following team members: {team_members}."
+    # Lets the supervisor's final_answer rule end the run without another model call
+    system_prompt += ("\nIf your answer completes the whole request and no other team member needs to act,"
+                      f" begin it with {FINAL_ANSWER_MARKER}.")
     prompt = ChatPromptTemplate.from_messages(
         [
             (
@@ -168,28 +1399,1023 @@ def create_agent(
             MessagesPlaceholder(variable_name="agent_scratchpad"),
         ]
     )
-    agent = create_openai_functions_agent(llm, tools, prompt)
+    # Same pipeline as create_openai_functions_agent, with the history compacted
+    # and the model call behind the response cache
+    llm_with_tools = llm.bind(functions=[convert_to_openai_function(t) for t in tools])
+    agent = (
+        RunnablePassthrough.assign(
+            agent_scratchpad=lambda x: format_to_openai_function_messages(x["intermediate_steps"])
+        )
+        | with_history_compaction(prompt)
+        | with_response_cache(llm_with_tools)
+        | OpenAIFunctionsAgentOutputParser()
+    )
     executor = AgentExecutor(agent=agent, tools=tools)
     return executor
 
 app = FastAPI()
 
 
-agent_times = {}  # Define agent_times as a global variable
-agent_start_times = {}  # Store the start time of each agent's execution
-agent_completed = {}  # Track the completion status of each agent
-agent_call_counts = {}  # Store the number of times each agent has been invoked
-agent_call_sequence = []  # Store the sequence of agent invocations
-stop_event = asyncio.Event()  # Create an event to signal when to stop
-task_active = False  # Flag to indicate if a task is currently active
-last_task_messages = []  # Store the agent messages from the last executed task
-human_feedback_needed = {}
+# shared state
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"  # Identifies this process to the other workers
+MAX_SHARED_RUNS = 1000  # Runs kept in the shared run index
+WORKER_HEARTBEAT_INTERVAL = 10.0  # Seconds between a worker's heartbeats, it counts as gone after three missed
+
+
+class StateBackend(abc.ABC):
+    """How the worker processes serving the API share runs, events and signals.
+
+    A run executes on the worker that accepted it, which keeps its live state in
+    `runs`. The backend lets every other worker serve the run as well. The owner
+    saves snapshots of its changed runs and relays every status and token event.
+    A worker asked to resolve feedback for, or cancel, a run it does not own
+    sends the owner a signal. Messages are dicts whose `channel` is `status`,
+    `tokens` or `signal`. Runs stay with their owner while `is_live` says it is
+    running, after that another worker may take them over from the run store.
+    """
+
+    shared = False  # Whether other workers see what goes through the backend
+
+    @abc.abstractmethod
+    async def start(self, receive: Callable[[dict], None]) -> None:
+        """Start handing the messages other workers publish to `receive`."""
+
+    @abc.abstractmethod
+    def publish(self, message: dict) -> None:
+        """Send a message to the other workers without waiting."""
+
+    @abc.abstractmethod
+    async def save_runs(self, snapshots: List[dict]) -> None:
+        """Save snapshots of runs this worker executes, for the others to read."""
+
+    @abc.abstractmethod
+    def save_run_soon(self, snapshot: dict) -> None:
+        """Save a snapshot without waiting, before any message published after it."""
+
+    @abc.abstractmethod
+    async def load_run(self, run_id: str) -> Optional[dict]:
+        """The latest snapshot of a run, or None if no worker shared it."""
+
+    @abc.abstractmethod
+    async def list_runs(self, limit: int) -> List[dict]:
+        """Snapshots of the most recently created runs, newest first."""
+
+    @abc.abstractmethod
+    async def latest_run_id(self) -> Optional[str]:
+        """The most recently created run on any worker."""
+
+    @abc.abstractmethod
+    async def is_live(self, worker_id: str) -> bool:
+        """Whether the worker with this ID is still running."""
+
+    @abc.abstractmethod
+    async def close(self) -> None:
+        """Stop sharing and release the connection."""
+
+
+class LocalStateBackend(StateBackend):
+    """A single worker process, which has nothing to share."""
+
+    async def start(self, receive: Callable[[dict], None]) -> None:
+        pass
+
+    def publish(self, message: dict) -> None:
+        pass
+
+    async def save_runs(self, snapshots: List[dict]) -> None:
+        pass
+
+    def save_run_soon(self, snapshot: dict) -> None:
+        pass
+
+    async def load_run(self, run_id: str) -> Optional[dict]:
+        return None
+
+    async def list_runs(self, limit: int) -> List[dict]:
+        return []
+
+    async def latest_run_id(self) -> Optional[str]:
+        return None
+
+    async def is_live(self, worker_id: str) -> bool:
+        # Only workers on this host can share the run store, tell them apart by process
+        host, _, pid = worker_id.rpartition(":")
+        if host != socket.gethostname() or not pid.isdigit():
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass  # Running, as another user
+        return True
+
+    async def close(self) -> None:
+        pass
+
+
+class RedisStateBackend(StateBackend):
+    """Share state through Redis, or any server speaking its protocol.
+
+    Snapshots are JSON strings that expire `ttl` seconds after their last save,
+    indexed by creation time in a sorted set. Messages go over one pub/sub
+    channel, and each worker skips its own. Publishing only queues a message for
+    a writer task, so the run loop never waits on Redis. The writer keeps the
+    order of the queue, so a final snapshot queued before a run's `end` event is
+    saved by the time other workers see the event. When Redis cannot keep up,
+    messages beyond `max_pending` are dropped and counted. Each worker refreshes
+    a heartbeat key that expires when it stops.
+    """
+
+    shared = True
+
+    def __init__(self, url: str, prefix: str, ttl: float, max_pending: int = 10000, worker_id: str = WORKER_ID):
+        try:
+            import redis.asyncio as aioredis
+        except ImportError:  # Only needed for SYMPHONY_STATE_BACKEND=redis
+            raise RuntimeError("SYMPHONY_STATE_BACKEND=redis needs the redis package") from None
+        self.redis = aioredis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self.ttl = ttl
+        self.worker_id = worker_id  # Origin of this worker's messages, and the key of its heartbeat
+        self.channel = f"{prefix}:events"
+        self.outbox = asyncio.Queue(maxsize=max_pending)
+        self.tasks = []
+
+    async def start(self, receive: Callable[[dict], None]) -> None:
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(self.channel)
+        await self.beat()
+        self.tasks = [asyncio.ensure_future(self.write()), asyncio.ensure_future(self.listen(pubsub, receive)),
+                      asyncio.ensure_future(self.keep_alive())]
+
+    def worker_key(self, worker_id: str) -> str:
+        return f"{self.prefix}:worker:{worker_id}"
+
+    async def beat(self) -> None:
+        await self.redis.set(self.worker_key(self.worker_id), 1, ex=int(3 * WORKER_HEARTBEAT_INTERVAL))
+
+    async def keep_alive(self) -> None:
+        from redis.exceptions import RedisError
+
+        while True:
+            await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL)
+            try:
+                await self.beat()
+            except RedisError as e:
+                print(f"Could not send a heartbeat: {e!r}")
+
+    def publish(self, message: dict) -> None:
+        try:
+            self.outbox.put_nowait((None, json.dumps({**message, "origin": self.worker_id}, default=str)))
+        except asyncio.QueueFull:
+            shared_messages_dropped.inc()
+
+    def save_run_soon(self, snapshot: dict) -> None:
+        try:
+            self.outbox.put_nowait((snapshot, None))
+        except asyncio.QueueFull:
+            pass  # The next sync saves it
+
+    async def write(self) -> None:
+        from redis.exceptions import RedisError
+
+        while True:
+            messages = [await self.outbox.get()]
+            while not self.outbox.empty():
+                messages.append(self.outbox.get_nowait())
+            try:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for snapshot, message in messages:
+                        if snapshot is not None:
+                            self.stage_snapshot(pipe, snapshot)
+                        else:
+                            pipe.publish(self.channel, message)
+                    await pipe.execute()
+            except RedisError as e:
+                print(f"Could not publish {len(messages)} messages: {e!r}")
+                shared_messages_dropped.inc(len(messages))
+                await asyncio.sleep(1.0)
+
+    async def listen(self, pubsub, receive: Callable[[dict], None]) -> None:
+        from redis.exceptions import ConnectionError as RedisConnectionError
+
+        while True:
+            try:
+                async for item in pubsub.listen():
+                    message = json.loads(item["data"])
+                    if message.pop("origin") == self.worker_id:
+                        continue
+                    try:
+                        receive(message)
+                    except Exception as e:
+                        print(f"Could not handle {message.get('channel')} message: {e!r}")
+            except RedisConnectionError as e:
+                # The pub/sub connection subscribes again when it reconnects
+                print(f"Lost the shared event channel: {e!r}")
+                await asyncio.sleep(1.0)
+
+    def run_key(self, run_id: str) -> str:
+        return f"{self.prefix}:run:{run_id}"
+
+    def stage_snapshot(self, pipe, snapshot: dict) -> None:
+        pipe.set(self.run_key(snapshot["run_id"]), json.dumps(snapshot, default=str), ex=int(self.ttl))
+        pipe.zadd(f"{self.prefix}:runs", {snapshot["run_id"]: snapshot["created_at"]})
+        pipe.zremrangebyrank(f"{self.prefix}:runs", 0, -MAX_SHARED_RUNS - 1)
+
+    async def save_runs(self, snapshots: List[dict]) -> None:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for snapshot in snapshots:
+                self.stage_snapshot(pipe, snapshot)
+            await pipe.execute()
+
+    async def load_run(self, run_id: str) -> Optional[dict]:
+        snapshot = await self.redis.get(self.run_key(run_id))
+        return json.loads(snapshot) if snapshot is not None else None
+
+    async def list_runs(self, limit: int) -> List[dict]:
+        run_ids = await self.redis.zrevrange(f"{self.prefix}:runs", 0, limit - 1)
+        if not run_ids:
+            return []
+        # Index entries outlive the snapshots that expired
+        return [json.loads(snapshot) for snapshot in await self.redis.mget([self.run_key(run_id) for run_id in run_ids])
+                if snapshot is not None]
+
+    async def latest_run_id(self) -> Optional[str]:
+        run_ids = await self.redis.zrevrange(f"{self.prefix}:runs", 0, 0)
+        return run_ids[0] if run_ids else None
+
+    async def is_live(self, worker_id: str) -> bool:
+        return bool(await self.redis.exists(self.worker_key(worker_id)))
+
+    async def close(self) -> None:
+        from redis.exceptions import RedisError
+
+        for task in self.tasks:
+            task.cancel()
+        with contextlib.suppress(RedisError):
+            # Let the other workers take over this worker's runs without waiting for the heartbeat to expire
+            await self.redis.delete(self.worker_key(self.worker_id))
+        await self.redis.aclose()
+
+
+def build_state_backend() -> StateBackend:
+    backend = os.getenv("SYMPHONY_STATE_BACKEND", "local").lower()
+    if backend == "redis":
+        return RedisStateBackend(
+            url=os.getenv("SYMPHONY_REDIS_URL", "redis://localhost:6379/0"),
+            prefix=os.getenv("SYMPHONY_REDIS_PREFIX", "symphony"),
+            ttl=float(os.getenv("SYMPHONY_STATE_TTL", "86400")),
+        )
+    return LocalStateBackend()
+
+
+state_backend = build_state_backend()
+STATE_SYNC_INTERVAL = float(os.getenv("SYMPHONY_STATE_SYNC_INTERVAL", "0.25"))  # Seconds between snapshot saves
+
+
+class StatusBroadcaster:
+    """Fan out agent status deltas to every connected dashboard.
+
+    Each subscriber gets its own bounded queue. When a client falls behind, the
+    oldest pending event is dropped so a slow reader never holds up the run.
+    Subscribers can follow a single run or, with no run ID, every run. Events
+    are also relayed to the other workers through `state_backend`.
+    """
+
+    def __init__(self, max_queue_size: int = 256):
+        self.max_queue_size = max_queue_size
+        self.subscribers = {}  # Map each subscriber queue to the run ID it follows
+
+    def subscribe(self, run_id: Optional[str] = None) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self.subscribers[queue] = run_id
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self.subscribers.pop(queue, None)
+
+    def publish(self, event_type: str, run_id: Optional[str] = None, **payload) -> None:
+        event = {"type": event_type, "run_id": run_id, "timestamp": time.time(), **payload}
+        self.deliver(event)
+        state_backend.publish({"channel": "status", **event})
+
+    def deliver(self, event: dict) -> None:
+        for queue, followed_run in list(self.subscribers.items()):
+            if followed_run is not None and followed_run != event["run_id"]:
+                continue
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+
+status_broadcaster = StatusBroadcaster()
+
+
+class TokenBroadcaster:
+    """Fan out a run's model tokens and tool calls to streaming clients.
+
+    Tokens only make sense in order, so unlike `StatusBroadcaster` no event is
+    skipped. A client whose bounded queue fills up is dropped instead: its
+    stream ends with a `dropped` event, and the server stops buffering for it.
+    Each queue keeps one slot free for that final event.
+    """
+
+    def __init__(self, max_queue_size: int):
+        self.max_queue_size = max_queue_size
+        self.subscribers = {}  # Run ID to the queues following it
+
+    def subscribe(self, run_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.max_queue_size + 1)
+        self.subscribers.setdefault(run_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, run_id: str, queue: asyncio.Queue) -> None:
+        queues = self.subscribers.get(run_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[run_id]
+
+    def publish(self, event_type: str, run_id: str, **payload) -> None:
+        event = {"type": event_type, "run_id": run_id, "timestamp": time.time(), **payload}
+        self.deliver(event)
+        state_backend.publish({"channel": "tokens", **event})
+
+    def deliver(self, event: dict) -> None:
+        run_id = event["run_id"]
+        if event["type"] == "end":
+            for queue in self.subscribers.pop(run_id, ()):
+                queue.put_nowait(event)
+            return
+        for queue in list(self.subscribers.get(run_id, ())):
+            if queue.qsize() < self.max_queue_size:
+                queue.put_nowait(event)
+                continue
+            self.unsubscribe(run_id, queue)
+            token_stream_drops.inc()
+            queue.put_nowait({"type": "dropped", "run_id": run_id, "timestamp": time.time()})
+
+    def close(self, run_id: str, status: str) -> None:
+        """End every stream following a run that stopped running."""
+        self.publish("end", run_id, status=status)
+
+
+token_broadcaster = TokenBroadcaster(max_queue_size=int(os.getenv("SYMPHONY_TOKEN_STREAM_BUFFER", "512")))
+TOKEN_STREAM_DEFAULT = os.getenv("SYMPHONY_STREAM_TOKENS", "false").lower() in ("1", "true", "yes")
+STATUS_STREAM_KEEPALIVE = 15.0  # Seconds between SSE keep-alive comments
+
+
+class AgentGraph:
+    """The dashboard's node list, indexed by agent label and versioned.
+
+    Every change bumps `version` and is recorded in a change log, so clients
+    that pass the last version they saw only get the nodes that changed since.
+    """
+
+    def __init__(self, nodes: List[dict]):
+        self.nodes = nodes
+        self.index = {node['data']['label']: node for node in nodes}
+        self.version = 0
+        self.node_versions = {label: 0 for label in self.index}  # Version each node last changed at
+        self.changes = []  # (version, label) in version order
+        self.serialized = {}  # Cached JSON of each node, refreshed only for changed nodes
+        self.serialized_version = -1
+
+    def update(self, label: str, **fields) -> Optional[dict]:
+        node = self.index.get(label)
+        if node is None:
+            return None
+        changed = {key: value for key, value in fields.items() if node['data'].get(key) != value}
+        if changed:
+            node['data'].update(changed)
+            self.version += 1
+            self.node_versions[label] = self.version
+            self.changes.append((self.version, label))
+            if len(self.changes) > 2 * len(self.nodes) + 64:
+                # Only the latest change of each node matters, drop the rest
+                self.changes = sorted((version, label) for label, version in self.node_versions.items())
+        return node
+
+    def changes_since(self, version: int) -> List[dict]:
+        start = bisect.bisect_right(self.changes, version, key=lambda change: change[0])
+        labels = dict.fromkeys(label for _, label in self.changes[start:])
+        return [self.index[label] for label in labels]
+
+    def to_json(self) -> str:
+        for node in (self.nodes if self.serialized_version < 0 else self.changes_since(self.serialized_version)):
+            self.serialized[node['data']['label']] = json.dumps(node)
+        self.serialized_version = self.version
+        return "[" + ", ".join(self.serialized[node['data']['label']] for node in self.nodes) + "]"
+
+
+class RunBudget(NamedTuple):
+    """Limits on what one run may spend, None for no limit."""
+    max_seconds: Optional[float] = None  # Wall-clock time executing, time queued or parked does not count
+    max_llm_calls: Optional[int] = None  # Chat model calls, supervisor routing included
+    max_tokens: Optional[int] = None  # Prompt and completion tokens of those calls
+    max_tool_calls: Optional[int] = None
+
+
+def env_limit(name: str, default: str, kind: Callable):
+    value = os.getenv(name, default)
+    return kind(value) if value else None
+
+
+DEFAULT_RUN_BUDGET = RunBudget(
+    max_seconds=env_limit("SYMPHONY_RUN_MAX_SECONDS", "900", float),
+    max_llm_calls=env_limit("SYMPHONY_RUN_MAX_LLM_CALLS", "200", int),
+    max_tokens=env_limit("SYMPHONY_RUN_MAX_TOKENS", "500000", int),
+    max_tool_calls=env_limit("SYMPHONY_RUN_MAX_TOOL_CALLS", "200", int),
+)
+
+
+def run_budget(**limits) -> RunBudget:
+    """The default budget lowered by the limits a request asked for, which cannot raise it."""
+    budget = DEFAULT_RUN_BUDGET
+    for field, limit in limits.items():
+        if limit is not None:
+            default = getattr(budget, field)
+            budget = budget._replace(**{field: limit if default is None else min(limit, default)})
+    return budget
+
+
+class RunState:
+    """Everything a single `stream_time_elapsed` invocation tracks about its run."""
+
+    def __init__(self, run_id: str, prompt: str, data: List[dict], priority: int = 0,
+                 feedback_timeout: float = 3600.0, feedback_default: str = "reject", stream_tokens: bool = False,
+                 team: str = "research", budget: RunBudget = DEFAULT_RUN_BUDGET):
+        self.run_id = run_id
+        self.prompt = prompt
+        self.worker = WORKER_ID  # Worker process executing the run, see StateBackend
+        self.reported_queue_position = None  # Queue position on that worker, for runs read from a snapshot
+        self.team = team  # Name of the team graph in `team_registry` that works on the prompt
+        self.priority = priority  # Higher priorities leave the run queue first
+        self.stream_tokens = stream_tokens  # Forward model tokens and tool calls to /runs/{run_id}/stream
+        self.feedback_timeout = feedback_timeout  # Seconds a human has to answer an approval request
+        self.feedback_default = feedback_default  # Decision applied when that time runs out
+        self.budget = budget
+        self.usage = {"seconds": 0.0, "llm_calls": 0, "tokens": 0, "tool_calls": 0}  # What the run spent of its budget
+        self.status = "queued"  # One of queued, running, parked, finished, stopped, failed, rejected, cancelled
+        self.stop_reason = None  # Why the run was stopped early: cancelled, or the budget limit it went over
+        self.error = None
+        self.graph = AgentGraph(data)  # This run's copy of the node graph shown on the dashboard
+        for label in self.graph.index:
+            self.graph.update(label, number_calls=0)
+        self.agent_times = {}  # Execution times of each agent call
+        self.supervisor_times = []  # Execution times of each supervisor call
+        self.agent_start_times = {}  # Start time of each agent's current execution
+        self.agent_completed = {}  # Completion status of each agent
+        self.agent_call_counts = {}  # Number of times each agent has been invoked
+        self.agent_call_sequence = []  # Sequence of agent invocations
+        self.messages = []  # Agent messages produced by this run
+        self.awaiting_approval = {}  # Agent name to output that needs approval, until the graph step has merged
+        self.human_feedback_needed = {}  # Pending approvals keyed by agent name, the run is parked meanwhile
+        self.stop_event = asyncio.Event()  # Set to stop the run early, and once it has finished
+        self.task_active = False
+        self.created_at = time.time()
+        self.queued_at = None  # When the run last entered the scheduler queue
+        self.started_at = None
+        self.finished_at = None
+        self.step_seq = 0  # Number of graph steps completed, including any before a resume
+        self.resume_messages = None  # Conversation to continue from when resuming a run
+
+    def publish(self, event_type: str, **payload) -> None:
+        status_broadcaster.publish(event_type, run_id=self.run_id, **payload)
+
+
+MAX_FINISHED_RUNS = 100  # Finished runs kept around for status and result queries
+FEEDBACK_TIMEOUT = float(os.getenv("SYMPHONY_FEEDBACK_TIMEOUT", "3600"))  # Default approval deadline in seconds
+FINISHED_STATUSES = ("finished", "stopped", "failed", "rejected", "cancelled")
+runs: Dict[str, RunState] = {}  # Run registry keyed by run ID, oldest first
+current_run: ContextVar[RunState] = ContextVar("current_run")  # The run a graph node belongs to
+
+
+def request_stop(run: RunState, reason: str) -> None:
+    """Stop a running run at once, keeping the steps it completed. The first reason given wins."""
+    if run.stop_reason is None:
+        run.stop_reason = reason
+        run.stop_event.set()
+        runs_stopped.inc(reason=reason)
+
+
+class RunStopped(Exception):
+    """Raised inside the graph to abandon the model or tool call of a run asked to stop."""
+
+
+class BudgetTracker(AsyncCallbackHandler):
+    """Count one run's model calls, tokens and tool calls, and stop the run once one is over budget.
+
+    A model call's prompt tokens are estimated when it starts. When it ends,
+    the estimate is replaced by the total the provider reports, or the number
+    of streamed chunks is added when a streamed response reports none. Calls
+    that would go over a limit, their estimated prompt included, are refused
+    without being counted. Once the run is asked to stop, for any reason, the
+    next call or streamed token raises `RunStopped`.
+    """
+
+    raise_error = True  # Let RunStopped through to the model or tool call
+
+    def __init__(self, run: RunState):
+        self.run = run
+        self.prompts = {}  # LangChain run ID to the estimated prompt tokens of a call in flight
+        self.streamed = {}  # LangChain run ID to the chunks streamed so far
+
+    def admit(self, **amounts: int) -> None:
+        """Spend `amounts` on a call about to start, or refuse it if they would go over budget."""
+        for kind, amount in amounts.items():
+            limit = getattr(self.run.budget, f"max_{kind}")
+            if limit is not None and self.run.usage[kind] + amount > limit:
+                request_stop(self.run, f"max_{kind}")
+        self.check()
+        for kind, amount in amounts.items():
+            self.run.usage[kind] += amount
+
+    def spend(self, kind: str, amount: int) -> None:
+        self.run.usage[kind] += amount
+        limit = getattr(self.run.budget, f"max_{kind}")
+        if limit is not None and self.run.usage[kind] > limit:
+            request_stop(self.run, f"max_{kind}")
+        self.check()
+
+    def check(self) -> None:
+        if self.run.stop_reason is not None:
+            raise RunStopped(self.run.stop_reason)
+
+    async def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs) -> None:
+        prompt = sum(HistoryCompactor.count_tokens(message) for batch in messages for message in batch)
+        self.admit(llm_calls=1, tokens=prompt)
+        self.prompts[run_id] = prompt
+
+    async def on_llm_new_token(self, token, *, run_id, **kwargs) -> None:
+        self.streamed[run_id] = self.streamed.get(run_id, 0) + 1
+        self.check()
+
+    async def on_llm_end(self, response, *, run_id, **kwargs) -> None:
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        prompt = self.prompts.pop(run_id, 0)
+        streamed = self.streamed.pop(run_id, 0)
+        self.spend("tokens", usage["total_tokens"] - prompt if usage.get("total_tokens") else streamed)
+
+    async def on_llm_error(self, error, *, run_id, **kwargs) -> None:
+        self.prompts.pop(run_id, None)
+        self.run.usage["tokens"] += self.streamed.pop(run_id, 0)
+
+    async def on_tool_start(self, serialized, input_str, *, run_id, **kwargs) -> None:
+        self.admit(tool_calls=1)
+
+
+def register_run(prompt: str, priority: int = 0, feedback_timeout: Optional[float] = None,
+                 feedback_default: str = "reject", stream_tokens: Optional[bool] = None,
+                 team: Optional[str] = None, budget: RunBudget = DEFAULT_RUN_BUDGET) -> RunState:
+    run = RunState(uuid.uuid4().hex, prompt, structure_cache.node_dicts(), priority=priority,
+                   feedback_timeout=feedback_timeout if feedback_timeout is not None else FEEDBACK_TIMEOUT,
+                   feedback_default=feedback_default,
+                   stream_tokens=stream_tokens if stream_tokens is not None else TOKEN_STREAM_DEFAULT,
+                   team=team or DEFAULT_TEAM, budget=budget)
+    runs[run.run_id] = run
+    finished = [run_id for run_id, state in runs.items() if state.status in FINISHED_STATUSES]
+    for run_id in finished[: max(0, len(finished) - MAX_FINISHED_RUNS)]:
+        del runs[run_id]
+    return run
+
+
+async def get_run(run_id: Optional[str] = None) -> Optional[RunState]:
+    """Look up a run by ID, defaulting to the most recently started one.
+
+    With a shared state backend, runs executing on other workers are read from
+    their latest snapshot. So are runs this worker finished that another worker
+    resumed since.
+    """
+    if run_id is None and state_backend.shared:
+        run_id = await state_backend.latest_run_id()
+    if run_id is None:
+        return next(reversed(runs.values()), None)
+    run = runs.get(run_id)
+    if state_backend.shared and (run is None or run.status in FINISHED_STATUSES):
+        snapshot = await state_backend.load_run(run_id)
+        if snapshot is not None and snapshot["worker"] != WORKER_ID:
+            run = run_from_snapshot(snapshot)
+    if run is None:
+        raise HTTPException(status_code=404, detail=f"Run {run_id} not found")
+    return run
+
+
+def run_snapshot(run: RunState) -> dict:
+    """What other workers need to serve a run's status, as JSON-safe data."""
+    return {
+        **describe_run(run),
+        "worker": run.worker,
+        "stream_tokens": run.stream_tokens,
+        "finished_at": run.finished_at,
+        "agent_times": run.agent_times,
+        "agent_start_times": run.agent_start_times,
+        "agent_completed": run.agent_completed,
+        "agent_call_counts": run.agent_call_counts,
+        "agent_call_sequence": run.agent_call_sequence,
+        "messages": [result.model_dump() for result in run.messages],
+        "human_feedback_needed": {agent: {"message": approval["message"], "deadline": approval.get("deadline")}
+                                  for agent, approval in run.human_feedback_needed.items()},
+        "graph": {"nodes": run.graph.nodes, "version": run.graph.version, "changes": run.graph.changes},
+    }
+
+
+def run_from_snapshot(snapshot: dict) -> RunState:
+    """A read-only copy of a run executing on another worker."""
+    run = RunState(snapshot["run_id"], snapshot["prompt"], [], priority=snapshot["priority"],
+                   stream_tokens=snapshot["stream_tokens"], team=snapshot["team"])
+    for field in ("worker", "status", "error", "stop_reason", "usage", "task_active", "created_at", "started_at",
+                  "finished_at", "agent_times", "agent_start_times", "agent_completed", "agent_call_counts",
+                  "agent_call_sequence", "human_feedback_needed"):
+        setattr(run, field, snapshot[field])
+    run.budget = RunBudget(**snapshot["budget"])
+    run.reported_queue_position = snapshot["queue_position"]
+    run.messages = [TaskResult(**message) for message in snapshot["messages"]]
+    run.graph = AgentGraph(snapshot["graph"]["nodes"])
+    run.graph.version = snapshot["graph"]["version"]
+    run.graph.changes = [tuple(change) for change in snapshot["graph"]["changes"]]
+    run.graph.node_versions.update({label: version for version, label in run.graph.changes})
+    return run
+
+
+async def sync_shared_runs() -> None:
+    """Save snapshots of this worker's runs that changed since the last save, every STATE_SYNC_INTERVAL."""
+    saved = {}  # Run ID to the state it was last saved in
+    while True:
+        await asyncio.sleep(STATE_SYNC_INTERVAL)
+        changed = []
+        for run in list(runs.values()):
+            state = (run.status, run.task_active, run.graph.version, len(run.messages),
+                     tuple(run.human_feedback_needed), scheduler.queue_position(run.run_id), tuple(run.usage.values()))
+            if run.worker == WORKER_ID and saved.get(run.run_id) != state:
+                saved[run.run_id] = state
+                changed.append(run_snapshot(run))
+        for run_id in set(saved) - set(runs):
+            del saved[run_id]
+        if not changed:
+            continue
+        try:
+            await state_backend.save_runs(changed)
+        except Exception as e:
+            print(f"Could not save {len(changed)} run snapshots: {e!r}")
+            for snapshot in changed:
+                saved.pop(snapshot["run_id"], None)  # Try again next time
+
+
+def share_final_state(run: RunState) -> None:
+    """Queue the snapshot of a run that stopped running ahead of its `end` event."""
+    if state_backend.shared:
+        state_backend.save_run_soon(run_snapshot(run))
+
+
+def receive_shared_message(message: dict) -> None:
+    """Handle an event or signal another worker published."""
+    channel = message.pop("channel")
+    if channel == "status":
+        status_broadcaster.deliver(message)
+    elif channel == "tokens":
+        token_broadcaster.deliver(message)
+    elif channel == "signal":
+        run = runs.get(message["run_id"])
+        if run is None or run.worker != WORKER_ID:
+            return
+        if message["type"] == "feedback" and message["agent"] in run.human_feedback_needed:
+            resolve_human_feedback(run, message["agent"], message["feedback"])
+        elif message["type"] == "cancel":
+            cancel_owned_run(run)
+
+
+class RunStore:
+    """Durable history of runs and the graph steps they completed, in SQLite.
+
+    Writes from the event loop only enqueue; a background thread applies them
+    in batches of up to `batch_size`, at least every `flush_interval` seconds,
+    on a WAL-mode connection so reads never wait for the writer. Workers may
+    share the store, each run records the worker that owns it.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            run_id TEXT PRIMARY KEY,
+            prompt TEXT NOT NULL,
+            team TEXT NOT NULL DEFAULT 'research',
+            priority INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL,
+            worker TEXT,
+            error TEXT,
+            stop_reason TEXT,
+            budget TEXT,
+            usage TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS runs_created_at ON runs (created_at);
+        CREATE TABLE IF NOT EXISTS steps (
+            run_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            node TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (run_id, seq)
+        );
+        CREATE TABLE IF NOT EXISTS approvals (
+            run_id TEXT NOT NULL,
+            agent TEXT NOT NULL,
+            message TEXT NOT NULL,
+            output TEXT NOT NULL,
+            deadline REAL NOT NULL,
+            default_decision TEXT NOT NULL,
+            decision TEXT,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (run_id, agent)
+        );
+    """
+
+    def __init__(self, path: str, batch_size: int = 100, flush_interval: float = 0.5):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = queue.Queue()
+        with self.connect() as conn:
+            conn.executescript(self.SCHEMA)
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(runs)")}
+            if "team" not in columns:
+                # Stores written before teams existed only ran the research team
+                conn.execute("ALTER TABLE runs ADD COLUMN team TEXT NOT NULL DEFAULT 'research'")
+            for column in ("worker", "stop_reason", "budget", "usage"):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE runs ADD COLUMN {column} TEXT")
+        self.writer = threading.Thread(target=self._write_loop, name="symphony-run-store", daemon=True)
+        self.writer.start()
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def save_run(self, run: "RunState") -> None:
+        self.pending.put((
+            "INSERT INTO runs (run_id, prompt, team, priority, status, worker, error, stop_reason, budget, usage,"
+            " created_at, started_at, finished_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT (run_id) DO UPDATE SET status = excluded.status, worker = excluded.worker,"
+            " error = excluded.error, stop_reason = excluded.stop_reason, usage = excluded.usage,"
+            " started_at = excluded.started_at, finished_at = excluded.finished_at",
+            (run.run_id, run.prompt, run.team, run.priority, run.status, run.worker, run.error, run.stop_reason,
+             json.dumps(run.budget._asdict()), json.dumps(run.usage), run.created_at, run.started_at, run.finished_at),
+        ))
+
+    def add_step(self, run_id: str, seq: int, node: str, payload: dict) -> None:
+        self.pending.put((
+            "INSERT OR REPLACE INTO steps (run_id, seq, node, payload, created_at) VALUES (?, ?, ?, ?, ?)",
+            (run_id, seq, node, json.dumps(payload), time.time()),
+        ))
+
+    def save_approval(self, run_id: str, agent: str, approval: dict) -> None:
+        self.pending.put((
+            "INSERT OR REPLACE INTO approvals (run_id, agent, message, output, deadline, default_decision, created_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (run_id, agent, approval["message"], approval["output"], approval["deadline"],
+             approval["default_decision"], time.time()),
+        ))
+
+    def resolve_approval(self, run_id: str, agent: str, decision: str) -> None:
+        self.pending.put((
+            "UPDATE approvals SET decision = ? WHERE run_id = ? AND agent = ?", (decision, run_id, agent)
+        ))
+
+    def _write_loop(self) -> None:
+        conn = self.connect()
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.pending.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            stop = None in batch
+            with conn:
+                for statement, params in (write for write in batch if write is not None):
+                    conn.execute(statement, params)
+            for _ in batch:
+                self.pending.task_done()
+            if stop:
+                conn.close()
+                return
+
+    def flush(self) -> None:
+        """Block until every queued write has been committed."""
+        self.pending.join()
+
+    def close(self) -> None:
+        self.pending.put(None)
+        self.writer.join()
+
+    def list_runs(self, limit: int, before: Optional[float] = None) -> List[dict]:
+        """A page of runs, newest first. Pass the last `created_at` seen as `before` for the next page."""
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT * FROM runs WHERE created_at < ? ORDER BY created_at DESC LIMIT ?",
+                (before if before is not None else float("inf"), limit),
+            ).fetchall()
+        return [self.run_record(row) for row in rows]
+
+    def get_run(self, run_id: str) -> Optional[dict]:
+        with self.connect() as conn:
+            row = conn.execute("SELECT * FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+        return self.run_record(row) if row else None
+
+    @staticmethod
+    def run_record(row: sqlite3.Row) -> dict:
+        record = dict(row)
+        for column in ("budget", "usage"):
+            # Runs stored before budgets existed have neither
+            record[column] = json.loads(record[column]) if record[column] else None
+        return record
+
+    def pending_approvals(self) -> List[dict]:
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT approvals.* FROM approvals JOIN runs USING (run_id)"
+                " WHERE approvals.decision IS NULL AND runs.status = 'parked'"
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def active_runs(self) -> List[dict]:
+        """Runs still queued or running as far as the store knows, with their owners."""
+        with self.connect() as conn:
+            rows = conn.execute("SELECT run_id, worker FROM runs WHERE status IN ('queued', 'running')").fetchall()
+        return [dict(row) for row in rows]
+
+    def interrupt_runs(self, owned: List[Tuple[str, Optional[str]]]) -> None:
+        """Mark (run_id, worker) runs interrupted, unless another worker took them over in the meantime."""
+        with self.connect() as conn:
+            conn.executemany(
+                "UPDATE runs SET status = 'interrupted'"
+                " WHERE run_id = ? AND worker IS ? AND status IN ('queued', 'running')",
+                owned,
+            )
+
+    def take_over(self, run_id: str, worker: Optional[str]) -> bool:
+        """Make this worker the owner of a run `worker` owned, False if another worker got to it first."""
+        with self.connect() as conn:
+            cursor = conn.execute("UPDATE runs SET worker = ? WHERE run_id = ? AND worker IS ?",
+                                  (WORKER_ID, run_id, worker))
+        return cursor.rowcount == 1
+
+    def get_steps(self, run_id: str) -> List[dict]:
+        with self.connect() as conn:
+            rows = conn.execute("SELECT * FROM steps WHERE run_id = ? ORDER BY seq", (run_id,)).fetchall()
+        return [{**dict(row), "payload": json.loads(row["payload"])} for row in rows]
+
+
+run_store = RunStore(
+    path=os.getenv("SYMPHONY_RUN_STORE_PATH", "runs.db"),
+    batch_size=int(os.getenv("SYMPHONY_RUN_STORE_BATCH_SIZE", "100")),
+    flush_interval=float(os.getenv("SYMPHONY_RUN_STORE_FLUSH_INTERVAL", "0.5")),
+)
+
+
+def finish_run(run: RunState, status: str) -> None:
+    """Put a run in a terminal status and release what it holds, whichever way it ended."""
+    run.status = status
+    run.finished_at = time.time()
+    run.stop_event.set()
+    run_seconds.observe(run.finished_at - run.created_at, status=status)
+    asyncio.ensure_future(repl_pool.end_session(run.run_id))
+    asyncio.ensure_future(workspaces.end_session(run.run_id))
+    run_store.save_run(run)
+    share_final_state(run)
+    token_broadcaster.close(run.run_id, run.status)
+
+
+class SchedulerFull(Exception):
+    """Raised when both the run slots and the run queue are full."""
+
+
+class RunScheduler:
+    """Admission control for agent runs.
+
+    At most `max_concurrency` runs execute at once. Further runs wait in a
+    bounded priority queue (highest priority first, FIFO within a priority) and
+    are started as slots free up. Submitting to a full queue raises
+    `SchedulerFull` so callers can shed load instead of piling up LangGraph runs.
+    """
+
+    def __init__(self, max_concurrency: int, max_queued: int):
+        self.max_concurrency = max_concurrency
+        self.max_queued = max_queued
+        self.queue = []  # Heap of (-priority, sequence, run)
+        self.running = {}  # Run ID to the task executing it
+        self._sequence = itertools.count()
+
+    def submit(self, run: RunState) -> None:
+        if len(self.queue) >= self.max_queued:
+            raise SchedulerFull(f"Run queue is full ({self.max_queued} runs waiting)")
+        heapq.heappush(self.queue, (-run.priority, next(self._sequence), run))
+        run.status = "queued"
+        run.queued_at = time.time()
+        run_store.save_run(run)
+        self._dispatch()
+
+    def queue_position(self, run_id: str) -> Optional[int]:
+        """1-based position of a queued run, or None if it is not waiting."""
+        for position, (_, _, run) in enumerate(sorted(self.queue), start=1):
+            if run.run_id == run_id:
+                return position
+        return None
+
+    def cancel(self, run_id: str) -> bool:
+        for index, (_, _, run) in enumerate(self.queue):
+            if run.run_id == run_id:
+                self.queue.pop(index)
+                heapq.heapify(self.queue)
+                request_stop(run, "cancelled")
+                run.publish("task_cancelled")
+                finish_run(run, "cancelled")
+                return True
+        if run_id in self.running:
+            # Let the run wrap up and keep what it completed, rather than cancelling its task
+            request_stop(runs[run_id], "cancelled")
+            return True
+        return False
+
+    def _dispatch(self) -> None:
+        while self.queue and len(self.running) < self.max_concurrency:
+            _, _, run = heapq.heappop(self.queue)
+            run.status = "running"
+            run.started_at = time.time()
+            run_queue_seconds.observe(run.started_at - run.queued_at)
+            run_store.save_run(run)
+            # Start from an empty context: dispatch can happen inside another run's task or callbacks,
+            # whose run and LangChain context variables must not leak into this run
+            task = Context().run(asyncio.create_task, self._execute(run))
+            task.add_done_callback(functools.partial(self._release, run))
+            self.running[run.run_id] = task
+
+    async def _execute(self, run: RunState) -> None:
+        try:
+            with span("run", run_id=run.run_id, priority=run.priority, resumed=run.resume_messages is not None):
+                await stream_time_elapsed(run)
+            if run.stop_reason == "cancelled":
+                run.status = "cancelled"
+                run.publish("task_cancelled")
+            elif run.stop_reason is not None:
+                run.status = "stopped"
+                run.publish("task_stopped", reason=run.stop_reason, usage=run.usage)
+            else:
+                run.status = "finished"
+        except RunParked as parked:
+            # Waiting for a human holds no slot; resolve_human_feedback resubmits the run
+            run.status = "parked"
+            run.publish("task_parked", agents=list(run.human_feedback_needed))
+            print(f"Run {run.run_id} parked: {parked}")
+        except Exception as e:
+            run.status = "failed"
+            run.error = repr(e)
+            run.publish("task_failed", error=run.error)
+            print(f"Run {run.run_id} failed: {run.error}")
+
+    def _release(self, run: RunState, task: asyncio.Task) -> None:
+        # Runs as a done callback so a task cancelled before it started still frees its slot
+        if task.cancelled():
+            run.status = "cancelled"
+            run.publish("task_cancelled")
+        run.task_active = False
+        if run.status in FINISHED_STATUSES:
+            finish_run(run, run.status)
+        else:
+            # Parked, its sessions are kept for when a human lets it continue
+            run_store.save_run(run)
+            share_final_state(run)
+            token_broadcaster.close(run.run_id, run.status)
+        del self.running[run.run_id]
+        self._dispatch()
+
+
+scheduler = RunScheduler(
+    max_concurrency=int(os.getenv("SYMPHONY_MAX_CONCURRENT_RUNS", "4")),
+    max_queued=int(os.getenv("SYMPHONY_MAX_QUEUED_RUNS", "32")),
+)
+metrics.gauge("symphony_runs_running", "Runs currently holding a scheduler slot.", lambda: len(scheduler.running))
+metrics.gauge("symphony_runs_queued", "Runs waiting in the scheduler queue.", lambda: len(scheduler.queue))
+metrics.gauge("symphony_workspace_bytes", "Bytes of documents in run workspaces, including those of ended runs.",
+              lambda: workspaces.total_bytes())
+metrics.gauge("symphony_runs_parked", "Runs parked until a human answers an approval request.",
+              lambda: sum(run.status == "parked" for run in runs.values()))
+
 
 class HumanFeedbackRequest(BaseModel):
     agent: str
     feedback: str
+    run_id: Optional[str] = None
 
 class AgentStatus(BaseModel):
+    run_id: Optional[str] = None
     current_agent: str = ""
     elapsed_time: float = 0.0
     task_active: bool = False
@@ -197,86 +2423,289 @@ class AgentStatus(BaseModel):
     current_agent_call_count: int = 0
     prior_agents: List[dict] = []
     data: List[dict] = None
+    version: int = 0
     human_feedback_requested: bool = False
 
+class RunBudgetRequest(BaseModel):
+    max_seconds: Optional[float] = Field(None, gt=0)
+    max_llm_calls: Optional[int] = Field(None, gt=0)
+    max_tokens: Optional[int] = Field(None, gt=0)
+    max_tool_calls: Optional[int] = Field(None, gt=0)
+
 class PromptRequest(BaseModel):
     prompt: str
+    priority: int = 0
+    feedback_timeout: Optional[float] = None  # Seconds to wait for approvals, SYMPHONY_FEEDBACK_TIMEOUT by default
+    feedback_default: Literal["approve", "reject"] = "reject"  # Decision applied when an approval times out
+    stream_tokens: Optional[bool] = None  # Stream tokens to /runs/{run_id}/stream, SYMPHONY_STREAM_TOKENS by default
+    team: Optional[str] = None  # Team graph to run, SYMPHONY_DEFAULT_TEAM by default
+    budget: RunBudgetRequest = RunBudgetRequest()  # Lower limits than the SYMPHONY_RUN_MAX_* defaults
 
 class TaskResult(BaseModel):
     agent: str
     message: str
 
-def human_approval(agent: str, msg: AIMessage) -> Runnable:
-    tool_strs = "\n\n".join(
-        json.dumps(tool_call, indent=2) for tool_call in msg.tool_calls
+class RunParked(Exception):
+    """Raised inside the graph to park a run until a human approves a step."""
+
+
+def park_for_approval(run: RunState) -> None:
+    """Persist a pending approval for each output awaiting one, arm their deadlines and park the run.
+
+    Workers only set their output aside, the supervisor parks the run before
+    it routes again. By then the graph step has merged and the outputs of the
+    workers that ran alongside are recorded.
+    """
+    # Saved in the same batch as the approvals, so the store never shows them pending without this worker as owner
+    run_store.save_run(run)
+    agents = list(run.awaiting_approval)
+    for agent, output in run.awaiting_approval.items():
+        approval = {
+            "message": f"Do you approve of the following tool invocations for {agent}?\n\n{output}\n\n",
+            "output": output,
+            "deadline": time.time() + run.feedback_timeout,
+            "default_decision": run.feedback_default,
+        }
+        run_store.save_approval(run.run_id, agent, approval)
+        arm_approval(run, agent, approval)
+        print(f"Waiting for human feedback for {agent}")
+        run.publish("human_feedback", agent=agent, message=approval["message"], deadline=approval["deadline"])
+    run.awaiting_approval.clear()
+    raise RunParked(f"Waiting for human feedback for {', '.join(agents)}")
+
+
+def arm_approval(run: RunState, agent: str, approval: dict) -> None:
+    loop = asyncio.get_running_loop()
+    approval["timer"] = loop.call_later(
+        max(0.0, approval["deadline"] - time.time()),
+        lambda: apply_feedback(run, agent, approval["default_decision"] == "approve", reason="deadline passed"),
     )
-    human_feedback_needed[agent] = {
-        "message": f"Do you approve of the following tool invocations for {agent}?\n\n{tool_strs}\n\n",
-        "tool_invocations": tool_strs
-    }
-    raise ValueError(f"Waiting for human feedback for {agent}")
+    run.human_feedback_needed[agent] = approval
+
+
+def apply_feedback(run: RunState, agent: str, approved: bool, reason: str) -> None:
+    approval = run.human_feedback_needed.pop(agent)
+    approval["timer"].cancel()
+    run_store.resolve_approval(run.run_id, agent, "approve" if approved else "reject")
+    run.publish("human_feedback_resolved", agent=agent, approved=approved, reason=reason)
+    if not approved:
+        run.error = f"{agent} output rejected: {reason}"
+        finish_run(run, "rejected")
+        return
+    # Record the approved output as the step the graph produced, then continue after it
+    message = HumanMessage(content=approval["output"], name=agent)
+    run.step_seq += 1
+    run_store.add_step(run.run_id, run.step_seq, agent, step_payload({"messages": [message]}))
+    record_messages(run, agent, [message])
+    run.resume_messages = run_conversation(run)
+    if run.human_feedback_needed:
+        return  # Workers that ran in the same step still wait for their approval
+    try:
+        scheduler.submit(run)
+    except SchedulerFull as e:
+        run.error = f"Could not resume after approval: {e}"
+        finish_run(run, "failed")
+
+
+def is_approval(feedback: str) -> bool:
+    return feedback.lower() in ("yes", "y")
 
-def resolve_human_feedback(agent: str, feedback: str) -> None:
-    if feedback.lower() not in ("yes", "y"):
-        raise ValueError(f"Tool invocations not approved for {agent}")
-    feedback_entry = human_feedback_needed.pop(agent, None)
-    if feedback_entry:
-        feedback_entry["event"].set()
+
+def resolve_human_feedback(run: RunState, agent: str, feedback: str) -> bool:
+    if agent not in run.human_feedback_needed:
+        raise ValueError(f"No feedback is pending for {agent}")
+    approved = is_approval(feedback)
+    apply_feedback(run, agent, approved, reason=feedback)
+    return approved
 
 @app.post("/resolve_feedback")
 async def resolve_feedback(request: HumanFeedbackRequest):
     agent = request.agent
     feedback = request.feedback
+    run = await get_run(request.run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail="No task has been run yet")
     try:
-        resolve_human_feedback(agent, feedback)
-        return {"message": f"Feedback resolved for {agent}"}
+        if run.worker == WORKER_ID:
+            approved = resolve_human_feedback(run, agent, feedback)
+        else:
+            # The worker running it applies the feedback, this one only checked it is pending
+            if agent not in run.human_feedback_needed:
+                raise ValueError(f"No feedback is pending for {agent}")
+            state_backend.publish({"channel": "signal", "type": "feedback", "run_id": run.run_id,
+                                   "agent": agent, "feedback": feedback})
+            approved = is_approval(feedback)
+        return {"message": f"Feedback resolved for {agent}", "run_id": run.run_id, "approved": approved}
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 def time_tracker(func):
     @functools.wraps(func)
     async def wrapper(*args, **kwargs):
+        run = current_run.get()
         start_time = time.time()
         agent_name = kwargs.get("name")
         if agent_name:
-            agent_start_times[agent_name] = start_time  # Store the start time of the agent
-            agent_completed[agent_name] = False  # Mark the agent as not completed
-        result = await func(*args, **kwargs)
-        end_time = time.time()
-        execution_time = end_time - start_time
-        if agent_name:
-            agent_times[agent_name] = agent_times.get(agent_name, [])
-            agent_times[agent_name].append(execution_time)
-            print(f"{agent_name} execution time: {execution_time:.2f} seconds")
-            agent_completed[agent_name] = True  # Mark the agent as completed
-        return result
+            run.agent_start_times[agent_name] = start_time  # Store the start time of the agent
+            run.agent_completed[agent_name] = False  # Mark the agent as not completed
+        try:
+            node = agent_name or func.__name__
+            with span(node, node_seconds, {"node": node}, run_id=run.run_id):
+                return await func(*args, **kwargs)
+        finally:
+            end_time = time.time()
+            execution_time = end_time - start_time
+            if agent_name:
+                run.agent_times[agent_name] = run.agent_times.get(agent_name, [])
+                run.agent_times[agent_name].append(execution_time)
+                print(f"{agent_name} execution time: {execution_time:.2f} seconds")
+                run.agent_completed[agent_name] = True  # Mark the agent as completed
 
     return wrapper
 
 
 @time_tracker
 async def agent_node(state, agent, name, ask_human_feedback=False):
+    run = current_run.get()
     print(f"{name} is active")
-    result = await agent.ainvoke(state)
+    # The agent name in the metadata tells token stream clients which agent is talking
+    result = await agent.ainvoke(state, {"metadata": {"agent": name}})
     
     if ask_human_feedback:
-        human_feedback_event = asyncio.Event()
-        human_feedback_needed[name] = {
-            "message": f"Do you approve of the following tool invocations for {name}?\n\n{result['output']}\n\n",
-            "tool_invocations": result.get("tool_calls", []),
-            "event": human_feedback_event
-        }
-        print(f"Waiting for human feedback for {name}")
-        await human_feedback_event.wait()
-    
+        # Added to the conversation once approved, the supervisor parks the run after this step
+        run.awaiting_approval[name] = result["output"]
+        return {"messages": []}
+
     return {"messages": [HumanMessage(content=result["output"], name=name)]}
 
-def create_team_supervisor(llm: ChatOpenAI, system_prompt, members) -> str:
-    """An LLM-based router."""
+def next_workers(decision: Union[str, List[str]]) -> List[str]:
+    """The workers a supervisor decision starts, in order. Empty when it finishes the run."""
+    workers = [decision] if isinstance(decision, str) else decision
+    return list(dict.fromkeys(worker for worker in workers if worker != "FINISH"))
+
+
+def route_next(state) -> Union[str, List[str]]:
+    """Graph edge after the supervisor. Several workers run concurrently in one step."""
+    workers = next_workers(state["next"])
+    if not workers:
+        return "FINISH"
+    return workers[0] if len(workers) == 1 else workers
+
+
+URL_PATTERN = re.compile(r"https?://[^\s<>\"')\]]+")
+FINAL_ANSWER_MARKER = "FINAL ANSWER"  # Workers are told to start an answer that completes the request with it
+CLAUSE_SEPARATOR = re.compile(r"[;,.!?]|\b(?:and|then|also|plus)\b", re.IGNORECASE)
+
+
+def worker_names(messages: List[BaseMessage]) -> List[str]:
+    """The workers that have answered so far, in order."""
+    return [message.name for message in messages if isinstance(message, HumanMessage) and message.name]
+
+
+def request_parts(request: str) -> List[str]:
+    """The clauses of a request once its URLs are taken out, e.g. two for "scrape <url> and search for X"."""
+    parts = CLAUSE_SEPARATOR.split(URL_PATTERN.sub(" ", request))
+    return [part.strip() for part in parts if re.search(r"\w", part)]
+
+
+def route_urls_unscraped(messages: List[BaseMessage], members: List[str]) -> Optional[str]:
+    """The request only asks about the pages it links to, and nobody has scraped them yet.
+
+    A request that also asks for other work is left to the supervisor, which
+    can start the scraper and other workers together.
+    """
+    request = next((m.content for m in messages if isinstance(m, HumanMessage) and not m.name), "")
+    if ("WebScraper" in members and URL_PATTERN.search(request) and "WebScraper" not in worker_names(messages)
+            and len(request_parts(request)) <= 1):
+        return "WebScraper"
+    return None
+
+
+def route_final_answer(messages: List[BaseMessage], members: List[str]) -> Optional[str]:
+    """The last worker marked its answer as final."""
+    last = messages[-1] if messages else None
+    if isinstance(last, HumanMessage) and last.name in members and FINAL_ANSWER_MARKER in str(last.content):
+        return "FINISH"
+    return None
+
+
+def route_all_workers_done(messages: List[BaseMessage], members: List[str]) -> Optional[str]:
+    """Every worker has answered and the last message is a worker's."""
+    answered = worker_names(messages)
+    if answered and isinstance(messages[-1], HumanMessage) and messages[-1].name and set(members) <= set(answered):
+        return "FINISH"
+    return None
+
+
+ROUTING_RULES = {
+    "urls_unscraped": route_urls_unscraped,
+    "final_answer": route_final_answer,
+    "all_workers_done": route_all_workers_done,
+}
+DEFAULT_RULE_CONFIDENCE = {"urls_unscraped": 0.9, "final_answer": 0.95, "all_workers_done": 0.85}
+
+
+class RuleRouter(Runnable):
+    """Route with deterministic rules, and ask the LLM supervisor only when no rule is sure.
+
+    `rules` maps rule names from `ROUTING_RULES` to the confidence of their
+    decisions. Rules are tried from the most to the least confident, and the
+    first match whose confidence reaches `threshold` decides the next worker
+    without a model call; otherwise the state goes to `supervisor`. Decisions
+    are counted by path on `/metrics`.
+    """
+
+    def __init__(self, supervisor: Runnable, members: List[str], rules: Dict[str, float], threshold: float):
+        self.supervisor = supervisor
+        self.options = ["FINISH"] + members
+        self.members = members
+        # Most confident first, so a finished answer wins over pages still to scrape
+        self.rules = sorted(rules.items(), key=lambda rule: rule[1], reverse=True)
+        self.threshold = threshold
+
+    def route(self, state: dict) -> Optional[dict]:
+        for name, confidence in self.rules:
+            if confidence < self.threshold:
+                continue
+            decision = ROUTING_RULES[name](state["messages"], self.members)
+            if decision is not None and set(next_workers(decision) or ["FINISH"]) <= set(self.options):
+                router_decisions.inc(path="rule", rule=name)
+                return {"next": decision}
+        router_decisions.inc(path="llm", rule="")
+        return None
+
+    def invoke(self, input, config=None, **kwargs):
+        return self.route(input) or self.supervisor.invoke(input, config, **kwargs)
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        return self.route(input) or await self.supervisor.ainvoke(input, config, **kwargs)
+
+
+def load_routing_rules() -> Dict[str, float]:
+    # SYMPHONY_ROUTER_RULES replaces the enabled rules and their confidences, e.g. {"urls_unscraped": 0.9}
+    configured = os.getenv("SYMPHONY_ROUTER_RULES")
+    rules = json.loads(configured) if configured else DEFAULT_RULE_CONFIDENCE
+    unknown = set(rules) - set(ROUTING_RULES)
+    if unknown:
+        raise ValueError(f"Unknown routing rules: {', '.join(sorted(unknown))}")
+    return rules
+
+
+def with_rule_router(supervisor: Runnable, members: List[str]) -> Runnable:
+    rules = load_routing_rules()
+    if not rules:
+        return supervisor
+    return RuleRouter(supervisor, members, rules, float(os.getenv("SYMPHONY_ROUTER_THRESHOLD", "0.8")))
+
+
+def create_team_supervisor(llm: "ChatOpenAI", system_prompt, members) -> str:
+    """An LLM-based router, behind the rule-based fast path."""
+    from langchain_core.output_parsers.openai_functions import JsonOutputFunctionsParser
+
     options = ["FINISH"] + members
     function_def = {
         "name": "route",
-        "description": "Select the next role.",
+        "description": "Select the next role, or several roles to work in parallel.",
         "parameters": {
             "title": "routeSchema",
             "type": "object",
@@ -285,6 +2714,7 @@ def create_team_supervisor(llm: ChatOpenAI, system_prompt, members) -> str:
                     "title": "Next",
                     "anyOf": [
                         {"enum": options},
+                        {"type": "array", "items": {"enum": members}, "minItems": 2, "uniqueItems": True},
                     ],
                 },
             },
@@ -298,14 +2728,17 @@ def create_team_supervisor(llm: ChatOpenAI, system_prompt, members) -> str:
             (
                 "system",
                 "Given the conversation above, who should act next?"
-                " Or should we FINISH? Select one of: {options}",
+                " Or should we FINISH? Select one of: {options}."
+                " If the request has independent parts for different workers, select a list"
+                " of those workers instead, and they will work on it at the same time.",
             ),
         ]
     ).partial(options=str(options), team_members=", ".join(members))
-    return (
-        prompt
-        | llm.bind_functions(functions=[function_def], function_call="route")
-        | JsonOutputFunctionsParser()
+    return with_rule_router(
+        with_history_compaction(prompt)
+        | with_response_cache(llm.bind_functions(functions=[function_def], function_call="route"))
+        | JsonOutputFunctionsParser(),
+        members,
     )
 
 # Research team graph state
@@ -316,65 +2749,30 @@ class ResearchTeamState(TypedDict):
     # the others' skill-sets
     team_members: List[str]
     # Used to route work. The supervisor calls a function
-    # that will update this every time it makes a decision
-    next: str
-
+    # that will update this every time it makes a decision.
+    # A list of workers runs them in parallel
+    next: Union[str, List[str]]
 
-llm = ChatOpenAI(model="gpt-4-turbo")
 
-search_agent = create_agent(
-    llm,
-    [tavily_tool],
-    "You are a research assistant who can search for up-to-date info using the tavily search engine.",
-)
-def should_ask_feedback(prompt):
-    keyword = "important"  # Change this to the desired keyword
+def should_ask_feedback(prompt, keyword="important"):
     return keyword in prompt.lower()
 
-async def conditional_search_node(state, agent, name):
-    if should_ask_feedback(state["messages"][0].content):
-        return await agent_node(state, agent, name, ask_human_feedback=True)
+async def conditional_agent_node(state, agent, name, feedback_keyword=None):
+    # Ask for approval when the user's request mentions the worker's feedback keyword
+    if feedback_keyword and should_ask_feedback(state["messages"][0].content, feedback_keyword):
+        return await agent_node(state, agent=agent, name=name, ask_human_feedback=True)
     else:
-        return await agent_node(state, agent, name, ask_human_feedback=False)
-
-search_node = functools.partial(conditional_search_node, agent=search_agent, name="Search")
-
-# search_node = functools.partial(agent_node, agent=search_agent, name="Search", ask_human_feedback=True)
-
-research_agent = create_agent(
-    llm,
-    [scrape_webpages],
-    "You are a research assistant who can scrape specified urls for more detailed information using the scrape_webpages function.",
-)
-research_node = functools.partial(agent_node, agent=research_agent, name="WebScraper", ask_human_feedback=False)
-
-supervisor_agent = create_team_supervisor(
-    llm,
-    "You are a supervisor tasked with managing a conversation between the"
-    " following workers:  Search, WebScraper. Given the following user request,"
-    " respond with the worker to act next. Each worker will perform a"
-    " task and respond with their results and status. When finished,"
-    " respond with FINISH.",
-    ["Search", "WebScraper"],
-)
-
-research_graph = StateGraph(ResearchTeamState)
-research_graph.add_node("Search", search_node)
-research_graph.add_node("WebScraper", research_node)
-research_graph.add_node("supervisor", supervisor_agent)
-
-# Define the control flow
-research_graph.add_edge("Search", "supervisor")
-research_graph.add_edge("WebScraper", "supervisor")
-research_graph.add_conditional_edges(
-    "supervisor",
-    lambda x: x["next"],
-    {"Search": "Search", "WebScraper": "WebScraper", "FINISH": END},
-)
+        return await agent_node(state, agent=agent, name=name, ask_human_feedback=False)
 
 
-research_graph.set_entry_point("supervisor")
-chain = research_graph.compile()
+async def supervisor_node(state, supervisor):
+    run = current_run.get()
+    if run.awaiting_approval:
+        park_for_approval(run)
+    with span("supervisor", node_seconds, {"node": "supervisor"}, run_id=run.run_id) as timing:
+        result = await supervisor.ainvoke(state)
+    run.supervisor_times.append(timing["duration"])
+    return result
 
 
 # The following functions interoperate between the top level graph state
@@ -387,34 +2785,534 @@ def enter_chain(message: str):
     return results
 
 
-research_chain = enter_chain | chain
+# model clients
+LLM_RETRY_BASE_DELAY = 0.5
+LLM_RETRY_MAX_DELAY = 20.0
 
-async def stream_time_elapsed(prompt: str):
-    global task_active, last_task_messages, agent_call_counts, agent_call_sequence
-    task_active = True
-    last_task_messages = []  # Reset the agent messages for the new task
-    agent_call_counts = {}  # Reset the agent call counts for the new task
-    agent_call_sequence = []  # Reset the agent call sequence for the new task
 
-    start_time = time.time()
+class ModelConfig(NamedTuple):
+    model: str
+    timeout: float  # Seconds before one request is abandoned
+    max_retries: int  # Retries after rate limits, timeouts, connection and server errors
+    max_concurrency: int  # Requests allowed in flight at once, before adapting to rate limits
+    fallback: Optional[str] = None  # Model to ask once the retries are used up
+
+
+def model_config(*specs) -> ModelConfig:
+    """Resolve a node's model settings from the team's then the node's `model` entry.
+
+    An entry is either a model name or a dict of `ModelConfig` fields, with the
+    model under `name`. Later entries override earlier ones.
+    """
+    config = DEFAULT_MODEL_CONFIG
+    for spec in specs:
+        if isinstance(spec, str):
+            config = config._replace(model=spec)
+        elif spec:
+            fields = dict(spec)
+            if "name" in fields:
+                fields["model"] = fields.pop("name")
+            config = config._replace(**fields)
+    return config
+
+
+DEFAULT_MODEL_CONFIG = ModelConfig(
+    model=os.getenv("SYMPHONY_LLM_MODEL", "gpt-4-turbo"),
+    timeout=float(os.getenv("SYMPHONY_LLM_TIMEOUT", "60")),
+    max_retries=int(os.getenv("SYMPHONY_LLM_MAX_RETRIES", "2")),
+    max_concurrency=int(os.getenv("SYMPHONY_LLM_MAX_CONCURRENCY", "8")),
+    fallback=os.getenv("SYMPHONY_LLM_FALLBACK_MODEL") or None,
+)
 
-    async for s in research_chain.astream(prompt, {"recursion_limit": 100}):
-        if "__end__" not in s:
-            print(s)
-            print("---")
-            current_time = time.time()
-            elapsed_time = current_time - start_time
-            print(f"Total elapsed time: {elapsed_time:.2f} seconds")
-            print()
-
-            # Store the agent messages
-            for key, value in s.items():
-                if isinstance(value, dict) and "messages" in value:
-                    for message in value["messages"]:
-                        last_task_messages.append(TaskResult(agent=key, message=message.content))
-                        agent_call_counts[key] = agent_call_counts.get(key, 0) + 1
-                        print(agent_call_counts[key])
-                        agent_call_sequence.append(key)
+
+class AdaptiveLimiter:
+    """Concurrency limit that backs off under rate limiting (AIMD).
+
+    The limit starts at `max_concurrency`. Each successful request raises it by
+    1/limit, about one slot per limit's worth of successes, up to the maximum.
+    Each rate limit error halves it, down to one request at a time.
+    """
+
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+    def succeeded(self) -> None:
+        self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+    def throttled(self) -> None:
+        self.limit = max(1.0, self.limit / 2)
+
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    """Seconds to wait before retrying: the server's Retry-After, else jittered exponential backoff."""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        return min(LLM_RETRY_MAX_DELAY, float(retry_after))
+    except (TypeError, ValueError):
+        return min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+@functools.lru_cache(maxsize=None)
+def pooled_chat_model() -> type:
+    """The `PooledChatOpenAI` class, defined on first use so importing the server skips the OpenAI client."""
+    import openai
+    from langchain_openai import ChatOpenAI
+
+    retryable_errors = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError,
+                        openai.InternalServerError)
+
+    class PooledChatOpenAI(ChatOpenAI):
+        """ChatOpenAI with adaptive concurrency, its own retries and a fallback model.
+
+        The OpenAI client's retries are turned off (`max_retries=0`) so rate limit
+        errors reach the limiter; `retries` takes their place. A request that still
+        fails goes to `fallback` once, as long as nothing was streamed yet. Only the
+        async paths are limited, the server never calls a model synchronously.
+        """
+
+        limiter: Any = None
+        retries: int = 0
+        fallback: Any = None
+
+        async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+            try:
+                return await self._agenerate_with_retries(messages, stop, run_manager, **kwargs)
+            except openai.APIError as error:
+                if self.fallback is None:
+                    raise
+                self.falling_back(error)
+                return await self.fallback._agenerate(messages, stop, run_manager, **kwargs)
+
+        async def _agenerate_with_retries(self, messages, stop=None, run_manager=None, **kwargs):
+            for attempt in itertools.count():
+                try:
+                    async with self.limiter.slot():
+                        result = await super()._agenerate(messages, stop, run_manager, **kwargs)
+                except retryable_errors as error:
+                    if attempt >= self.retries:
+                        raise
+                    await self.before_retry(error, attempt)
+                else:
+                    self.limiter.succeeded()
+                    return result
+
+        async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+            streamed = False
+            try:
+                async for chunk in self._astream_with_retries(messages, stop, run_manager, **kwargs):
+                    streamed = True
+                    yield chunk
+            except openai.APIError as error:
+                if self.fallback is None or streamed:
+                    raise
+                self.falling_back(error)
+                async for chunk in self.fallback._astream(messages, stop, run_manager, **kwargs):
+                    yield chunk
+
+        async def _astream_with_retries(self, messages, stop=None, run_manager=None, **kwargs):
+            for attempt in itertools.count():
+                streamed = False
+                try:
+                    async with self.limiter.slot():
+                        async for chunk in super()._astream(messages, stop, run_manager, **kwargs):
+                            streamed = True
+                            yield chunk
+                except retryable_errors as error:
+                    if streamed or attempt >= self.retries:
+                        raise
+                    await self.before_retry(error, attempt)
+                else:
+                    self.limiter.succeeded()
+                    return
+
+        async def before_retry(self, error: Exception, attempt: int) -> None:
+            if isinstance(error, openai.RateLimitError):
+                self.limiter.throttled()
+            llm_retries.inc(model=self.model_name, error=type(error).__name__)
+            await asyncio.sleep(retry_delay(error, attempt))
+
+        def falling_back(self, error: Exception) -> None:
+            print(f"{self.model_name} failed ({type(error).__name__}), falling back to {self.fallback.model_name}")
+            llm_fallbacks.inc(model=self.model_name, fallback=self.fallback.model_name)
+
+    return PooledChatOpenAI
+
+
+class ModelPool:
+    """Chat models for each distinct `ModelConfig`, sharing one pooled HTTP client.
+
+    Nodes with the same settings share a model and so its concurrency limit.
+    The HTTP clients are created with the first model.
+    """
+
+    def __init__(self, max_connections: int, max_keepalive: int):
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive)
+        self.models = {}
+        self.http_client = None
+        self.http_async_client = None
+
+    def get(self, config: ModelConfig) -> "ChatOpenAI":
+        if config not in self.models:
+            if self.http_async_client is None:
+                self.http_client = httpx.Client(limits=self.limits)
+                self.http_async_client = httpx.AsyncClient(limits=self.limits)
+            fallback = None
+            if config.fallback and config.fallback != config.model:
+                fallback = self.get(config._replace(model=config.fallback, fallback=None))
+            self.models[config] = pooled_chat_model()(
+                model=config.model,
+                request_timeout=config.timeout,
+                max_retries=0,
+                retries=config.max_retries,
+                limiter=AdaptiveLimiter(config.max_concurrency),
+                fallback=fallback,
+                http_client=self.http_client,
+                http_async_client=self.http_async_client,
+            )
+        return self.models[config]
+
+    def stats(self) -> List[dict]:
+        return [
+            {"model": config.model, "limit": round(model.limiter.limit, 2), "max_concurrency": config.max_concurrency,
+             "in_flight": model.limiter.in_flight, "fallback": config.fallback}
+            for config, model in self.models.items()
+        ]
+
+    async def close(self) -> None:
+        if self.http_async_client is not None:
+            await self.http_async_client.aclose()
+            self.http_client.close()
+            self.http_async_client = self.http_client = None
+        self.models.clear()
+
+
+model_pool = ModelPool(
+    max_connections=int(os.getenv("SYMPHONY_LLM_MAX_CONNECTIONS", "100")),
+    max_keepalive=int(os.getenv("SYMPHONY_LLM_MAX_KEEPALIVE", "20")),
+)
+
+
+# team graphs
+TOOL_FACTORIES: Dict[str, Callable[[], BaseTool]] = {
+    "tavily_search": lambda: CachedTavilySearchResults(max_results=5),
+    "scrape_webpages": lambda: scrape_webpages,
+    "create_outline": lambda: create_outline,
+    "read_document": lambda: read_document,
+    "write_document": lambda: write_document,
+    "edit_document": lambda: edit_document,
+    "python_repl": lambda: python_repl,
+}
+
+DEFAULT_SUPERVISOR_PROMPT = (
+    "You are a supervisor tasked with managing a conversation between the"
+    " following workers:  {team_members}. Given the following user request,"
+    " respond with the worker to act next. Each worker will perform a"
+    " task and respond with their results and status. When finished,"
+    " respond with FINISH."
+)
+
+DEFAULT_TEAMS = {
+    "research": {
+        "supervisor": {"prompt": DEFAULT_SUPERVISOR_PROMPT},
+        "workers": {
+            "Search": {
+                "tools": ["tavily_search"],
+                "prompt": "You are a research assistant who can search for up-to-date info using the tavily search engine.",
+                "feedback_keyword": "important",
+            },
+            "WebScraper": {
+                "tools": ["scrape_webpages"],
+                "prompt": "You are a research assistant who can scrape specified urls for more detailed information using the scrape_webpages function.",
+            },
+        },
+    },
+}
+
+
+class TeamGraph(NamedTuple):
+    name: str
+    members: List[str]
+    graph: Runnable  # Compiled graph, takes {"messages": [...]}
+    entry: Runnable  # The graph behind `enter_chain`, takes the prompt
+
+
+def load_team_specs() -> Dict[str, dict]:
+    """The built-in teams plus any defined in SYMPHONY_TEAMS_PATH, validated without building anything."""
+    specs = dict(DEFAULT_TEAMS)
+    path = os.getenv("SYMPHONY_TEAMS_PATH")
+    if path:
+        specs.update(json.loads(Path(path).read_text()))
+    for team, spec in specs.items():
+        if not spec.get("workers"):
+            raise ValueError(f"Team {team} has no workers")
+        for worker, worker_spec in spec["workers"].items():
+            if worker in ("supervisor", "FINISH"):
+                raise ValueError(f"Team {team} cannot have a worker named {worker}")
+            unknown = set(worker_spec.get("tools", [])) - set(TOOL_FACTORIES)
+            if unknown:
+                raise ValueError(f"Unknown tools for {team}/{worker}: {', '.join(sorted(unknown))}")
+            if "prompt" not in worker_spec:
+                raise ValueError(f"Worker {team}/{worker} has no prompt")
+        for node in [spec.get("supervisor", {}), *spec["workers"].values()]:
+            model_config(spec.get("model"), node.get("model"))  # Raises on unknown settings
+    return specs
+
+
+class TeamRegistry:
+    """Team graphs built from their declarative spec on first use, then cached.
+
+    Building a team creates its models, tools, agents and supervisor and
+    compiles its graph. Models come from `model_pool` and tools are shared
+    between teams that use the same ones. Nothing is built at import, so the server starts without
+    touching any team it is not asked to run.
+    """
+
+    def __init__(self, specs: Dict[str, dict]):
+        self.specs = specs
+        self.graphs = {}
+        self.tools = {}
+        self.lock = threading.Lock()  # Teams can be built from a warm-up thread and the event loop at once
+
+    def get_tool(self, name: str) -> BaseTool:
+        if name not in self.tools:
+            self.tools[name] = TOOL_FACTORIES[name]()
+        return self.tools[name]
+
+    def get(self, team: str) -> TeamGraph:
+        graph = self.graphs.get(team)
+        if graph is None:
+            with self.lock:
+                graph = self.graphs.get(team)
+                if graph is None:
+                    graph = self.graphs[team] = self.build(team, self.specs[team])
+        return graph
+
+    def build(self, team: str, spec: dict) -> TeamGraph:
+        members = list(spec["workers"])
+        team_graph = StateGraph(ResearchTeamState)
+        for worker, worker_spec in spec["workers"].items():
+            agent = create_agent(
+                model_pool.get(model_config(spec.get("model"), worker_spec.get("model"))),
+                [self.get_tool(name) for name in worker_spec.get("tools", [])],
+                worker_spec["prompt"],
+            )
+            team_graph.add_node(worker, functools.partial(
+                conditional_agent_node, agent=agent, name=worker, feedback_keyword=worker_spec.get("feedback_keyword"),
+            ))
+            team_graph.add_edge(worker, "supervisor")
+        supervisor_spec = spec.get("supervisor", {})
+        supervisor = create_team_supervisor(
+            model_pool.get(model_config(spec.get("model"), supervisor_spec.get("model"))),
+            supervisor_spec.get("prompt", DEFAULT_SUPERVISOR_PROMPT),
+            members,
+        )
+        team_graph.add_node("supervisor", functools.partial(supervisor_node, supervisor=supervisor))
+
+        # Define the control flow
+        team_graph.add_conditional_edges("supervisor", route_next, {**{m: m for m in members}, "FINISH": END})
+        team_graph.set_entry_point("supervisor")
+        compiled = team_graph.compile()
+        return TeamGraph(team, members, compiled, enter_chain | compiled)
+
+
+team_registry = TeamRegistry(load_team_specs())
+DEFAULT_TEAM = os.getenv("SYMPHONY_DEFAULT_TEAM", "research")
+
+def step_payload(value) -> dict:
+    """JSON-safe form of a graph step's output for the run store."""
+    if isinstance(value, dict) and "messages" in value:
+        return {"messages": [{"name": message.name, "content": message.content} for message in value["messages"]]}
+    return value if isinstance(value, dict) else {"value": value}
+
+
+def record_messages(run: RunState, agent: str, messages: List[BaseMessage]) -> None:
+    """Account for the messages a worker added to the conversation."""
+    for message in messages:
+        run.messages.append(TaskResult(agent=agent, message=message.content))
+        run.agent_call_counts[agent] = run.agent_call_counts.get(agent, 0) + 1
+        run.agent_call_sequence.append(agent)
+    run.graph.update(
+        agent,
+        status='success',
+        timeElapsed=run.agent_times[agent][-1] if agent in run.agent_times else 0.0,
+        number_calls=run.agent_call_counts.get(agent, 0),
+    )
+
+
+def run_conversation(run: RunState) -> List[BaseMessage]:
+    """The graph's message state so far: the prompt followed by every worker message."""
+    return [HumanMessage(content=run.prompt)] + [
+        HumanMessage(content=result.message, name=result.agent) for result in run.messages
+    ]
+
+
+def restore_run(record: dict, steps: List[dict]) -> RunState:
+    """Rebuild an interrupted run from the store so it can continue where it stopped."""
+    run = RunState(record["run_id"], record["prompt"], structure_cache.node_dicts(), priority=record["priority"],
+                   team=record["team"], budget=RunBudget(**record["budget"]) if record["budget"] else DEFAULT_RUN_BUDGET)
+    # The budget carries on from what the run spent before, so resuming never resets it
+    run.usage.update(record["usage"] or {})
+    run.created_at = record["created_at"]
+    run.status = record["status"]
+    for step in steps:
+        run.step_seq = step["seq"]
+        if "messages" in step["payload"]:
+            record_messages(run, step["node"], [
+                HumanMessage(content=message["content"], name=message["name"])
+                for message in step["payload"]["messages"]
+            ])
+    run.resume_messages = run_conversation(run)
+    return run
+
+
+GRAPH_RUN_NAME = "symphony_run"
+TOOL_OUTPUT_PREVIEW = 2000  # Characters of tool output sent to token stream clients
+
+
+async def stream_graph_events(run: RunState, graph: Runnable, graph_input, config: dict):
+    """Yield the graph's steps like `astream`, and forward tokens and tool calls to the run's token stream.
+
+    Streaming events also makes the chat models stream their responses, even
+    though the agents call them with `ainvoke`.
+    """
+    events = graph.astream_events(
+        graph_input, {**config, "run_name": GRAPH_RUN_NAME}, version="v1",
+        include_names=[GRAPH_RUN_NAME], include_types=["chat_model", "tool"],
+    )
+    async for event in events:
+        kind = event["event"]
+        if event["name"] == GRAPH_RUN_NAME:
+            if kind == "on_chain_stream":
+                yield event["data"]["chunk"]
+            continue
+        agent = event["metadata"].get("agent")
+        if agent is None:
+            continue  # The supervisor only streams its routing function call
+        if kind == "on_chat_model_stream" and event["data"]["chunk"].content:
+            token_broadcaster.publish("token", run.run_id, agent=agent, text=event["data"]["chunk"].content)
+        elif kind == "on_tool_start":
+            token_broadcaster.publish("tool_start", run.run_id, agent=agent, tool=event["name"],
+                                      input=event["data"].get("input"))
+        elif kind == "on_tool_end":
+            output = str(event["data"].get("output", ""))
+            token_broadcaster.publish("tool_end", run.run_id, agent=agent, tool=event["name"],
+                                      output=output[:TOOL_OUTPUT_PREVIEW], truncated=len(output) > TOOL_OUTPUT_PREVIEW)
+
+
+async def until_stopped(run: RunState, steps: Awaitable) -> None:
+    """Await `steps` unless the run's stop_event is set first, which cancels them.
+
+    The steps run in a task of their own so that cancelling them interrupts the
+    graph node in flight, while the run's task carries on to wrap up. Streaming
+    events waits for the graph to end instead, which `BudgetTracker` makes
+    happen at the next model call, token or tool call.
+    """
+    work = asyncio.ensure_future(steps)
+    stopped = asyncio.ensure_future(run.stop_event.wait())
+    try:
+        await asyncio.wait({work, stopped}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        stopped.cancel()
+        if not work.done():
+            work.cancel()
+            await asyncio.gather(work, return_exceptions=True)
+    if not work.cancelled() and run.stop_reason is None:
+        work.result()
+
+
+async def stream_time_elapsed(run: RunState):
+    current_run.set(run)
+    run.task_active = True
+    prompt = run.prompt
+
+    start_time = time.time()
+    run.publish("task_start", prompt=prompt)
+
+    config = {"recursion_limit": 100, "callbacks": [metrics_callback, BudgetTracker(run)]}
+    team = team_registry.graphs.get(run.team)
+    if team is None:
+        # Building takes seconds, or waits for the warm-up thread building it, so keep it off the event loop
+        team = await asyncio.to_thread(team_registry.get, run.team)
+    if run.resume_messages:
+        # The supervisor is the entry point and runs after every worker, so starting
+        # the graph over with the conversation so far picks up after the last completed node
+        graph, graph_input = team.graph, {"messages": run.resume_messages}
+    else:
+        graph, graph_input = team.entry, prompt
+    if run.stream_tokens:
+        stream = stream_graph_events(run, graph, graph_input, config)
+    else:
+        stream = graph.astream(graph_input, config)
+
+    counted_until = start_time  # The run time up to here is already in usage["seconds"]
+
+    def count_seconds():
+        nonlocal counted_until
+        now = time.time()
+        run.usage["seconds"] += now - counted_until
+        counted_until = now
+
+    async def consume_steps():
+        async for s in stream:
+            if "__end__" not in s:
+                print(s)
+                print("---")
+                current_time = time.time()
+                elapsed_time = current_time - start_time
+                print(f"Total elapsed time: {elapsed_time:.2f} seconds")
+                print()
+
+                # Store the agent messages
+                for key, value in s.items():
+                    if key in run.awaiting_approval:
+                        continue  # Recorded as a step of its own once approved
+                    run.step_seq += 1
+                    run_store.add_step(run.run_id, run.step_seq, key, step_payload(value))
+                    if isinstance(value, dict) and "messages" in value:
+                        record_messages(run, key, value["messages"])
+                        print(run.agent_call_counts[key])
+                        run.publish(
+                            "agent_finish",
+                            agent=key,
+                            elapsed_time=run.agent_times[key][-1] if key in run.agent_times else 0.0,
+                            call_count=run.agent_call_counts.get(key, 0),
+                        )
+                    elif isinstance(value, dict) and value.get("next") is not None:
+                        # The supervisor has routed to one or more workers, which start right away
+                        for worker in next_workers(value["next"]):
+                            run.publish(
+                                "agent_start",
+                                agent=worker,
+                                call_count=run.agent_call_counts.get(worker, 0),
+                            )
+                count_seconds()
+                run_store.save_run(run)  # A restart resumes the run with what it has spent so far
+
+    remaining = None if run.budget.max_seconds is None else run.budget.max_seconds - run.usage["seconds"]
+    deadline = None if remaining is None else asyncio.get_running_loop().call_later(
+        max(0.0, remaining), request_stop, run, "max_seconds")
+    try:
+        await until_stopped(run, consume_steps())
+    finally:
+        if deadline is not None:
+            deadline.cancel()
+        count_seconds()
 
     end_time = time.time()
     execution_time = end_time - start_time
@@ -422,18 +3320,25 @@ async def stream_time_elapsed(prompt: str):
     print(f"Total execution time: {execution_time:.2f} seconds")
     print("Agent execution times:")
     total_agent_time = 0
-    for agent, times in agent_times.items():
+    for agent, times in run.agent_times.items():
         total_time = sum(times)
         print(f"{agent}: {total_time:.2f} seconds (calls: {len(times)})")
         for i, time_taken in enumerate(times, start=1):
             print(f"  Call {i}: {time_taken:.2f} seconds")
         total_agent_time += total_time
 
-    supervisor_time = execution_time - total_agent_time
-    print(f"Supervisor: {supervisor_time:.2f} seconds")
-
-    stop_event.set()  # Signal the print_elapsed_times coroutine to stop
-    task_active = False
+    supervisor_time = sum(run.supervisor_times)
+    print(f"Supervisor: {supervisor_time:.2f} seconds (calls: {len(run.supervisor_times)})")
+    print(f"Graph overhead: {execution_time - total_agent_time - supervisor_time:.2f} seconds")
+
+    run.stop_event.set()  # Signal anything waiting on this run that it is done
+    run.task_active = False
+    run.publish(
+        "task_end",
+        execution_time=execution_time,
+        supervisor_time=supervisor_time,
+        call_counts=run.agent_call_counts,
+    )
 
 # @app.on_event("startup")
 # async def startup_event():
@@ -442,21 +3347,104 @@ async def stream_time_elapsed(prompt: str):
 #         global data
 #         data = json.load(file)
 
-with open('cleaned_structure.json', 'r') as file:
-    global data
-    data = json.load(file)
+class AgentNodeData(BaseModel):
+    label: str
+    status: str = "pending"
+    timeElapsed: float = 0.0
+
+    model_config = ConfigDict(extra="allow")
+
+class AgentNode(BaseModel):
+    id: Union[str, int]
+    data: AgentNodeData
+
+    model_config = ConfigDict(extra="allow")
+
+
+class StructureCache:
+    """The graph structure from cleaned_structure.json, parsed and validated once.
+
+    The app's startup hook loads it off the event loop, and `watch` polls the file and reloads it only when its inode, mtime or size
+    changes. A reload builds the new node tuple completely before swapping it
+    in with a single assignment, so readers see either the old or the new
+    graph, never a partial one. An invalid file keeps the previous graph.
+    """
+
+    def __init__(self, path: str, poll_interval: float):
+        self.path = Path(path)
+        self.poll_interval = poll_interval
+        self.snapshot = (None, ())  # (file identity, validated nodes), swapped atomically
+        self.rejected = None  # Identity of the last version of the file that failed to load
+
+    def load(self) -> bool:
+        stat = self.path.stat()
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if identity in (self.snapshot[0], self.rejected):
+            return False
+        try:
+            nodes = tuple(AgentNode.model_validate(node) for node in json.loads(self.path.read_text()))
+        except Exception:
+            self.rejected = identity
+            raise
+        self.snapshot = (identity, nodes)
+        return True
+
+    def node_dicts(self) -> List[dict]:
+        """Fresh, mutable copies of the nodes for a run to track its status in."""
+        return [node.model_dump() for node in self.snapshot[1]]
+
+    async def watch(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                if await asyncio.to_thread(self.load):
+                    print(f"Reloaded graph structure from {self.path}")
+            except Exception as e:
+                print(f"Keeping the previous graph structure, reloading {self.path} failed: {e!r}")
+
+
+structure_cache = StructureCache(
+    path=os.getenv("SYMPHONY_STRUCTURE_PATH", "cleaned_structure.json"),
+    poll_interval=float(os.getenv("SYMPHONY_STRUCTURE_POLL_INTERVAL", "2")),
+)
+structure_watcher = None  # Task polling the structure file, started with the app
+state_syncer = None  # Task saving run snapshots for the other workers, with a shared state backend
 
 @app.post("/run_agent_stream")
 async def run_agent_stream(request: PromptRequest):
-    with open('cleaned_structure.json', 'r') as file:
-        global data
-        data = json.load(file)
-    prompt = request.prompt
-    asyncio.ensure_future(stream_time_elapsed(prompt))
-    return {"message": "Agent stream started"}
+    if request.team is not None and request.team not in team_registry.specs:
+        raise HTTPException(status_code=404, detail=f"Team {request.team} not found")
+    run = register_run(request.prompt, priority=request.priority, feedback_timeout=request.feedback_timeout,
+                       feedback_default=request.feedback_default, stream_tokens=request.stream_tokens,
+                       team=request.team, budget=run_budget(**request.budget.model_dump()))
+    try:
+        scheduler.submit(run)
+    except SchedulerFull as e:
+        del runs[run.run_id]
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "5"})
+    if state_backend.shared:
+        # Saved right away so the client's next request finds the run whichever worker it reaches
+        try:
+            await state_backend.save_runs([run_snapshot(run)])
+        except Exception as e:
+            print(f"Could not save run {run.run_id}: {e!r}")
+    if run.status == "queued":
+        return {"message": "Agent stream queued", "run_id": run.run_id,
+                "queue_position": scheduler.queue_position(run.run_id)}
+    return {"message": "Agent stream started", "run_id": run.run_id}
 
 @app.get("/agent_status", response_model=AgentStatus)
-async def get_agent_status():
+async def get_agent_status(run_id: Optional[str] = None, since: Optional[int] = None):
+    """Status of a run. With `since`, `data` only holds the nodes changed after that version."""
+    run = await get_run(run_id)
+    if run is None:
+        return AgentStatus(
+            message="No task has been run yet. Please submit a POST request to /run_agent_stream to start a new task.",
+            data=structure_cache.node_dicts(),
+        )
+    return agent_status(run, since)
+
+def agent_status(run: RunState, since: Optional[int] = None) -> AgentStatus:
     current_agent = ""
     elapsed_time = 0.0
     message = ""
@@ -464,61 +3452,326 @@ async def get_agent_status():
     prior_agents = []
     human_feedback_requested = False
 
-    if not task_active:
+    if not run.task_active:
         # Find the last completed agent
-        for agent in reversed(agent_call_sequence):
-            if agent_completed.get(agent, False):
+        for agent in reversed(run.agent_call_sequence):
+            if run.agent_completed.get(agent, False):
                 current_agent = agent
-                elapsed_time = agent_times[agent][-1] if agent in agent_times else 0.0
-                current_agent_call_count = agent_call_counts.get(current_agent, 0)
+                elapsed_time = run.agent_times[agent][-1] if agent in run.agent_times else 0.0
+                current_agent_call_count = run.agent_call_counts.get(current_agent, 0)
                 break
-
-        if not current_agent:
-            message = "No task has been run yet. Please submit a POST request to /run_agent_stream to start a new task."
     else:
         current_time = time.time()
-        for agent, start_time in agent_start_times.items():
-            if not agent_completed.get(agent, True):  # Check if the agent has not completed
+        for agent, start_time in run.agent_start_times.items():
+            if not run.agent_completed.get(agent, True):  # Check if the agent has not completed
                 current_agent = agent
                 elapsed_time = current_time - start_time
-                current_agent_call_count = agent_call_counts.get(current_agent, 0)
-                updated_agent = update_elapsed_time(data, current_agent, elapsed_time)
+                current_agent_call_count = run.agent_call_counts.get(current_agent, 0)
+                # number_calls is kept up to date by the run loop, only the running agent changes here
+                updated_agent = run.graph.update(current_agent, timeElapsed=elapsed_time, status='running')
                 if updated_agent is None:
                     raise HTTPException(status_code=404, detail="Agent not found")
-                
-                # Update the number_calls payload for each agent
-                for agent_data in data:
-                    if agent_data['data']['label'] in agent_call_counts:
-                        agent_data['data']['number_calls'] = agent_call_counts[agent_data['data']['label']]
-                    else:
-                        agent_data['data']['number_calls'] = 0
-                
                 break
 
     prior_agents = []
-    for agent in agent_call_sequence:
+    for agent in run.agent_call_sequence:
         if agent != current_agent:
             prior_agents.append({
                 "agent": agent,
-                "call_count": agent_call_counts.get(agent, 0)
+                "call_count": run.agent_call_counts.get(agent, 0)
             })
         else:
             break
     
-    # Check if any agent needs human feedback
-    for agent in human_feedback_needed:
-        if agent == current_agent:
-            message = human_feedback_needed[agent]["message"]
+    # Check if any agent needs human feedback, a parked run is waiting on the agent that asked
+    for agent in run.human_feedback_needed:
+        if agent == current_agent or run.status == "parked":
+            current_agent = agent
+            message = run.human_feedback_needed[agent]["message"]
             human_feedback_requested = True
             break
 
-    return AgentStatus(current_agent=current_agent, elapsed_time=elapsed_time, task_active=task_active, message=message,
-                       current_agent_call_count=current_agent_call_count, prior_agents=prior_agents, data=data,
-                       human_feedback_requested=human_feedback_requested)
+    return AgentStatus(run_id=run.run_id, current_agent=current_agent, elapsed_time=elapsed_time,
+                       task_active=run.task_active, message=message,
+                       current_agent_call_count=current_agent_call_count, prior_agents=prior_agents,
+                       data=run.graph.nodes if since is None else run.graph.changes_since(since),
+                       version=run.graph.version, human_feedback_requested=human_feedback_requested)
+
+def format_sse(event: dict) -> str:
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+@app.get("/agent_status/stream")
+async def stream_agent_status(request: Request, run_id: Optional[str] = None):
+    """Push agent status over Server-Sent Events instead of polling /agent_status.
+
+    The first event is a full `snapshot` of the current status (including the
+    node list); every following event is a small delta emitted from the run loop.
+    Without a `run_id` the stream follows every run.
+    """
+    queue = status_broadcaster.subscribe(run_id)
+
+    async def event_stream():
+        try:
+            snapshot = await get_agent_status(run_id)
+            yield format_sse({"type": "snapshot", "timestamp": time.time(), **snapshot.model_dump()})
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=STATUS_STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_sse(event)
+        finally:
+            status_broadcaster.unsubscribe(queue)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/runs/{run_id}/stream")
+async def stream_run_tokens(request: Request, run_id: str):
+    """Stream a run's model tokens and tool calls over Server-Sent Events as they happen.
+
+    Only runs started with `stream_tokens` produce `token`, `tool_start` and
+    `tool_end` events. The stream ends with an `end` event once the run stops
+    running, or with `dropped` if the client reads too slowly to keep up.
+    """
+    run = await get_run(run_id)
+    queue = token_broadcaster.subscribe(run_id)
+
+    async def event_stream():
+        try:
+            if run.status in FINISHED_STATUSES or run.status == "parked":
+                yield format_sse({"type": "end", "run_id": run_id, "timestamp": time.time(), "status": run.status})
+                return
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=STATUS_STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_sse(event)
+                if event["type"] in ("end", "dropped"):
+                    return
+        finally:
+            token_broadcaster.unsubscribe(run_id, queue)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 @app.get("/last_task_results", response_model=List[TaskResult])
-async def get_last_task_results():
-    return last_task_messages
+async def get_last_task_results(run_id: Optional[str] = None):
+    run = await get_run(run_id)
+    return run.messages if run else []
+
+def describe_run(run: RunState) -> dict:
+    return {
+        "run_id": run.run_id,
+        "prompt": run.prompt,
+        "team": run.team,
+        "status": run.status,
+        "priority": run.priority,
+        "queue_position": scheduler.queue_position(run.run_id) if run.worker == WORKER_ID else run.reported_queue_position,
+        "task_active": run.task_active,
+        "created_at": run.created_at,
+        "started_at": run.started_at,
+        "error": run.error,
+        "stop_reason": run.stop_reason,
+        "budget": run.budget._asdict(),
+        "usage": run.usage,
+    }
+
+@app.on_event("startup")
+async def start_repl_workers():
+    # Spawning the worker interpreters takes a while, keep that off the event loop
+    await asyncio.to_thread(repl_pool.start)
+
+@app.on_event("startup")
+async def prebuild_teams():
+    # Build the teams expected to run first off the event loop, so the server
+    # accepts requests right away and the first run does not pay for the build
+    teams = os.getenv("SYMPHONY_PREBUILD_TEAMS", DEFAULT_TEAM)
+    for team in filter(None, (name.strip() for name in teams.split(","))):
+        asyncio.ensure_future(asyncio.to_thread(team_registry.get, team))
+
+@app.on_event("startup")
+async def share_run_state():
+    global state_syncer
+    await state_backend.start(receive_shared_message)
+    if state_backend.shared:
+        state_syncer = asyncio.ensure_future(sync_shared_runs())
+
+@app.on_event("startup")
+async def watch_graph_structure():
+    # Runs copy the nodes when they are registered, load them before the first one
+    global structure_watcher
+    await asyncio.to_thread(structure_cache.load)
+    structure_watcher = asyncio.ensure_future(structure_cache.watch())
+
+async def take_over_run(record: dict) -> bool:
+    """Make this worker the owner of a stored run, False while another live worker still owns it."""
+    owner = record["worker"]
+    # A run's owner with this worker's ID is a previous process that had the same host and PID
+    if (owner not in (None, WORKER_ID) and record["status"] not in FINISHED_STATUSES + ("interrupted",)
+            and await state_backend.is_live(owner)):
+        return False
+    # Workers starting together share the run store, only one of them gets the run
+    return await asyncio.to_thread(run_store.take_over, record["run_id"], owner)
+
+@app.on_event("startup")
+async def interrupt_orphaned_runs():
+    # Runs whose worker stopped while they were queued or running can no longer finish on their own,
+    # those of workers still running are left to them
+    live = {}
+    orphaned = []
+    for record in await asyncio.to_thread(run_store.active_runs):
+        owner = record["worker"]
+        if owner not in live:
+            live[owner] = owner not in (None, WORKER_ID) and await state_backend.is_live(owner)
+        if not live[owner]:
+            orphaned.append((record["run_id"], owner))
+    await asyncio.to_thread(run_store.interrupt_runs, orphaned)
+
+@app.on_event("startup")
+async def restore_parked_runs():
+    # Runs parked for approval by a stopped worker wait again here, with their original deadlines
+    for approval in await asyncio.to_thread(run_store.pending_approvals):
+        run = runs.get(approval["run_id"])
+        if run is None:
+            record = await asyncio.to_thread(run_store.get_run, approval["run_id"])
+            if not await take_over_run(record):
+                continue
+            run = restore_run(record, await asyncio.to_thread(run_store.get_steps, approval["run_id"]))
+            runs[run.run_id] = run
+            if run.run_id in workspaces.ended:
+                # Its documents are still needed, keep them out of quota cleanup
+                await asyncio.to_thread(workspaces.get, run.run_id)
+        arm_approval(run, approval["agent"], approval)
+
+@app.on_event("shutdown")
+async def release_shared_resources():
+    if structure_watcher is not None:
+        structure_watcher.cancel()
+    if state_syncer is not None:
+        state_syncer.cancel()
+    await state_backend.close()
+    await page_fetcher.close()
+    await model_pool.close()
+    tool_executor.shutdown()
+    repl_pool.shutdown()
+    await asyncio.to_thread(run_store.close)
+    if tracer_provider is not None:
+        await asyncio.to_thread(tracer_provider.shutdown)
+
+@app.get("/cache_stats")
+async def get_cache_stats():
+    return {
+        "llm": response_cache.stats() if response_cache is not None else None,
+        "search": search_cache.stats(),
+        "scrape": page_fetcher.stats(),
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/teams")
+async def list_teams():
+    return [
+        {"name": name, "workers": list(spec["workers"]), "built": name in team_registry.graphs}
+        for name, spec in team_registry.specs.items()
+    ]
+
+@app.get("/models")
+async def list_models():
+    return model_pool.stats()
+
+@app.get("/runs")
+async def list_runs():
+    listed = {run.run_id: run for run in runs.values()}
+    if state_backend.shared:
+        for snapshot in await state_backend.list_runs(MAX_FINISHED_RUNS):
+            local = runs.get(snapshot["run_id"])
+            if snapshot["worker"] != WORKER_ID and (local is None or local.status in FINISHED_STATUSES):
+                listed[snapshot["run_id"]] = run_from_snapshot(snapshot)
+    return [describe_run(run) for run in sorted(listed.values(), key=lambda run: run.created_at)]
+
+@app.get("/runs/{run_id}")
+async def get_run_details(run_id: str):
+    return describe_run(await get_run(run_id))
+
+@app.post("/runs/{run_id}/resume")
+async def resume_run(run_id: str):
+    """Continue an interrupted or failed run from its last completed graph step."""
+    if run_id in runs and runs[run_id].status not in FINISHED_STATUSES:
+        raise HTTPException(status_code=409, detail=f"Run {run_id} is already {runs[run_id].status}")
+    snapshot = await state_backend.load_run(run_id)
+    if snapshot is not None and snapshot["worker"] != WORKER_ID and snapshot["status"] not in FINISHED_STATUSES:
+        raise HTTPException(status_code=409, detail=f"Run {run_id} is already {snapshot['status']} on another worker")
+    await asyncio.to_thread(run_store.flush)
+    record = await asyncio.to_thread(run_store.get_run, run_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail=f"Run {run_id} not found")
+    if record["status"] == "finished":
+        raise HTTPException(status_code=409, detail=f"Run {run_id} already finished")
+    if record["status"] == "stopped":
+        raise HTTPException(status_code=409, detail=f"Run {run_id} used up its {record['stop_reason']} budget")
+    if not await take_over_run(record):
+        raise HTTPException(status_code=409, detail=f"Run {run_id} is already {record['status']} on another worker")
+    run = restore_run(record, await asyncio.to_thread(run_store.get_steps, run_id))
+    runs.pop(run_id, None)
+    runs[run_id] = run
+    try:
+        scheduler.submit(run)
+    except SchedulerFull as e:
+        del runs[run_id]
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "5"})
+    return {"message": f"Resuming run {run_id} after step {run.step_seq}", "run_id": run_id}
+
+@app.get("/run_history")
+async def get_run_history(limit: int = 20, before: Optional[float] = None):
+    """Past runs from the run store, newest first, paged with `before`."""
+    page = await asyncio.to_thread(run_store.list_runs, min(limit, 100), before)
+    return {"runs": page, "next_before": page[-1]["created_at"] if len(page) == min(limit, 100) else None}
+
+@app.get("/run_history/{run_id}")
+async def get_run_history_details(run_id: str):
+    record = await asyncio.to_thread(run_store.get_run, run_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail=f"Run {run_id} not found")
+    return {**record, "steps": await asyncio.to_thread(run_store.get_steps, run_id)}
+
+def cancel_owned_run(run: RunState) -> bool:
+    """Cancel a run executing on this worker, False if it already stopped."""
+    if run.status == "parked":
+        for agent, approval in list(run.human_feedback_needed.items()):
+            approval["timer"].cancel()
+            run_store.resolve_approval(run.run_id, agent, "cancelled")
+        run.human_feedback_needed.clear()
+        request_stop(run, "cancelled")
+        run.publish("task_cancelled")
+        finish_run(run, "cancelled")
+        return True
+    return scheduler.cancel(run.run_id)
+
+@app.post("/runs/{run_id}/cancel")
+async def cancel_run(run_id: str):
+    """Cancel a queued, running or parked run.
+
+    A running run cancels the node in flight and keeps the steps it completed,
+    which `/last_task_results` still returns. Its `stop_reason` is `cancelled`.
+    """
+    run = await get_run(run_id)
+    if run.worker != WORKER_ID and run.status not in FINISHED_STATUSES:
+        state_backend.publish({"channel": "signal", "type": "cancel", "run_id": run_id})
+    elif run.worker != WORKER_ID or not cancel_owned_run(run):
+        raise HTTPException(status_code=409, detail=f"Run {run_id} is already {run.status}")
+    return {"message": f"Cancelling run {run_id}", "run_id": run_id}
 
 import json
 from fastapi import FastAPI, HTTPException
@@ -534,41 +3787,25 @@ import requests
 #         global data
 #         data = json.load(file)
 
-def reset_agents(agents):
-    for agent in agents:
-        agent['data']['timeElapsed'] = 0.0
-        if agent['data']['num iters'] > 0:
-            agent['data']['status'] = 'success'
-        else:
-            agent['data']['status'] = 'pending'
-    return agents
-
-def update_elapsed_time(agents, agent_label, new_elapsed_time):
-    for agent in agents:
-        if agent['data']['label'] == agent_label:
-            agent['data']['timeElapsed'] = new_elapsed_time
-            agent['data']['status'] = 'running'
-            return agent  # Return the updated agent for confirmation
-    return None
-
 @app.get("/update_agent")
-async def update_agent():
+async def update_agent(run_id: Optional[str] = None):
     try:
-        # Call get_agent_status asynchronously and wait for its result
-        status_data = await get_agent_status()
-        current_agent = status_data.current_agent
-        elapsed_time = status_data.elapsed_time
-        
-        # Update elapsed time
-        updated_agent = update_elapsed_time(data, current_agent, elapsed_time)
-        if updated_agent is None:
+        run = await get_run(run_id)
+        if run is None:
+            raise HTTPException(status_code=404, detail="Agent not found")
+        # agent_status moves the running agent's elapsed time forward
+        status_data = agent_status(run)
+        if run.graph.index.get(status_data.current_agent) is None:
             raise HTTPException(status_code=404, detail="Agent not found")
         
-        # Optionally save the updated data to a file (or omit if not needed)
-        with open('updated_agents.json', 'w') as file:
-            json.dump(data, file)
+        # Only rewrite the file when something changed, re-serializing just the changed nodes
+        if run.graph.serialized_version != run.graph.version:
+            content = run.graph.to_json()
+            await asyncio.to_thread(Path('updated_agents.json').write_text, content)
         
-        return JSONResponse(status_code=200, content=data)
+        return JSONResponse(status_code=200, content=run.graph.nodes)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
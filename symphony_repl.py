@@ -0,0 +1,43 @@
+"""Worker side of symphony_api's `python_repl` tool.
+
+Each REPL worker is a fresh interpreter started with `python -m symphony_repl
+<fd> <memory limit>`, so it does not inherit the server's memory, threads or
+open files, and never imports the module the server was started from. This
+module is all a worker imports besides matplotlib and the REPL itself, keep it
+free of symphony_api.
+"""
+import resource
+import sys
+from multiprocessing.connection import Connection
+from typing import Optional
+
+
+def repl_worker_main(conn, memory_limit: Optional[int]) -> None:
+    """Serve (session_id, code) requests over `conn`, one PythonREPL per session."""
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    import matplotlib
+    matplotlib.use("Agg")
+    from langchain_experimental.utilities import PythonREPL
+
+    sessions = {}
+    while True:
+        try:
+            session_id, code = conn.recv()
+        except EOFError:
+            return
+        if code is None:
+            # The run that owned this session has finished
+            sessions.pop(session_id, None)
+            continue
+        repl = sessions.setdefault(session_id, PythonREPL())
+        try:
+            result = repl.run(code)
+        except BaseException as e:
+            result = repr(e)
+        conn.send(result)
+
+
+if __name__ == "__main__":
+    # The server passes its end of a socket pair and the memory cap in bytes, 0 for none
+    repl_worker_main(Connection(int(sys.argv[1])), int(sys.argv[2]) or None)
@@ -0,0 +1,20 @@
+import json
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# symphony_api builds its stores and clients at import, point them at a scratch directory
+SCRATCH = Path(tempfile.mkdtemp(prefix="symphony-tests-"))
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("TAVILY_API_KEY", "test")
+os.environ.setdefault("SYMPHONY_RUN_STORE_PATH", str(SCRATCH / "runs.db"))
+os.environ.setdefault("SYMPHONY_WORKSPACE_ROOT", str(SCRATCH / "workspaces"))
+os.environ.setdefault("SYMPHONY_STRUCTURE_PATH", str(SCRATCH / "cleaned_structure.json"))
+os.environ.setdefault("SYMPHONY_LLM_CACHE", "off")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bench.symphony_bench import BENCH_STRUCTURE  # noqa: E402
+
+(SCRATCH / "cleaned_structure.json").write_text(json.dumps(BENCH_STRUCTURE))
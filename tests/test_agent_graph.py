@@ -0,0 +1,83 @@
+import asyncio
+import json
+
+import httpx
+
+import symphony_api
+from symphony_api import AgentGraph, RunState
+
+
+def make_graph(*labels: str) -> AgentGraph:
+    return AgentGraph([{"id": str(i), "data": {"label": label, "status": "idle"}} for i, label in enumerate(labels)])
+
+
+def labels(nodes: list) -> list:
+    return [node["data"]["label"] for node in nodes]
+
+
+def test_changes_since_returns_each_changed_node_once():
+    graph = make_graph("supervisor", "Search", "WebScraper")
+    graph.update("Search", status="running")
+    seen = graph.version
+    graph.update("WebScraper", status="running")
+    graph.update("Search", status="done")
+    graph.update("WebScraper", status="done")
+
+    assert labels(graph.changes_since(0)) == ["Search", "WebScraper"]
+    assert labels(graph.changes_since(seen)) == ["WebScraper", "Search"]
+    assert graph.changes_since(graph.version) == []
+    assert graph.changes_since(seen)[1]["data"]["status"] == "done"
+
+
+def test_updates_that_change_nothing_keep_the_version():
+    graph = make_graph("supervisor", "Search")
+    graph.update("Search", status="running")
+    version = graph.version
+
+    assert graph.update("Search", status="running")["data"]["status"] == "running"
+    assert graph.update("Unknown", status="running") is None
+    assert graph.version == version
+    assert graph.changes_since(version) == []
+
+
+def test_deltas_survive_change_log_compaction():
+    graph = make_graph("supervisor", "Search", "WebScraper")
+    graph.update("WebScraper", status="running")
+    seen = graph.version
+    for step in range(200):
+        graph.update("Search", timeElapsed=step)
+
+    assert len(graph.changes) <= 2 * len(graph.nodes) + 64
+    assert labels(graph.changes_since(seen)) == ["Search"]
+    assert labels(graph.changes_since(seen - 1)) == ["WebScraper", "Search"]
+
+
+def test_serialized_nodes_follow_updates():
+    graph = make_graph("supervisor", "Search")
+    assert json.loads(graph.to_json()) == graph.nodes
+    graph.update("Search", status="running", number_calls=1)
+
+    assert json.loads(graph.to_json()) == graph.nodes
+
+
+def test_agent_status_since_only_sends_nodes_changed_after_that_version(monkeypatch):
+    symphony_api.structure_cache.load()
+    run = RunState("graph-delta", "prompt", symphony_api.structure_cache.node_dicts())
+    run.task_active = False
+    monkeypatch.setitem(symphony_api.runs, run.run_id, run)
+    first, second = labels(run.graph.nodes)[:2]
+    run.graph.update(first, status="done")
+
+    async def status(**params) -> dict:
+        transport = httpx.ASGITransport(app=symphony_api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://api") as client:
+            return (await client.get("/agent_status", params={"run_id": run.run_id, **params})).json()
+
+    full = asyncio.run(status())
+    run.graph.update(second, status="running")
+    delta = asyncio.run(status(since=full["version"]))
+    unchanged = asyncio.run(status(since=delta["version"]))
+
+    assert labels(full["data"]) == labels(run.graph.nodes)
+    assert labels(delta["data"]) == [second] and delta["version"] == full["version"] + 1
+    assert unchanged["data"] == []
@@ -0,0 +1,123 @@
+import asyncio
+import uuid
+
+import httpx
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.outputs import ChatGeneration, LLMResult
+from pydantic import ValidationError
+
+import symphony_api
+from symphony_api import BudgetTracker, HistoryCompactor, RunBudget, RunBudgetRequest, RunState, RunStopped, RunStore
+
+PROMPT = [[SystemMessage(content="You route work between workers."), HumanMessage(content="What is LangGraph?")]]
+PROMPT_TOKENS = sum(HistoryCompactor.count_tokens(message) for message in PROMPT[0])
+
+
+def make_tracker(**limits) -> BudgetTracker:
+    return BudgetTracker(RunState("r", "prompt", [], budget=RunBudget(**limits)))
+
+
+def result(token_usage=None) -> LLMResult:
+    return LLMResult(generations=[[ChatGeneration(message=AIMessage(content="answer"))]],
+                     llm_output={"token_usage": token_usage} if token_usage else None)
+
+
+async def call(tracker: BudgetTracker, token_usage=None, streamed: int = 0) -> None:
+    run_id = uuid.uuid4()
+    await tracker.on_chat_model_start({}, PROMPT, run_id=run_id)
+    for _ in range(streamed):
+        await tracker.on_llm_new_token("word", run_id=run_id)
+    await tracker.on_llm_end(result(token_usage), run_id=run_id)
+
+
+def test_refused_call_is_not_counted():
+    tracker = make_tracker(max_llm_calls=2)
+
+    async def main():
+        await call(tracker)
+        await call(tracker)
+        with pytest.raises(RunStopped):
+            await call(tracker)
+
+    asyncio.run(main())
+
+    assert tracker.run.usage["llm_calls"] == 2
+    assert tracker.run.stop_reason == "max_llm_calls"
+
+
+def test_streamed_call_counts_its_prompt_and_chunks():
+    tracker = make_tracker()
+    asyncio.run(call(tracker, streamed=3))
+
+    assert tracker.run.usage["tokens"] == PROMPT_TOKENS + 3
+
+
+def test_reported_usage_replaces_the_prompt_estimate():
+    tracker = make_tracker()
+    asyncio.run(call(tracker, token_usage={"prompt_tokens": 40, "completion_tokens": 2, "total_tokens": 42}))
+
+    assert tracker.run.usage["tokens"] == 42
+    assert not tracker.prompts
+
+
+def test_call_whose_prompt_is_over_the_token_budget_never_starts():
+    tracker = make_tracker(max_tokens=PROMPT_TOKENS - 1)
+
+    with pytest.raises(RunStopped):
+        asyncio.run(call(tracker))
+
+    assert tracker.run.usage["tokens"] == 0 and tracker.run.usage["llm_calls"] == 0
+    assert tracker.run.stop_reason == "max_tokens"
+
+
+@pytest.mark.parametrize("field", ["max_seconds", "max_llm_calls", "max_tokens", "max_tool_calls"])
+@pytest.mark.parametrize("limit", [0, -1])
+def test_budget_request_limits_must_be_positive(field, limit):
+    with pytest.raises(ValidationError):
+        RunBudgetRequest(**{field: limit})
+    assert getattr(RunBudgetRequest(**{field: 1}), field) == 1
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = RunStore(str(tmp_path / "runs.db"))
+    monkeypatch.setattr(symphony_api, "run_store", store)
+    symphony_api.structure_cache.load()
+    yield store
+    store.close()
+
+
+def stored_run(store: RunStore, status: str, stop_reason=None) -> dict:
+    run = RunState(f"budget-{status}", "prompt", [], budget=RunBudget(max_llm_calls=3))
+    run.worker = symphony_api.WORKER_ID
+    run.status = status
+    run.stop_reason = stop_reason
+    run.usage.update(seconds=4.0, llm_calls=3 if stop_reason else 2, tokens=120, tool_calls=1)
+    store.save_run(run)
+    store.flush()
+    return store.get_run(run.run_id)
+
+
+def test_restored_run_keeps_what_it_spent(store):
+    run = symphony_api.restore_run(stored_run(store, "interrupted"), [])
+
+    assert run.usage == {"seconds": 4.0, "llm_calls": 2, "tokens": 120, "tool_calls": 1}
+    with pytest.raises(RunStopped):
+        asyncio.run(call(BudgetTracker(run)))
+        asyncio.run(call(BudgetTracker(run)))
+    assert run.usage["llm_calls"] == 3
+
+
+def test_run_stopped_by_its_budget_cannot_be_resumed(store):
+    record = stored_run(store, "stopped", stop_reason="max_llm_calls")
+
+    async def resume():
+        transport = httpx.ASGITransport(app=symphony_api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://api") as client:
+            return await client.post(f"/runs/{record['run_id']}/resume")
+
+    response = asyncio.run(resume())
+
+    assert response.status_code == 409
+    assert "max_llm_calls" in response.json()["detail"]
@@ -0,0 +1,89 @@
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+import symphony_api
+from symphony_api import Counter, HistoryCompactor
+
+SYSTEM = SystemMessage(content="You are a research assistant.")
+REQUEST = HumanMessage(content="Find the release notes for LangGraph and summarize them.")
+
+
+@pytest.fixture
+def compactions(monkeypatch):
+    counter = Counter("compactions", "Test compactions.", ("stage",))
+    monkeypatch.setattr(symphony_api, "history_compactions", counter)
+    monkeypatch.setattr(symphony_api, "history_tokens_saved", Counter("saved", "Test tokens saved."))
+    return counter
+
+
+def conversation(turns: int, chars: int) -> list:
+    return [SYSTEM, REQUEST] + [
+        HumanMessage(content=f"{i} " + "x" * chars, name="Search" if i % 2 else "WebScraper") for i in range(turns)
+    ]
+
+
+def total_tokens(messages: list) -> int:
+    return sum(HistoryCompactor.count_tokens(message) for message in messages)
+
+
+def test_history_under_the_threshold_is_sent_unchanged(compactions):
+    messages = conversation(turns=6, chars=100)
+    compactor = HistoryCompactor(max_tokens=total_tokens(messages), keep_recent=2, document_chars=50,
+                                 message_chars=50)
+
+    assert compactor.compact(messages) == messages
+    assert compactions.values == {}
+
+
+def test_history_over_the_threshold_is_compacted(compactions):
+    messages = conversation(turns=6, chars=400)
+    compactor = HistoryCompactor(max_tokens=total_tokens(messages) - 1, keep_recent=2, document_chars=50,
+                                 message_chars=50)
+
+    compacted = compactor.compact(messages)
+
+    assert total_tokens(compacted) <= compactor.max_tokens
+    assert compactions.values == {("messages",): 1}
+    assert symphony_api.history_tokens_saved.values[()] == total_tokens(messages) - total_tokens(compacted)
+
+
+def test_system_prompt_first_request_and_recent_turns_are_kept(compactions):
+    messages = conversation(turns=6, chars=400)
+    stubs = [message.copy(update={"content": f"[Earlier output from {message.name} omitted]"})
+             for message in messages[2:-2]]
+    compactor = HistoryCompactor(max_tokens=total_tokens(messages[:2] + stubs + messages[-2:]), keep_recent=2,
+                                 document_chars=50, message_chars=50)
+
+    compacted = compactor.compact(messages)
+
+    assert compacted[:2] == [SYSTEM, REQUEST]
+    assert compacted[-2:] == messages[-2:]
+    # Older turns keep their place and author, so the supervisor still sees who acted
+    assert compacted[2:-2] == stubs
+    assert compactions.values == {("stubs",): 1}
+
+
+def test_old_scraped_pages_are_cut_whatever_the_budget(compactions):
+    page = "<Document name=\"notes\">\n" + "y" * 500 + "\n</Document>"
+    messages = [SYSTEM, REQUEST, HumanMessage(content=page, name="WebScraper"), AIMessage(content="Done.")]
+    compactor = HistoryCompactor(max_tokens=10_000, keep_recent=1, document_chars=100, message_chars=1000)
+
+    compacted = compactor.compact(messages)
+
+    assert compacted[2].content.startswith("<Document name=\"notes\">\n" + "y" * 100 + "\n[... 400 characters truncated]")
+    assert compacted[2].content.endswith("</Document>")
+    assert compacted[3] == messages[3]
+    assert compactions.values == {("documents",): 1}
+
+
+def test_recent_turns_are_shortened_when_stubs_are_not_enough(compactions):
+    messages = conversation(turns=4, chars=4000)
+    compactor = HistoryCompactor(max_tokens=total_tokens(messages[:2]) + 600, keep_recent=2, document_chars=50,
+                                 message_chars=1000)
+
+    compacted = compactor.compact(messages)
+
+    assert compacted[:2] == [SYSTEM, REQUEST]
+    assert [message.name for message in compacted] == [message.name for message in messages]
+    assert all(message.content.endswith("[... 3002 characters truncated]") for message in compacted[-2:])
+    assert compactions.values == {("recent_messages",): 1}
@@ -0,0 +1,190 @@
+import asyncio
+import json
+import time
+
+import openai
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import symphony_api
+from symphony_api import AdaptiveLimiter, ModelPool, model_config
+
+
+class StubOpenAI:
+    """OpenAI-compatible chat completions that answer each model's scripted error statuses first, then succeed."""
+
+    def __init__(self, script: dict, latency: float = 0.0):
+        self.script = {model: list(statuses) for model, statuses in script.items()}
+        self.latency = latency
+        self.requests = []  # Model of each request, in arrival order
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        model = body["model"]
+        self.requests.append(model)
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        statuses = self.script.get(model)
+        status = statuses.pop(0) if statuses else 200
+        if status != 200:
+            error = {"message": f"Scripted {status}", "type": "test", "code": None}
+            return web.json_response({"error": error}, status=status, headers={"retry-after": "0"})
+
+        completion = {"id": "chatcmpl-test", "created": int(time.time()), "model": model}
+        content = f"Answer from {model}"
+        if not body.get("stream"):
+            return web.json_response({
+                **completion, "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 5, "completion_tokens": 3, "total_tokens": 8},
+            })
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for delta, finish_reason in (({"role": "assistant", "content": content}, None), ({}, "stop")):
+            chunk = {**completion, "object": "chat.completion.chunk",
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+
+def run_against_stub(monkeypatch, stub: StubOpenAI, scenario):
+    """Run `scenario(pool)` with a fresh ModelPool whose models talk to `stub`."""
+
+    async def main():
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", stub.chat_completions)
+        async with TestServer(app) as server:
+            monkeypatch.setenv("OPENAI_API_BASE", str(server.make_url("/v1")))
+            pool = ModelPool(max_connections=10, max_keepalive=5)
+            try:
+                return await scenario(pool)
+            finally:
+                await pool.close()
+
+    return asyncio.run(main())
+
+
+def test_rate_limited_request_is_retried_and_halves_the_limit(monkeypatch):
+    stub = StubOpenAI({"primary": [429]})
+    config = model_config({"name": "primary", "max_concurrency": 8, "max_retries": 2})
+
+    async def scenario(pool):
+        model = pool.get(config)
+        return model, await model.ainvoke("hello")
+
+    model, answer = run_against_stub(monkeypatch, stub, scenario)
+
+    assert answer.content == "Answer from primary"
+    assert stub.requests == ["primary", "primary"]
+    # Halved by the 429, then raised by 1/limit for the success
+    assert model.limiter.limit == pytest.approx(4.25)
+
+
+def test_retries_stop_after_max_retries(monkeypatch):
+    stub = StubOpenAI({"primary": [429, 429, 429, 429]})
+    config = model_config({"name": "primary", "max_concurrency": 8, "max_retries": 2, "fallback": None})
+
+    async def scenario(pool):
+        model = pool.get(config)
+        with pytest.raises(openai.RateLimitError):
+            await model.ainvoke("hello")
+        return model
+
+    model = run_against_stub(monkeypatch, stub, scenario)
+
+    assert stub.requests == ["primary"] * 3
+    assert model.limiter.limit == 2.0
+
+
+def test_client_errors_are_not_retried(monkeypatch):
+    stub = StubOpenAI({"primary": [400]})
+    config = model_config({"name": "primary", "max_retries": 2, "fallback": None})
+
+    async def scenario(pool):
+        with pytest.raises(openai.BadRequestError):
+            await pool.get(config).ainvoke("hello")
+
+    run_against_stub(monkeypatch, stub, scenario)
+
+    assert stub.requests == ["primary"]
+
+
+def test_falls_back_once_retries_are_used_up(monkeypatch):
+    stub = StubOpenAI({"primary": [500, 500]})
+    config = model_config({"name": "primary", "max_retries": 1, "fallback": "backup"})
+    fallbacks = symphony_api.llm_fallbacks.values.get(("primary", "backup"), 0)
+
+    async def scenario(pool):
+        return await pool.get(config).ainvoke("hello")
+
+    answer = run_against_stub(monkeypatch, stub, scenario)
+
+    assert answer.content == "Answer from backup"
+    assert stub.requests == ["primary", "primary", "backup"]
+    assert symphony_api.llm_fallbacks.values[("primary", "backup")] == fallbacks + 1
+
+
+def test_stream_falls_back_when_nothing_was_streamed(monkeypatch):
+    stub = StubOpenAI({"primary": [503]})
+    config = model_config({"name": "primary", "max_retries": 0, "fallback": "backup"})
+
+    async def scenario(pool):
+        return [chunk.content async for chunk in pool.get(config).astream("hello")]
+
+    chunks = run_against_stub(monkeypatch, stub, scenario)
+
+    assert "".join(chunks) == "Answer from backup"
+    assert stub.requests == ["primary", "backup"]
+
+
+def test_models_with_the_same_config_share_a_limiter(monkeypatch):
+    stub = StubOpenAI({}, latency=0.05)
+    config = model_config({"name": "primary", "max_concurrency": 2})
+
+    async def scenario(pool):
+        first, second = pool.get(config), pool.get(config._replace())
+        assert first is second
+        await asyncio.gather(*(first.ainvoke(f"question {index}") for index in range(6)))
+
+    run_against_stub(monkeypatch, stub, scenario)
+
+    assert len(stub.requests) == 6
+    assert stub.peak_in_flight == 2
+
+
+def test_limiter_halves_down_to_one_and_recovers():
+    limiter = AdaptiveLimiter(max_concurrency=8)
+    for expected in (4.0, 2.0, 1.0, 1.0):
+        limiter.throttled()
+        assert limiter.limit == expected
+    for _ in range(100):
+        limiter.succeeded()
+    assert limiter.limit == 8
+
+
+def test_limiter_admits_only_its_current_limit():
+    limiter = AdaptiveLimiter(max_concurrency=4)
+    limiter.throttled()
+    peak = 0
+
+    async def request():
+        nonlocal peak
+        async with limiter.slot():
+            peak = max(peak, limiter.in_flight)
+            await asyncio.sleep(0.01)
+
+    async def main():
+        await asyncio.gather(*(request() for _ in range(8)))
+
+    asyncio.run(main())
+
+    assert peak == 2
+    assert limiter.in_flight == 0
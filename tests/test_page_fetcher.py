@@ -0,0 +1,137 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from symphony_api import PageFetcher
+
+
+def make_fetcher(**overrides) -> PageFetcher:
+    settings = dict(ttl=900.0, max_bytes=1 << 20, max_connections=4, timeout=5.0)
+    settings.update(overrides)
+    return PageFetcher(**settings)
+
+
+async def fetch_all(routes, fetch):
+    """Serve `routes` on a local test server and run `fetch(url)`, where `url` maps a path to its address."""
+    app = web.Application()
+    for path, handler in routes.items():
+        app.router.add_get(path, handler)
+    async with TestServer(app) as server:
+        return await fetch(lambda path: str(server.make_url(path)))
+
+
+def test_revalidates_expired_page_with_etag_and_last_modified():
+    fetcher = make_fetcher(ttl=-1)  # Every cached page is already stale
+    seen_headers = []
+
+    async def page(request):
+        seen_headers.append(dict(request.headers))
+        if request.headers.get("If-None-Match") == '"v1"':
+            return web.Response(status=304)
+        return web.Response(
+            text="<html><title>Doc</title><body>hello</body></html>",
+            content_type="text/html",
+            headers={"ETag": '"v1"', "Last-Modified": "Wed, 21 Oct 2015 07:28:00 GMT"},
+        )
+
+    async def fetch(url):
+        try:
+            first = await fetcher.fetch(url("/doc"))
+            second = await fetcher.fetch(url("/doc"))
+        finally:
+            await fetcher.close()
+        return first, second
+
+    first, second = asyncio.run(fetch_all({"/doc": page}, fetch))
+
+    assert second.text == first.text and second.title == "Doc"
+    assert "If-None-Match" not in seen_headers[0]
+    assert seen_headers[1]["If-None-Match"] == '"v1"'
+    assert seen_headers[1]["If-Modified-Since"] == "Wed, 21 Oct 2015 07:28:00 GMT"
+    assert fetcher.revalidated == 1
+
+
+def test_fresh_page_is_served_from_cache():
+    fetcher = make_fetcher()
+    requests = 0
+
+    async def page(request):
+        nonlocal requests
+        requests += 1
+        return web.Response(text="<p>cached</p>", content_type="text/html")
+
+    async def fetch(url):
+        try:
+            for _ in range(3):
+                await fetcher.fetch(url("/doc"))
+        finally:
+            await fetcher.close()
+
+    asyncio.run(fetch_all({"/doc": page}, fetch))
+
+    assert requests == 1
+    assert (fetcher.hits, fetcher.misses) == (2, 1)
+
+
+def test_concurrent_fetches_of_one_url_share_a_request():
+    fetcher = make_fetcher()
+    requests = 0
+
+    async def slow_page(request):
+        nonlocal requests
+        requests += 1
+        await asyncio.sleep(0.1)
+        return web.Response(text="<p>slow</p>", content_type="text/html")
+
+    async def fetch(url):
+        try:
+            return await asyncio.gather(*(fetcher.fetch(url("/slow")) for _ in range(5)))
+        finally:
+            await fetcher.close()
+
+    pages = asyncio.run(fetch_all({"/slow": slow_page}, fetch))
+
+    assert requests == 1
+    assert len({page.text for page in pages}) == 1
+    assert fetcher.single_flight.coalesced == 4
+
+
+def test_cache_is_bounded_by_encoded_bytes():
+    body = "é" * 100  # 100 characters, 200 bytes once encoded
+    fetcher = make_fetcher(max_bytes=450)
+
+    async def page(request):
+        return web.Response(text=f"<p>{body}</p>", content_type="text/html")
+
+    async def fetch(url):
+        try:
+            for name in ("a", "b", "a", "c"):
+                await fetcher.fetch(url(f"/{name}"))
+        finally:
+            await fetcher.close()
+
+    asyncio.run(fetch_all({"/{name}": page}, fetch))
+
+    # Three pages would fit a budget counted in characters, only two fit in bytes
+    assert [url.rsplit("/", 1)[1] for url in fetcher.pages] == ["a", "c"]
+    assert fetcher.size == sum(len(page.text.encode()) for page in fetcher.pages.values())
+    assert fetcher.size <= 450
+
+
+def test_page_larger_than_the_cache_is_not_kept():
+    fetcher = make_fetcher(max_bytes=100)
+
+    async def page(request):
+        return web.Response(text="<p>" + "x" * 200 + "</p>", content_type="text/html")
+
+    async def fetch(url):
+        try:
+            return await fetcher.fetch(url("/big"))
+        finally:
+            await fetcher.close()
+
+    result = asyncio.run(fetch_all({"/big": page}, fetch))
+
+    assert len(result.text) == 200
+    assert not fetcher.pages and fetcher.size == 0
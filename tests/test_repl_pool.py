@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+from symphony_api import ReplTimeout, ReplWorkerPool
+
+
+def run_in_pool(scenario, **settings):
+    pool = ReplWorkerPool(**{"size": 1, "timeout": 30.0, "memory_limit": None, **settings})
+
+    async def main():
+        try:
+            return await scenario(pool)
+        finally:
+            pool.shutdown()
+
+    return asyncio.run(main())
+
+
+def test_workers_do_not_import_the_server():
+    async def scenario(pool):
+        return await pool.run("a", "import sys\n"
+                                   "print(sys.modules['__main__'].__spec__.name)\n"
+                                   "print(sorted({'symphony_api', 'fastapi', 'langgraph'} & set(sys.modules)))")
+
+    # Whatever module started the server, the worker's __main__ is its own
+    assert run_in_pool(scenario).split() == ["symphony_repl", "[]"]
+
+
+def test_sessions_keep_their_own_namespace():
+    async def scenario(pool):
+        await pool.run("a", "x = 41")
+        return await pool.run("a", "print(x + 1)"), await pool.run("b", "print('x' in dir())")
+
+    assert [output.strip() for output in run_in_pool(scenario)] == ["42", "False"]
+
+
+def test_worker_past_its_time_limit_is_replaced():
+    async def scenario(pool):
+        await pool.run("a", "x = 1")  # Waits for the worker to finish starting
+        pool.timeout = 0.5
+        with pytest.raises(ReplTimeout):
+            await pool.run("a", "import time\ntime.sleep(10)")
+        return await pool.run("a", "print('x' in dir())"), pool.respawns
+
+    output, respawns = run_in_pool(scenario)
+
+    assert output.strip() == "False" and respawns == 1
@@ -0,0 +1,116 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.prompt_values import ChatPromptValue
+from langchain_core.runnables import RunnableLambda
+
+import symphony_api
+from symphony_api import CachedLLM, MemoryResponseCache, SQLiteResponseCache, response_cache_key
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class CountingLLM:
+    """A chat model stand-in that answers with the number of calls made so far."""
+
+    def __init__(self):
+        self.calls = 0
+        self.runnable = RunnableLambda(self.answer)
+
+    def answer(self, prompt: ChatPromptValue) -> AIMessage:
+        self.calls += 1
+        return AIMessage(content=f"answer {self.calls}")
+
+
+def prompt(question: str) -> ChatPromptValue:
+    return ChatPromptValue(messages=[SystemMessage(content="You answer questions."), HumanMessage(content=question)])
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_cache(request, tmp_path):
+    def make(ttl: float = 600.0):
+        if request.param == "memory":
+            return MemoryResponseCache(maxsize=8, ttl=ttl)
+        return SQLiteResponseCache(path=str(tmp_path / "llm_cache.db"), ttl=ttl)
+
+    return make
+
+
+def test_key_ignores_whitespace_but_not_content():
+    llm = SimpleNamespace(model_name="gpt-4-turbo")
+    key = response_cache_key(llm, prompt("What is  LangGraph?\n").to_messages())
+
+    assert key == response_cache_key(llm, prompt(" What is LangGraph? ").to_messages())
+    assert key != response_cache_key(llm, prompt("What is LangChain?").to_messages())
+    assert key != response_cache_key(llm, [HumanMessage(content="What is LangGraph?")])
+
+
+def test_key_depends_on_the_model_and_bound_functions():
+    messages = prompt("What is LangGraph?").to_messages()
+    llm = RunnableLambda(lambda value: value)
+
+    assert response_cache_key(SimpleNamespace(model_name="a"), messages) != response_cache_key(
+        SimpleNamespace(model_name="b"), messages)
+    assert response_cache_key(llm.bind(function_call="route"), messages) != response_cache_key(
+        llm.bind(function_call="other"), messages)
+
+
+def test_repeated_prompt_is_served_from_the_cache(make_cache):
+    llm = CountingLLM()
+    cached = CachedLLM(llm.runnable, make_cache())
+
+    async def main():
+        first = await cached.ainvoke(prompt("What is LangGraph?"))
+        again = await cached.ainvoke(prompt("What  is LangGraph?"))
+        other = await cached.ainvoke(prompt("What is LangChain?"))
+        return first, again, other
+
+    first, again, other = asyncio.run(main())
+
+    assert (first.content, again.content, other.content) == ("answer 1", "answer 1", "answer 2")
+    assert llm.calls == 2
+    assert (cached.cache.hits, cached.cache.misses) == (1, 2)
+
+
+def test_entries_expire_after_ttl(make_cache, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(symphony_api.time, "time", clock)
+    llm = CountingLLM()
+    cached = CachedLLM(llm.runnable, make_cache(ttl=60))
+
+    async def ask() -> str:
+        return (await cached.ainvoke(prompt("What is LangGraph?"))).content
+
+    asyncio.run(ask())
+    clock.now += 59
+    assert asyncio.run(ask()) == "answer 1"
+    clock.now += 2
+    assert asyncio.run(ask()) == "answer 2"
+    assert llm.calls == 2
+
+
+def test_sync_calls_bypass_the_cache(make_cache):
+    llm = CountingLLM()
+    cached = CachedLLM(llm.runnable, make_cache())
+
+    answers = [cached.invoke(prompt("What is LangGraph?")).content for _ in range(2)]
+
+    assert answers == ["answer 1", "answer 2"]
+    assert (cached.cache.hits, cached.cache.misses) == (0, 0)
+
+
+def test_models_are_not_wrapped_when_caching_is_off(monkeypatch):
+    llm = CountingLLM().runnable
+    monkeypatch.setattr(symphony_api, "response_cache", None)
+    assert symphony_api.with_response_cache(llm) is llm
+
+    monkeypatch.setattr(symphony_api, "response_cache", MemoryResponseCache())
+    assert isinstance(symphony_api.with_response_cache(llm), CachedLLM)
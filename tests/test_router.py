@@ -0,0 +1,57 @@
+from langchain_core.messages import HumanMessage
+from langchain_core.runnables import RunnableLambda
+
+from symphony_api import DEFAULT_RULE_CONFIDENCE, RuleRouter
+
+MEMBERS = ["Search", "WebScraper"]
+
+
+def make_router(rules=DEFAULT_RULE_CONFIDENCE, threshold=0.8) -> RuleRouter:
+    supervisor = RunnableLambda(lambda state: {"next": "Search"})
+    return RuleRouter(supervisor, MEMBERS, rules, threshold)
+
+
+def test_most_confident_matching_rule_wins():
+    # Both urls_unscraped (0.9) and final_answer (0.95) match
+    messages = [
+        HumanMessage(content="Summarize https://example.com/post"),
+        HumanMessage(content="FINAL ANSWER: it is about routing", name="Search"),
+    ]
+    for rules in ({"urls_unscraped": 0.9, "final_answer": 0.95}, {"final_answer": 0.95, "urls_unscraped": 0.9}):
+        assert make_router(rules).route({"messages": messages}) == {"next": "FINISH"}
+
+
+def test_rule_below_threshold_falls_back_to_the_supervisor():
+    messages = [
+        HumanMessage(content="Find the latest release"),
+        HumanMessage(content="done", name="Search"),
+        HumanMessage(content="done", name="WebScraper"),
+    ]
+    router = make_router({"all_workers_done": 0.6})
+    assert router.route({"messages": messages}) is None
+    assert router.invoke({"messages": messages}) == {"next": "Search"}
+    assert make_router({"all_workers_done": 0.6}, threshold=0.5).route({"messages": messages}) == {"next": "FINISH"}
+
+
+def test_default_rules_finish_once_every_worker_answered():
+    request = HumanMessage(content="Find the latest release")
+    searched = HumanMessage(content="done", name="Search")
+    scraped = HumanMessage(content="done", name="WebScraper")
+    assert make_router().route({"messages": [request, searched]}) is None
+    assert make_router().route({"messages": [request, searched, scraped]}) == {"next": "FINISH"}
+    final = HumanMessage(content="FINAL ANSWER: version 0.1 is the latest", name="Search")
+    assert make_router().route({"messages": [request, final]}) == {"next": "FINISH"}
+
+
+def test_unscraped_urls_go_to_the_scraper():
+    messages = [HumanMessage(content="What does https://example.com/post say?")]
+    assert make_router().route({"messages": messages}) == {"next": "WebScraper"}
+
+
+def test_request_with_other_work_goes_to_the_supervisor():
+    for request in ("Scrape https://example.com/team and search for the lead developer",
+                    "Summarize https://example.com/post, then find related work"):
+        assert make_router().route({"messages": [HumanMessage(content=request)]}) is None
+    for request in ("Summarize https://example.com/a and https://example.com/b",
+                    "What do https://example.com/a, https://example.com/b say?"):
+        assert make_router().route({"messages": [HumanMessage(content=request)]}) == {"next": "WebScraper"}
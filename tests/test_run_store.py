@@ -0,0 +1,74 @@
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import symphony_api
+from symphony_api import RunState, RunStore
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = RunStore(str(tmp_path / "runs.db"))
+    monkeypatch.setattr(symphony_api, "run_store", store)
+    yield store
+    store.close()
+
+
+def stopped_worker() -> str:
+    """ID of a worker whose process has already exited."""
+    finished = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True, text=True)
+    return f"{socket.gethostname()}:{finished.stdout.strip()}"
+
+
+def save(store: RunStore, run_id: str, worker, status: str) -> None:
+    run = RunState(run_id, "prompt", [])
+    run.worker = worker
+    run.status = status
+    store.save_run(run)
+    store.flush()
+
+
+def test_startup_interrupts_only_runs_of_stopped_workers(store):
+    live = f"{socket.gethostname()}:{os.getppid()}"
+    save(store, "live", live, "running")
+    save(store, "live-queued", live, "queued")
+    save(store, "stopped", stopped_worker(), "running")
+    save(store, "previous", symphony_api.WORKER_ID, "queued")  # A previous process with this worker's ID
+    save(store, "legacy", None, "running")  # Written before runs recorded their worker
+    save(store, "done", stopped_worker(), "finished")
+
+    asyncio.run(symphony_api.interrupt_orphaned_runs())
+
+    statuses = {run_id: store.get_run(run_id)["status"]
+                for run_id in ("live", "live-queued", "stopped", "previous", "legacy", "done")}
+    assert statuses == {"live": "running", "live-queued": "queued", "stopped": "interrupted",
+                        "previous": "interrupted", "legacy": "interrupted", "done": "finished"}
+
+
+def test_runs_are_taken_over_only_from_stopped_workers(store):
+    live = f"{socket.gethostname()}:{os.getppid()}"
+    save(store, "live", live, "parked")
+    save(store, "stopped", stopped_worker(), "parked")
+    save(store, "ended", live, "interrupted")
+
+    async def main():
+        return [await symphony_api.take_over_run(store.get_run(run_id)) for run_id in ("live", "stopped", "ended")]
+
+    assert asyncio.run(main()) == [False, True, True]
+    assert store.get_run("live")["worker"] == live
+    assert store.get_run("stopped")["worker"] == symphony_api.WORKER_ID
+
+
+def test_one_worker_wins_a_take_over(store):
+    owner = stopped_worker()
+    save(store, "r", owner, "parked")
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: store.take_over("r", owner), range(4)))
+
+    assert sorted(results) == [False, False, False, True]
@@ -0,0 +1,131 @@
+import asyncio
+
+import pytest
+
+import symphony_api
+from symphony_api import Histogram, RunScheduler, RunState, RunStore, SchedulerFull
+
+
+class GatedRuns:
+    """Stands in for the graph run: each run holds its slot until it is released."""
+
+    def __init__(self):
+        self.started = []
+        self.gates = {}
+
+    async def run(self, run: RunState) -> None:
+        self.started.append(run.run_id)
+        await self.gate(run.run_id).wait()
+
+    def gate(self, run_id: str) -> asyncio.Event:
+        return self.gates.setdefault(run_id, asyncio.Event())
+
+    async def release(self, run_id: str) -> None:
+        self.gate(run_id).set()
+        while run_id in symphony_api.scheduler.running:
+            await asyncio.sleep(0)
+
+
+@pytest.fixture
+def runs(tmp_path, monkeypatch):
+    store = RunStore(str(tmp_path / "runs.db"))
+    gated = GatedRuns()
+    monkeypatch.setattr(symphony_api, "run_store", store)
+    monkeypatch.setattr(symphony_api, "runs", {})
+    monkeypatch.setattr(symphony_api, "stream_time_elapsed", gated.run)
+    monkeypatch.setattr(symphony_api, "run_queue_seconds", Histogram("queue_seconds", "Test queue time."))
+    yield gated
+    store.close()
+
+
+def use_scheduler(monkeypatch, max_concurrency: int, max_queued: int = 10) -> RunScheduler:
+    scheduler = RunScheduler(max_concurrency=max_concurrency, max_queued=max_queued)
+    monkeypatch.setattr(symphony_api, "scheduler", scheduler)
+    return scheduler
+
+
+def submit(scheduler: RunScheduler, run_id: str, priority: int = 0) -> RunState:
+    run = RunState(run_id, "prompt", [], priority=priority)
+    symphony_api.runs[run_id] = run
+    scheduler.submit(run)
+    return run
+
+
+def test_queued_runs_start_by_priority_then_arrival(runs, monkeypatch):
+    scheduler = use_scheduler(monkeypatch, max_concurrency=1)
+
+    async def main():
+        submit(scheduler, "first")
+        for run_id, priority in (("low", 0), ("high", 5), ("mid", 1), ("high-later", 5)):
+            submit(scheduler, run_id, priority)
+        positions = [scheduler.queue_position(run_id) for run_id in ("high", "high-later", "mid", "low")]
+        await asyncio.sleep(0)
+        for run_id in ("first", "high", "high-later", "mid", "low"):
+            await runs.release(run_id)
+        return positions
+
+    assert asyncio.run(main()) == [1, 2, 3, 4]
+    assert runs.started == ["first", "high", "high-later", "mid", "low"]
+
+
+def test_runs_beyond_the_concurrency_cap_wait(runs, monkeypatch):
+    scheduler = use_scheduler(monkeypatch, max_concurrency=2, max_queued=2)
+
+    async def main():
+        submitted = [submit(scheduler, f"run-{i}") for i in range(4)]
+        await asyncio.sleep(0)
+        statuses = [run.status for run in submitted]
+        with pytest.raises(SchedulerFull):
+            submit(scheduler, "run-4")
+        started_while_full = list(runs.started)
+        await runs.release("run-0")
+        await asyncio.sleep(0)
+        running = sorted(scheduler.running)
+        for run_id in ("run-1", "run-2", "run-3"):
+            await runs.release(run_id)
+        return statuses, started_while_full, running
+
+    statuses, started_while_full, running = asyncio.run(main())
+
+    assert statuses == ["running", "running", "queued", "queued"]
+    assert started_while_full == ["run-0", "run-1"]
+    assert running == ["run-1", "run-2"]
+
+
+def test_cancelled_queued_run_never_starts(runs, monkeypatch):
+    scheduler = use_scheduler(monkeypatch, max_concurrency=1)
+
+    async def main():
+        submit(scheduler, "running")
+        cancelled = submit(scheduler, "cancelled")
+        waiting = submit(scheduler, "waiting")
+        await asyncio.sleep(0)
+        assert scheduler.cancel("cancelled")
+        position = scheduler.queue_position("waiting")
+        await runs.release("running")
+        await runs.release("waiting")
+        return cancelled, waiting, position
+
+    cancelled, waiting, position = asyncio.run(main())
+
+    assert (cancelled.status, cancelled.stop_reason) == ("cancelled", "cancelled")
+    assert position == 1
+    assert runs.started == ["running", "waiting"]
+    assert waiting.status == "finished"
+
+
+def test_queue_time_is_observed_when_a_run_starts(runs, monkeypatch):
+    scheduler = use_scheduler(monkeypatch, max_concurrency=1)
+
+    async def main():
+        submit(scheduler, "first")
+        submit(scheduler, "second")
+        await asyncio.sleep(0.2)
+        await runs.release("first")
+        await runs.release("second")
+
+    asyncio.run(main())
+
+    (counts, total), = symphony_api.run_queue_seconds.series.values()
+    assert sum(counts) == 2
+    assert 0.2 <= total[0] < 1.0  # The first run started at once, the second waited for it
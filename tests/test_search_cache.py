@@ -0,0 +1,99 @@
+import asyncio
+
+import symphony_api
+from symphony_api import CachedTavilySearchResults, SearchCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_normalize_ignores_case_spacing_and_trailing_punctuation():
+    assert SearchCache.normalize("  What is   LangGraph?? ") == "what is langgraph"
+    assert SearchCache.normalize("what is langgraph") == SearchCache.normalize("What is LangGraph!")
+    assert SearchCache.normalize("c++ vs c#") != SearchCache.normalize("c vs c")
+
+
+def test_tool_cache_key_includes_max_results():
+    five = CachedTavilySearchResults(max_results=5)
+    ten = CachedTavilySearchResults(max_results=10)
+    assert five._cache_key("Python  GIL?") == five._cache_key("python gil")
+    assert five._cache_key("python gil") != ten._cache_key("python gil")
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(symphony_api.time, "time", clock)
+    cache = SearchCache(maxsize=8, ttl=60)
+
+    cache.set("q", [{"url": "a"}])
+    clock.now += 59
+    assert cache.get("q") == [{"url": "a"}]
+    clock.now += 2
+    assert cache.get("q") is None
+    assert cache.stats()["size"] == 0
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = SearchCache(maxsize=2, ttl=60)
+    cache.set("a", [1])
+    cache.set("b", [2])
+    cache.get("a")
+    cache.set("c", [3])
+
+    assert cache.get("b") is None
+    assert cache.get("a") == [1] and cache.get("c") == [3]
+
+
+def test_error_strings_are_not_cached():
+    cache = SearchCache(maxsize=8, ttl=60)
+    cache.set("q", "HTTPError('429 Too Many Requests')")
+    assert cache.get("q") is None
+
+
+def test_concurrent_identical_queries_share_one_search():
+    cache = SearchCache(maxsize=8, ttl=60)
+    calls = 0
+
+    async def search():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return [{"url": "a"}]
+
+    async def main():
+        key = (SearchCache.normalize("Latest AI news?"), 5)
+        results = await asyncio.gather(*(cache.search(key, search) for _ in range(4)))
+        again = await cache.search((SearchCache.normalize("latest ai news"), 5), search)
+        return results, again
+
+    results, again = asyncio.run(main())
+
+    assert calls == 1
+    assert results == [[{"url": "a"}]] * 4 and again == [{"url": "a"}]
+    stats = cache.stats()
+    assert stats["coalesced"] == 3
+    assert (stats["hits"], stats["misses"]) == (1, 4)
+
+
+def test_cancelled_caller_does_not_cancel_the_shared_search():
+    cache = SearchCache(maxsize=8, ttl=60)
+
+    async def search():
+        await asyncio.sleep(0.05)
+        return ["done"]
+
+    async def main():
+        first = asyncio.ensure_future(cache.search("q", search))
+        second = asyncio.ensure_future(cache.search("q", search))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(main()) == ["done"]
+    assert cache.get("q") == ["done"]
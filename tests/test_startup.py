@@ -0,0 +1,44 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+
+import symphony_api
+from bench.symphony_bench import BENCH_STRUCTURE, measure_import_time
+
+# Same default as `bench/symphony_bench.py --import-time`
+IMPORT_BUDGET = float(os.getenv("SYMPHONY_IMPORT_BUDGET", "2"))
+
+
+def test_import_stays_within_budget():
+    seconds = measure_import_time(repeats=3)["seconds"]
+    assert seconds["p50"] < IMPORT_BUDGET, f"importing symphony_api takes {seconds['p50']:.2f} s"
+
+
+def test_import_leaves_heavy_tool_dependencies_unloaded():
+    heavy = ["matplotlib", "langchain_experimental", "langchain.agents", "langchain_openai", "openai",
+             "langchain_core.output_parsers.openai_functions", "redis"]
+    check = f"import sys, json, symphony_api; print(json.dumps([m for m in {heavy!r} if m in sys.modules]))"
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    completed = subprocess.run([sys.executable, "-c", check], env=env, capture_output=True, text=True, check=True,
+                               cwd=os.path.dirname(os.environ["SYMPHONY_RUN_STORE_PATH"]))
+    assert json.loads(completed.stdout.splitlines()[-1]) == []
+
+
+def test_structure_is_loaded_at_startup_not_per_run(monkeypatch):
+    async def start():
+        await symphony_api.watch_graph_structure()
+        symphony_api.structure_watcher.cancel()
+
+    asyncio.run(start())
+
+    def fail_load():
+        raise AssertionError("the structure file was read while registering a run")
+
+    monkeypatch.setattr(symphony_api.structure_cache, "load", fail_load)
+    run = symphony_api.register_run("hello")
+    try:
+        assert [node["data"]["label"] for node in run.graph.nodes] == [node["data"]["label"] for node in BENCH_STRUCTURE]
+    finally:
+        symphony_api.runs.pop(run.run_id)
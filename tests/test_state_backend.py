@@ -0,0 +1,186 @@
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+import pytest
+from fakeredis import TcpFakeServer
+
+import symphony_api
+from symphony_api import LocalStateBackend, RedisStateBackend, StateBackend
+
+
+@pytest.fixture(scope="module")
+def redis_url():
+    server = TcpFakeServer(("127.0.0.1", 0), server_type="redis")
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "redis://%s:%d/0" % server.server_address
+    server.shutdown()
+    server.server_close()
+
+
+def make_backends(redis_url, count: int = 2):
+    """Backends of `count` workers sharing one key prefix."""
+    prefix = f"test-{uuid.uuid4().hex[:8]}"
+    return [RedisStateBackend(redis_url, prefix, ttl=60, worker_id=f"worker-{index}") for index in range(count)]
+
+
+def snapshot(run_id: str, created_at: float, status: str = "running") -> dict:
+    return {"run_id": run_id, "created_at": created_at, "status": status}
+
+
+async def wait_for(predicate, timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+async def close_all(backends) -> None:
+    for backend in backends:
+        await backend.close()
+
+
+def test_state_backend_is_abstract():
+    with pytest.raises(TypeError):
+        StateBackend()
+
+    class Partial(StateBackend):
+        def publish(self, message: dict) -> None:
+            pass
+
+    with pytest.raises(TypeError):
+        Partial()
+    assert not LocalStateBackend().shared
+
+
+def test_snapshots_are_listed_newest_first(redis_url):
+    async def main():
+        owner, reader = make_backends(redis_url)
+        try:
+            await owner.save_runs([snapshot("a", 1.0), snapshot("b", 2.0)])
+            await owner.save_runs([snapshot("a", 1.0, status="finished")])
+            loaded = await reader.load_run("a")
+            listed = await reader.list_runs(limit=10)
+            latest = await reader.latest_run_id()
+            # An expired snapshot leaves its index entry behind, listing skips it
+            await reader.redis.delete(reader.run_key("b"))
+            after_expiry = await reader.list_runs(limit=10)
+            missing = await reader.load_run("missing")
+            return loaded, listed, latest, after_expiry, missing
+        finally:
+            await close_all([owner, reader])
+
+    loaded, listed, latest, after_expiry, missing = asyncio.run(main())
+
+    assert loaded == snapshot("a", 1.0, status="finished")
+    assert [entry["run_id"] for entry in listed] == ["b", "a"]
+    assert latest == "b"
+    assert [entry["run_id"] for entry in after_expiry] == ["a"]
+    assert missing is None
+
+
+def test_messages_reach_other_workers_but_not_their_origin(redis_url):
+    async def main():
+        backends = make_backends(redis_url, count=3)
+        received = {backend.worker_id: [] for backend in backends}
+        try:
+            for backend in backends:
+                await backend.start(received[backend.worker_id].append)
+            backends[0].publish({"channel": "status", "type": "agent_start", "run_id": "r", "agent": "Search"})
+            backends[0].publish({"channel": "tokens", "type": "token", "run_id": "r", "token": "Hi"})
+            await wait_for(lambda: all(len(received[backend.worker_id]) == 2 for backend in backends[1:]))
+            await asyncio.sleep(0.05)
+        finally:
+            await close_all(backends)
+        return received
+
+    received = asyncio.run(main())
+
+    assert received["worker-0"] == []
+    for worker in ("worker-1", "worker-2"):
+        assert [(message["channel"], message["type"]) for message in received[worker]] == [
+            ("status", "agent_start"), ("tokens", "token")]
+        assert "origin" not in received[worker][0]
+
+
+def test_final_snapshot_is_saved_before_later_messages(redis_url):
+    async def main():
+        owner, reader = make_backends(redis_url)
+        seen_at_end = []
+
+        def receive(message):
+            if message["type"] == "end":
+                seen_at_end.append(asyncio.ensure_future(reader.load_run("r")))
+
+        try:
+            await owner.start(lambda message: None)
+            await reader.start(receive)
+            owner.save_run_soon(snapshot("r", 1.0, status="finished"))
+            owner.publish({"channel": "tokens", "type": "end", "run_id": "r", "status": "finished"})
+            await wait_for(lambda: seen_at_end)
+            return await seen_at_end[0]
+        finally:
+            await close_all([owner, reader])
+
+    assert asyncio.run(main())["status"] == "finished"
+
+
+def test_signals_are_relayed_to_the_owner(redis_url):
+    async def main():
+        owner, other = make_backends(redis_url)
+        signals = []
+        try:
+            await owner.start(signals.append)
+            await other.start(lambda message: None)
+            other.publish({"channel": "signal", "type": "feedback", "run_id": "r", "agent": "Search", "feedback": "yes"})
+            other.publish({"channel": "signal", "type": "cancel", "run_id": "r"})
+            await wait_for(lambda: len(signals) == 2)
+        finally:
+            await close_all([owner, other])
+        return signals
+
+    signals = asyncio.run(main())
+
+    assert signals == [
+        {"channel": "signal", "type": "feedback", "run_id": "r", "agent": "Search", "feedback": "yes"},
+        {"channel": "signal", "type": "cancel", "run_id": "r"},
+    ]
+
+
+def test_workers_are_live_until_they_close(redis_url):
+    async def main():
+        first, second = make_backends(redis_url)
+        await first.start(lambda message: None)
+        await second.start(lambda message: None)
+        try:
+            before = [await first.is_live(worker) for worker in ("worker-0", "worker-1", "worker-9")]
+            ttl = await first.redis.ttl(first.worker_key("worker-1"))
+            await second.close()
+            after = await first.is_live("worker-1")
+        finally:
+            await first.close()
+        return before, ttl, after
+
+    before, ttl, after = asyncio.run(main())
+
+    assert before == [True, True, False]
+    assert 0 < ttl <= 3 * symphony_api.WORKER_HEARTBEAT_INTERVAL
+    assert after is False
+
+
+def test_local_workers_are_live_while_their_process_runs():
+    backend = LocalStateBackend()
+    finished = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True, text=True)
+    host = socket.gethostname()
+
+    async def main():
+        return [await backend.is_live(worker) for worker in (
+            symphony_api.WORKER_ID, f"{host}:{finished.stdout.strip()}", f"elsewhere:{os.getpid()}")]
+
+    assert asyncio.run(main()) == [True, False, False]
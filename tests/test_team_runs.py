@@ -0,0 +1,276 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import symphony_api
+from symphony_api import FINISHED_STATUSES, ModelPool, TeamRegistry, load_team_specs
+
+WORKER_PROMPTS = {"Search": "tavily search engine", "WebScraper": "scrape specified urls"}
+
+
+class ScriptedTeamLLM:
+    """OpenAI-compatible chat completions for the research team.
+
+    The supervisor routes to `first` and finishes once every worker it chose
+    has answered. Each worker answers with its name after its delay.
+    """
+
+    def __init__(self, first, delays: dict = None, answers: dict = None):
+        self.first = first
+        self.delays = delays or {}
+        self.answers = answers or {}  # Worker to its answer, its name and "answer" by default
+        self.worker_prompts = []  # System prompt of every worker request
+        self.routes = []  # Every routing decision the supervisor model made
+        self.working = 0  # Worker requests in flight
+        self.peak_working = 0
+
+    def reply(self, body: dict) -> dict:
+        messages = body["messages"]
+        if any(function["name"] == "route" for function in body.get("functions") or []):
+            answered = {message["name"] for message in messages if message.get("name")}
+            chosen = [self.first] if isinstance(self.first, str) else self.first
+            decision = "FINISH" if set(chosen) <= answered else self.first
+            self.routes.append(decision)
+            return {"role": "assistant", "content": None,
+                    "function_call": {"name": "route", "arguments": json.dumps({"next": decision})}}
+        system = messages[0]["content"]
+        self.worker_prompts.append(system)
+        worker = next(name for name, prompt in WORKER_PROMPTS.items() if prompt in system)
+        return {"role": "assistant", "content": f"{worker} {self.answers.get(worker, 'answer')}"}
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        message = self.reply(body)
+        if message["content"]:
+            worker = message["content"].split()[0]
+            self.working += 1
+            self.peak_working = max(self.peak_working, self.working)
+            try:
+                await asyncio.sleep(self.delays.get(worker, 0.0))
+            finally:
+                self.working -= 1
+        completion = {"id": "chatcmpl-test", "created": int(time.time()), "model": body["model"]}
+        if not body.get("stream"):
+            return web.json_response({
+                **completion, "object": "chat.completion",
+                "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 5, "completion_tokens": 3, "total_tokens": 8},
+            })
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for delta, finish_reason in ((message, None), ({}, "stop")):
+            chunk = {**completion, "object": "chat.completion.chunk",
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+
+def run_against_team(monkeypatch, llm: ScriptedTeamLLM, scenario):
+    """Run `scenario(client)` against the API, with freshly built teams whose models talk to `llm`."""
+
+    async def main():
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", llm.chat_completions)
+        async with TestServer(app) as server:
+            monkeypatch.setenv("OPENAI_API_BASE", str(server.make_url("/v1")))
+            monkeypatch.setattr(symphony_api, "model_pool", ModelPool(max_connections=10, max_keepalive=5))
+            monkeypatch.setattr(symphony_api, "team_registry", TeamRegistry(load_team_specs()))
+            symphony_api.structure_cache.load()
+            transport = httpx.ASGITransport(app=symphony_api.app)
+            try:
+                async with httpx.AsyncClient(transport=transport, base_url="http://api") as client:
+                    return await scenario(client)
+            finally:
+                await symphony_api.model_pool.close()
+
+    return asyncio.run(main())
+
+
+async def wait_for_status(client: httpx.AsyncClient, run_id: str, statuses, timeout: float = 10.0) -> dict:
+    deadline = time.monotonic() + timeout
+    while True:
+        run = (await client.get(f"/runs/{run_id}")).json()
+        if run["status"] in statuses:
+            return run
+        assert time.monotonic() < deadline, f"run is still {run['status']}"
+        await asyncio.sleep(0.02)
+
+
+async def results(client: httpx.AsyncClient, run_id: str) -> list:
+    return [result["agent"] for result in (await client.get("/last_task_results", params={"run_id": run_id})).json()]
+
+
+def drain(queue: asyncio.Queue) -> list:
+    events = []
+    while not queue.empty():
+        events.append(queue.get_nowait())
+    return events
+
+
+async def stored_steps(client: httpx.AsyncClient, run_id: str) -> list:
+    await asyncio.to_thread(symphony_api.run_store.flush)
+    return [step["node"] for step in (await client.get(f"/run_history/{run_id}")).json()["steps"]]
+
+
+@pytest.mark.parametrize("stream_tokens", [False, True])
+@pytest.mark.parametrize("delays", [{"Search": 0.0, "WebScraper": 0.2}, {"Search": 0.2, "WebScraper": 0.0}],
+                         ids=["search-first", "scraper-first"])
+def test_parallel_step_keeps_the_other_worker_when_one_parks(monkeypatch, delays, stream_tokens):
+    monkeypatch.setenv("SYMPHONY_ROUTER_RULES", "{}")
+    llm = ScriptedTeamLLM(["Search", "WebScraper"], delays)
+
+    async def scenario(client):
+        run_id = (await client.post("/run_agent_stream", json={
+            "prompt": "important: look up the release notes and the docs", "stream_tokens": stream_tokens,
+        })).json()["run_id"]
+        parked = await wait_for_status(client, run_id, ("parked",) + FINISHED_STATUSES)
+        while_parked = await results(client, run_id), await stored_steps(client, run_id)
+        resolved = await client.post("/resolve_feedback", json={"agent": "Search", "feedback": "yes", "run_id": run_id})
+        finished = await wait_for_status(client, run_id, FINISHED_STATUSES)
+        return parked["status"], while_parked, resolved.status_code, finished["status"], await results(client, run_id)
+
+    parked, (parked_results, parked_steps), resolved, status, final_results = run_against_team(monkeypatch, llm, scenario)
+
+    assert parked == "parked"
+    # The WebScraper ran alongside the parked Search and its answer was kept, in memory and in the store
+    assert parked_results == ["WebScraper"]
+    assert parked_steps == ["supervisor", "WebScraper"]
+    assert (resolved, status) == (200, "finished")
+    assert sorted(final_results) == ["Search", "WebScraper"]
+
+
+def test_link_and_search_request_fans_out_with_the_default_rules(monkeypatch):
+    monkeypatch.delenv("SYMPHONY_ROUTER_RULES", raising=False)
+    llm = ScriptedTeamLLM(["Search", "WebScraper"], {"Search": 0.1, "WebScraper": 0.1})
+
+    async def scenario(client):
+        run_id = (await client.post("/run_agent_stream", json={
+            "prompt": "Scrape https://example.com/team and search for the lead developer"})).json()["run_id"]
+        finished = await wait_for_status(client, run_id, FINISHED_STATUSES)
+        return finished["status"], await results(client, run_id), await stored_steps(client, run_id)
+
+    status, final_results, steps = run_against_team(monkeypatch, llm, scenario)
+
+    assert status == "finished"
+    # The URL rule left the request to the supervisor model, which started both workers in one step.
+    # Once both had answered, the all_workers_done rule finished the run without another model call
+    assert llm.routes == [["Search", "WebScraper"]]
+    assert llm.peak_working == 2
+    assert sorted(final_results) == ["Search", "WebScraper"]
+    assert steps[0] == steps[-1] == "supervisor" and sorted(steps[1:3]) == ["Search", "WebScraper"]
+
+
+async def start_parked_run(client: httpx.AsyncClient, **settings) -> str:
+    """Start a run whose Search step waits for approval, and wait until it parks."""
+    run_id = (await client.post("/run_agent_stream", json={
+        "prompt": "important: look up the release notes", **settings})).json()["run_id"]
+    parked = await wait_for_status(client, run_id, ("parked",) + FINISHED_STATUSES)
+    assert parked["status"] == "parked"
+    return run_id
+
+
+@pytest.mark.parametrize("feedback, status, kept", [
+    ("yes", "finished", ["Search"]),
+    ("no, cite the sources", "rejected", []),
+], ids=["approve", "reject"])
+def test_approval_decides_whether_the_run_continues(monkeypatch, feedback, status, kept):
+    monkeypatch.setenv("SYMPHONY_ROUTER_RULES", "{}")
+    llm = ScriptedTeamLLM("Search")
+
+    async def scenario(client):
+        events = symphony_api.status_broadcaster.subscribe()
+        try:
+            run_id = await start_parked_run(client)
+            resolved = await client.post("/resolve_feedback",
+                                         json={"agent": "Search", "feedback": feedback, "run_id": run_id})
+            finished = await wait_for_status(client, run_id, FINISHED_STATUSES)
+        finally:
+            symphony_api.status_broadcaster.unsubscribe(events)
+        lifecycle = [event["type"] for event in drain(events) if event["run_id"] == run_id
+                     and event["type"] in ("task_start", "task_parked", "human_feedback_resolved", "task_end")]
+        return resolved.json(), finished, await results(client, run_id), lifecycle
+
+    resolved, finished, final_results, lifecycle = run_against_team(monkeypatch, llm, scenario)
+
+    assert resolved["approved"] is (status == "finished")
+    # Dashboards see the run stop running when it parks, and start again once approved
+    assert lifecycle == ["task_start", "task_parked", "human_feedback_resolved"] + (
+        ["task_start", "task_end"] if status == "finished" else [])
+    assert finished["status"] == status
+    assert final_results == kept
+    if status == "rejected":
+        # The reviewer's feedback is kept as the reason
+        assert finished["error"] == "Search output rejected: no, cite the sources"
+
+
+@pytest.mark.parametrize("default, status", [("approve", "finished"), ("reject", "rejected")])
+def test_unanswered_approval_takes_the_default_at_its_deadline(monkeypatch, default, status):
+    monkeypatch.setenv("SYMPHONY_ROUTER_RULES", "{}")
+    llm = ScriptedTeamLLM("Search")
+
+    async def scenario(client):
+        run_id = await start_parked_run(client, feedback_timeout=0.3, feedback_default=default)
+        finished = await wait_for_status(client, run_id, FINISHED_STATUSES)
+        late = await client.post("/resolve_feedback", json={"agent": "Search", "feedback": "yes", "run_id": run_id})
+        return finished, late.status_code
+
+    finished, late = run_against_team(monkeypatch, llm, scenario)
+
+    assert finished["status"] == status
+    assert late == 400  # Nothing is pending any more
+    if status == "rejected":
+        assert finished["error"] == "Search output rejected: deadline passed"
+
+
+def test_parked_run_is_restored_after_a_restart(monkeypatch, tmp_path):
+    monkeypatch.setenv("SYMPHONY_ROUTER_RULES", "{}")
+    store = symphony_api.RunStore(str(tmp_path / "runs.db"))
+    monkeypatch.setattr(symphony_api, "run_store", store)
+    llm = ScriptedTeamLLM("Search")
+
+    async def scenario(client):
+        run_id = await start_parked_run(client)
+        await asyncio.to_thread(store.flush)
+        deadline = symphony_api.runs[run_id].human_feedback_needed["Search"]["deadline"]
+        # The server stops: its timers and in-memory runs are gone, the store keeps the parked run
+        symphony_api.runs[run_id].human_feedback_needed["Search"]["timer"].cancel()
+        monkeypatch.setattr(symphony_api, "runs", {})
+        await symphony_api.restore_parked_runs()
+        restored = symphony_api.runs[run_id]
+        waiting = restored.status, restored.human_feedback_needed["Search"]["deadline"] == deadline
+        await client.post("/resolve_feedback", json={"agent": "Search", "feedback": "yes", "run_id": run_id})
+        finished = await wait_for_status(client, run_id, FINISHED_STATUSES)
+        return waiting, finished["status"], await results(client, run_id)
+
+    try:
+        waiting, status, final_results = run_against_team(monkeypatch, llm, scenario)
+    finally:
+        store.close()
+
+    assert waiting == ("parked", True)
+    assert status == "finished"
+    assert final_results == ["Search"]
+
+
+def test_final_answer_ends_the_run_without_asking_the_supervisor_model(monkeypatch):
+    monkeypatch.delenv("SYMPHONY_ROUTER_RULES", raising=False)
+    llm = ScriptedTeamLLM("Search", answers={"Search": "FINAL ANSWER: LangGraph 0.1 is the latest release"})
+
+    async def scenario(client):
+        run_id = (await client.post("/run_agent_stream", json={
+            "prompt": "What is the latest LangGraph release?"})).json()["run_id"]
+        finished = await wait_for_status(client, run_id, FINISHED_STATUSES)
+        return finished["status"], await results(client, run_id)
+
+    status, final_results = run_against_team(monkeypatch, llm, scenario)
+
+    assert (status, final_results) == ("finished", ["Search"])
+    # Workers are told to mark an answer that completes the request, and the marker ends the run
+    assert llm.worker_prompts and all(symphony_api.FINAL_ANSWER_MARKER in prompt for prompt in llm.worker_prompts)
+    assert llm.routes == ["Search"]
@@ -0,0 +1,65 @@
+import asyncio
+
+from symphony_api import TokenBroadcaster, token_stream_drops
+
+
+def drain(queue: asyncio.Queue) -> list:
+    events = []
+    while not queue.empty():
+        events.append(queue.get_nowait())
+    return events
+
+
+def test_slow_subscriber_is_dropped_without_holding_up_the_others():
+    broadcaster = TokenBroadcaster(max_queue_size=3)
+    drops = token_stream_drops.values.get((), 0)
+
+    async def main():
+        slow, fast = broadcaster.subscribe("r"), broadcaster.subscribe("r")
+        received = []
+        for i in range(5):
+            broadcaster.publish("token", "r", text=str(i))
+            received += drain(fast)
+        broadcaster.close("r", "finished")
+        return drain(slow), received + drain(fast)
+
+    slow, fast = asyncio.run(main())
+
+    assert [event["type"] for event in slow] == ["token"] * 3 + ["dropped"]
+    assert [event.get("text") for event in slow[:3]] == ["0", "1", "2"]
+    assert [event["type"] for event in fast] == ["token"] * 5 + ["end"]
+    assert fast[-1]["status"] == "finished"
+    assert token_stream_drops.values[()] == drops + 1
+    assert "r" not in broadcaster.subscribers
+
+
+def test_end_is_delivered_to_a_subscriber_whose_queue_is_full():
+    broadcaster = TokenBroadcaster(max_queue_size=3)
+
+    async def main():
+        queue = broadcaster.subscribe("r")
+        for i in range(3):
+            broadcaster.publish("token", "r", text=str(i))
+        broadcaster.close("r", "stopped")
+        return drain(queue)
+
+    events = asyncio.run(main())
+
+    assert [event["type"] for event in events] == ["token"] * 3 + ["end"]
+    assert events[-1]["status"] == "stopped"
+
+
+def test_streams_only_get_their_own_run():
+    broadcaster = TokenBroadcaster(max_queue_size=3)
+
+    async def main():
+        first, second = broadcaster.subscribe("a"), broadcaster.subscribe("b")
+        broadcaster.publish("token", "a", text="for a")
+        broadcaster.close("a", "finished")
+        return drain(first), drain(second)
+
+    first, second = asyncio.run(main())
+
+    assert [event["type"] for event in first] == ["token", "end"]
+    assert second == []
+    assert list(broadcaster.subscribers) == ["b"]
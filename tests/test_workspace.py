@@ -0,0 +1,99 @@
+import asyncio
+import os
+
+import pytest
+
+from symphony_api import DocumentWorkspace, WorkspaceError, WorkspaceManager
+
+LINES = "one\ntwo\nthree\n"
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    workspace = DocumentWorkspace(tmp_path / "run", quota_bytes=1024)
+    workspace.write("notes.txt", LINES)
+    return workspace
+
+
+@pytest.mark.parametrize("inserts, expected", [
+    ({1: "zero"}, "zero\none\ntwo\nthree\n"),
+    ({3: "two and a half"}, "one\ntwo\ntwo and a half\nthree\n"),
+    ({4: "four"}, "one\ntwo\nthree\nfour\n"),
+    ({1: "zero", 3: "one and a half", 6: "four"}, "zero\none\none and a half\ntwo\nthree\nfour\n"),
+], ids=["start", "middle", "end", "several"])
+def test_insert_places_lines_before_the_line_number(workspace, inserts, expected):
+    workspace.insert("notes.txt", inserts)
+
+    assert workspace.read("notes.txt") == expected
+    assert workspace.size == len(expected)
+
+
+def test_insert_at_the_end_of_a_document_without_final_newline(workspace):
+    workspace.write("notes.txt", "one\ntwo")
+    workspace.insert("notes.txt", {3: "three", 4: "four"})
+
+    # Like the list of lines edit_document used to splice, the first insert continues the last line
+    assert workspace.read("notes.txt") == "one\ntwothree\nfour\n"
+    assert workspace.read("notes.txt", 2, 3) == "four\n"
+
+
+@pytest.mark.parametrize("line_number", [0, 5])
+def test_insert_past_the_document_is_refused(workspace, line_number):
+    with pytest.raises(WorkspaceError, match="out of range"):
+        workspace.insert("notes.txt", {line_number: "nowhere"})
+
+    assert workspace.read("notes.txt") == LINES
+
+
+@pytest.mark.parametrize("start, end, expected", [
+    (0, 1, "one\n"),
+    (1, 2, "two\n"),
+    (2, None, "three\n"),
+    (None, None, LINES),
+    (3, None, ""),
+    (10, 20, ""),
+], ids=["start", "middle", "end", "whole", "at-eof", "past-eof"])
+def test_read_returns_the_requested_lines(workspace, start, end, expected):
+    assert workspace.read("notes.txt", start, end) == expected
+
+
+def test_reads_follow_writes_and_edits_made_outside_the_workspace(workspace):
+    workspace.read("notes.txt")
+    workspace.write("notes.txt", "alpha\nbeta\n")
+    assert workspace.read("notes.txt", 1, 2) == "beta\n"
+
+    # The line index is keyed on the file version, so a change made by anything else rebuilds it
+    path = workspace.resolve("notes.txt")
+    path.write_text("first line, now much longer\nsecond\n")
+    os.utime(path, ns=(0, 1))
+    assert workspace.read("notes.txt", 1, 2) == "second\n"
+
+
+def test_documents_outside_the_workspace_are_refused(workspace):
+    with pytest.raises(WorkspaceError, match="outside the workspace"):
+        workspace.read("../elsewhere.txt")
+    with pytest.raises(WorkspaceError, match="does not exist"):
+        workspace.read("missing.txt")
+
+
+def test_writes_beyond_the_quota_are_refused(workspace):
+    with pytest.raises(WorkspaceError, match="limited to 1024 bytes"):
+        workspace.write("big.txt", "x" * 1024)
+    assert not workspace.resolve("big.txt").exists()
+
+
+def test_ended_workspaces_are_deleted_oldest_first_over_the_total_quota(tmp_path):
+    manager = WorkspaceManager(tmp_path / "workspaces", quota_bytes=1024, total_quota_bytes=250)
+
+    async def main():
+        for run_id in ("a", "b", "c"):
+            manager.get(run_id).write("notes.txt", "x" * 100)
+        await manager.end_session("a")
+        await manager.end_session("b")
+        await manager.end_session("missing")
+
+    asyncio.run(main())
+
+    assert list(manager.ended) == ["b"]
+    assert list(manager.active) == ["c"]
+    assert sorted(path.name for path in (tmp_path / "workspaces").iterdir()) == ["b", "c"]